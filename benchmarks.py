@@ -0,0 +1,638 @@
+# Benchmarks for the shopping cart.
+# Run with: python benchmarks.py <benchmark> (python benchmarks.py --help lists them)
+import argparse
+import contextlib
+import csv
+import datetime
+import importlib.util
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+
+# The main code file has spaces in its name so it is loaded from its path instead of imported by name
+def load_shop():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "shopping cart using python oop.py")
+    spec = importlib.util.spec_from_file_location("shop", path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["shop"] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+shop = load_shop()
+
+
+# Function to call func repeatedly for about `seconds` seconds, returns calls per second
+def rate(func, seconds):
+    calls = 0
+    start = time.perf_counter()
+    deadline = start + seconds
+    while True:
+        func()
+        calls += 1
+        now = time.perf_counter()
+        if now >= deadline:
+            return calls / (now - start)
+
+
+# Benchmark of logins per second at different password hashing costs, with and without the verification cache
+def bench_login(args):
+    settings = [('pbkdf2_sha256', dict(iterations=iterations)) for iterations in (10000, 50000, 100000, 200000, 600000)]
+    settings += [('scrypt', dict(n=n)) for n in (2**12, 2**14, 2**15)]
+    print(f"{'algorithm':<15}{'cost':<18}{'hash ms':>10}{'logins/sec':>14}{'cached/sec':>14}")
+    for algorithm, params in settings:
+        hasher = shop.PasswordHasher(algorithm, **params)
+        cache = shop.VerificationCache()
+        start = time.perf_counter()
+        encoded = hasher.hash("Password123")
+        hash_ms = (time.perf_counter() - start) * 1000
+        cold = rate(lambda: hasher.verify("Password123", encoded), args.seconds)
+
+        def cached_login():
+            if not cache.check("Password123", encoded) and hasher.verify("Password123", encoded):
+                cache.add("Password123", encoded)
+        cached_login()
+        warm = rate(cached_login, args.seconds)
+        cost = ', '.join(f"{key}={value}" for key, value in params.items())
+        print(f"{algorithm:<15}{cost:<18}{hash_ms:>10.1f}{cold:>14.1f}{warm:>14.0f}")
+
+
+# Stress test of concurrent carts fighting over a few products, fails if any stock is oversold or lost or a shopper
+# thread raised
+def stress_reservations(args):
+    stock = args.stock
+    reservations = shop.InventoryReservations(ttl=60)
+    products = [shop.Product(i, f"Product {i}", 10, "Contended product", stock) for i in range(1, args.products + 1)]
+    customers = [shop.Customer(i, f"customer{i}", None, "Stress", "Test", "-", password_hash="-") for i in range(args.threads)]
+    for customer in customers:
+        customer.cart = shop.ShoppingCart(customer, reservations)
+    sold = [0] * args.threads
+    errors = [None] * args.threads
+    start_barrier = threading.Barrier(args.threads)
+
+    def shopper(index):
+        rng = random.Random(index)
+        cart = customers[index].cart
+        # Every fourth shopper never checks out, their carts are abandoned at the end
+        abandons = index % 4 == 0
+        start_barrier.wait()
+        try:
+            for _ in range(args.operations):
+                product = rng.choice(products)
+                action = rng.random()
+                if action < 0.6:
+                    cart.add_product(product, rng.randint(1, 3))
+                elif action < 0.95 or abandons:
+                    cart.remove_product(product.product_id, rng.randint(1, 3))
+                else:
+                    sold[index] += sum(line.quantity for line in cart.checkout().lines)
+        except Exception as error:
+            errors[index] = error
+
+    old_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    old_stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        threads = [threading.Thread(target=shopper, args=(i,)) for i in range(args.threads)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        sys.stdout.close()
+        sys.stdout = old_stdout
+        sys.setswitchinterval(old_interval)
+
+    in_carts = sum(customer.cart.quantity_of(product.product_id) for customer in customers for product in products)
+    left = sum(product.quantity for product in products)
+    total = stock * len(products)
+    ok = all(product.quantity >= 0 for product in products) and sum(sold) + in_carts + left == total
+    print(f"{args.threads} threads x {args.operations} operations in {elapsed:.2f}s: sold {sum(sold)}, in carts {in_carts}, left {left}, started with {total}")
+    failed = [(index, error) for index, error in enumerate(errors) if error is not None]
+    for index, error in failed:
+        print(f"shopper {index} raised {type(error).__name__}: {error}")
+    ok = ok and not failed
+
+    # Every cart left with items is abandoned, expiring them has to give all of that stock back
+    reservations.ttl = 0
+    for customer in customers:
+        reservations.touch(customer.cart)
+    reservations.expire(time.monotonic() + 1)
+    left_after_expiry = sum(product.quantity for product in products)
+    ok = ok and left_after_expiry == total - sum(sold)
+    print(f"after expiring abandoned carts: left {left_after_expiry}")
+    print("PASS: no stock oversold or lost" if ok else "FAIL: stock oversold or lost" if not failed else f"FAIL: {len(failed)} shopper threads raised")
+    if not ok:
+        sys.exit(1)
+
+
+# Function making synthetic products one at a time, descriptions repeat like they do in real catalogs
+def synthetic_products(count, start_id=1):
+    adjectives = ["Wireless", "Compact", "Premium", "Budget", "Smart", "Portable", "Heavy duty", "Eco"]
+    kinds = ["laptop", "phone", "tablet", "camera", "printer", "monitor", "keyboard", "mouse", "speaker", "charger"]
+    for i in range(start_id, start_id + count):
+        kind = kinds[i % len(kinds)]
+        adjective = adjectives[(i // len(kinds)) % len(adjectives)]
+        yield shop.Product(i, f"{adjective} {kind} {i}", round(5 + (i * 7919 % 200000) / 100, 2), f"{adjective} {kind} for everyday use", i % 500)
+
+
+# The Product class as it was before it got __slots__, used as the baseline of the memory benchmark
+class DictProduct:
+    def __init__(self, product_id, name, price, description, quantity):
+        self.product_id = product_id
+        self.name = name
+        self.price = price
+        self.description = description
+        self.quantity = quantity
+
+
+# Benchmark of the memory used by a catalog of Product objects (with and without __slots__) and by the columnar catalog
+def bench_memory(args):
+    print(f"{args.products} products")
+    modes = (
+        ("Product objects with __dict__", shop.ProductCatalog, lambda p: DictProduct(p.product_id, p.name, p.price, p.description, p.quantity)),
+        ("Product objects with __slots__", shop.ProductCatalog, lambda p: p),
+        ("ColumnarCatalog (arrays)", shop.ColumnarCatalog, lambda p: p),
+    )
+    for label, catalog_class, convert in modes:
+        tracemalloc.start()
+        catalog = catalog_class()
+        for product in synthetic_products(args.products):
+            catalog.add(convert(product))
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{label:<32}{current / 2**20:>10.1f} MiB{current / args.products:>10.0f} bytes/product (peak {peak / 2**20:.1f} MiB)")
+        del catalog
+
+
+SEARCH_WORDS = ["wireless", "compact", "premium", "laptop", "phone", "camera", "smart", "charger"]
+
+
+# Function to write a synthetic user population straight into a users file, every user shares one password hash
+def write_synthetic_users(filename, count, password_hash):
+    with open(filename, 'w') as file:
+        for user_id in range(1, count + 1):
+            file.write(json.dumps({'type': 'Customer', 'user_id': user_id, 'username': f"user{user_id:08d}",
+                                   'first_name': "Synthetic", 'last_name': "User", 'address': f"{user_id} Benchmark St",
+                                   'password_hash': password_hash}) + '\n')
+
+
+# Function to time one workflow: setup() runs untimed before every call of operation(i), returns the measurements
+def measure(operation, operations, setup=None, memory_operations=200):
+    latencies = []
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        for i in range(operations):
+            if setup is not None:
+                setup(i)
+            begin = time.perf_counter_ns()
+            operation(i)
+            latencies.append(time.perf_counter_ns() - begin)
+        wall = time.perf_counter() - start
+        # A short second pass under tracemalloc gives the memory the workflow allocates (tracemalloc slows everything down)
+        tracemalloc.start()
+        for i in range(operations, operations + min(memory_operations, operations)):
+            if setup is not None:
+                setup(i)
+            operation(i)
+        traced_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    latencies.sort()
+    timed = sum(latencies) / 1e9
+    return {
+        'operations': operations,
+        'throughput_per_sec': operations / timed if timed else 0.0,
+        'p50_ms': latencies[len(latencies) // 2] / 1e6,
+        'p99_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] / 1e6,
+        'wall_sec': wall,
+        'peak_traced_kib': traced_peak / 1024,
+        'max_rss_mib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+# Function to run every shopping workflow against one synthetic catalog size, returns {workflow: measurements}
+def run_workflows(catalog_size, args, workdir):
+    rng = random.Random(catalog_size)
+    results = {}
+    operations = args.operations
+
+    start = time.perf_counter()
+    store = shop.Store(compact=args.compact)
+    for product in synthetic_products(catalog_size):
+        product.quantity += 1000000
+        store.add_product(product)
+    results['build_catalog'] = {'seconds': time.perf_counter() - start, 'max_rss_mib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+    hasher = shop.password_hasher
+    users_file = os.path.join(workdir, f"users-{catalog_size}.txt")
+    write_synthetic_users(users_file, args.users, hasher.hash("Password123"))
+    start = time.perf_counter()
+    user_db = shop.UserDatabase(users_file)
+    results['load_users'] = {'seconds': time.perf_counter() - start, 'users': args.users}
+    order_store = shop.OrderStore(os.path.join(workdir, f"orders-{catalog_size}.db"))
+    sessions = shop.SessionManager(store)
+    customers = [user_db.find_user(f"user{user_id:08d}") for user_id in rng.sample(range(1, args.users + 1), min(args.users, 500))]
+    for customer in customers:
+        sessions.login(customer)
+    product_ids = [rng.randint(1, catalog_size) for _ in range(4 * operations + 1000)]
+    queries = [rng.choice(SEARCH_WORDS)[:rng.randint(2, 7)] for _ in range(2 * operations)]
+
+    def signup(i):
+        customer = shop.Customer(user_db.allocate_user_id(), f"signup{catalog_size}x{i:08d}", "Password123", "New", "Customer", "-")
+        user_db.add_user(customer)
+    results['signup'] = measure(signup, min(operations, args.kdf_operations))
+
+    def forget_logins(i):
+        shop.verification_cache.clear()
+
+    def login(i):
+        user = user_db.find_user(f"user{rng.randint(1, args.users):08d}", 'Customer')
+        user.check_password("Password123")
+        sessions.login(user)
+    results['login'] = measure(login, min(operations, args.kdf_operations), setup=forget_logins)
+
+    results['search'] = measure(lambda i: store.search(queries[i % len(queries)]), operations)
+
+    def add_to_cart(i):
+        customers[i % len(customers)].cart.add_product(store.get_product(product_ids[i]), 1)
+    results['add_to_cart'] = measure(add_to_cart, operations)
+
+    def fill_cart(i):
+        cart = customers[i % len(customers)].cart
+        for product_id in product_ids[3 * i % len(product_ids): 3 * i % len(product_ids) + 3]:
+            cart.add_product(store.get_product(product_id), 1)
+
+    results['checkout'] = measure(lambda i: customers[i % len(customers)].cart.checkout(order_store), operations, setup=fill_cart)
+
+    def view_history(i):
+        list(itertools.islice(customers[i % len(customers)].iter_shopping_history(order_store, 20), 20))
+    results['history'] = measure(view_history, operations)
+
+    sessions.close()
+    order_store.close()
+    return results
+
+
+# Benchmark of the realistic shopping workflows (signup, login, search, add to cart, checkout, history) on synthetic
+# catalogs and user populations, prints throughput, p50/p99 latency and memory and saves everything as JSON
+def bench_workflows(args):
+    if args.kdf_iterations is not None:
+        shop.configure_password_hashing(iterations=args.kdf_iterations)
+    report = {
+        'date': datetime.datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'compact': args.compact,
+        'users': args.users,
+        'operations': args.operations,
+        'password_hashing': {'algorithm': shop.password_hasher.algorithm, 'iterations': shop.password_hasher.iterations},
+        'results': {},
+    }
+    with tempfile.TemporaryDirectory() as workdir:
+        for size in args.catalog_sizes:
+            print(f"\nCatalog of {size} products, {args.users} users")
+            results = report['results'][str(size)] = run_workflows(size, args, workdir)
+            print(f"  build catalog {results['build_catalog']['seconds']:.2f}s, load users {results['load_users']['seconds']:.2f}s")
+            print(f"  {'workflow':<14}{'ops/sec':>12}{'p50 ms':>10}{'p99 ms':>10}{'traced KiB':>12}{'max RSS MiB':>13}")
+            for workflow, result in results.items():
+                if 'throughput_per_sec' in result:
+                    print(f"  {workflow:<14}{result['throughput_per_sec']:>12.1f}{result['p50_ms']:>10.3f}{result['p99_ms']:>10.3f}{result['peak_traced_kib']:>12.0f}{result['max_rss_mib']:>13.0f}")
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f"\nSaved results to {args.output}")
+    if args.compare:
+        compare_results(args.compare, report)
+
+
+# Function to print how the throughput and p99 latency changed compared to an earlier results file
+def compare_results(filename, report):
+    with open(filename) as file:
+        previous = json.load(file)
+    print(f"\nCompared to {filename} ({previous.get('date', 'unknown date')}):")
+    for size, results in report['results'].items():
+        for workflow, result in results.items():
+            before = previous.get('results', {}).get(size, {}).get(workflow)
+            if not before or 'throughput_per_sec' not in result or not before.get('throughput_per_sec'):
+                continue
+            throughput = (result['throughput_per_sec'] / before['throughput_per_sec'] - 1) * 100
+            p99 = (result['p99_ms'] / before['p99_ms'] - 1) * 100 if before['p99_ms'] else 0.0
+            flag = "  <-- slower" if throughput < -10 else ""
+            print(f"  {size:>10} {workflow:<14} throughput {throughput:+7.1f}%  p99 {p99:+7.1f}%{flag}")
+
+
+# Benchmark of the inventory journal: stock changes per second from many threads (each one durable on disk within the
+# group commit delay), then how long a restart takes from the snapshot plus the log
+def bench_journal(args):
+    with tempfile.TemporaryDirectory() as workdir:
+        directory = os.path.join(workdir, 'inventory')
+        store = shop.Store(compact=args.compact)
+        journal = store.journal = shop.InventoryJournal(directory, store, snapshot_every=args.snapshot_every)
+        journal.open()
+        start = time.perf_counter()
+        for product in synthetic_products(args.products):
+            store.add_product(product)
+        print(f"journaled {args.products} new products in {time.perf_counter() - start:.2f}s")
+        reservations = shop.InventoryReservations()
+
+        def shopper(index):
+            rng = random.Random(index)
+            for _ in range(args.operations):
+                product = store.get_product(rng.randint(1, args.products))
+                with reservations.lock_for(product.product_id):
+                    store.change_quantity(product, -1 if product.quantity else 1)
+
+        threads = [threading.Thread(target=shopper, args=(i,)) for i in range(args.threads)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        journal.barrier()
+        elapsed = time.perf_counter() - start
+        changes = args.threads * args.operations
+        print(f"{args.threads} threads made {changes} stock changes in {elapsed:.2f}s: {changes / elapsed:.0f} durable changes/sec")
+        stock = {product.product_id: product.quantity for product in store.products}
+
+        # Stop without the final snapshot, like a crash right after the last fsync, so the restart has to replay the log
+        journal.close(snapshot=False)
+        start = time.perf_counter()
+        restarted = shop.Store(compact=args.compact)
+        replayed = shop.InventoryJournal(directory, restarted, snapshot_every=args.snapshot_every).open()
+        elapsed = time.perf_counter() - start
+        ok = {product.product_id: product.quantity for product in restarted.products} == stock
+        print(f"restart replayed {replayed} events on top of the snapshot in {elapsed:.2f}s")
+        print("PASS: stock recovered exactly" if ok else "FAIL: recovered stock differs")
+        restarted.journal.close(snapshot=False)
+        if not ok:
+            sys.exit(1)
+
+
+# One client process of the sharded benchmark: shops through its own router for a while, sends back how many calls it made
+def sharded_client(router, users, products, seconds, results):
+    rng = random.Random(router.router_id)
+    calls = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        user_id = rng.choice(users)
+        action = rng.random()
+        if action < 0.4:
+            router.get_product(rng.randint(1, products))
+        elif action < 0.5:
+            router.search(rng.choice(SEARCH_WORDS))
+        elif action < 0.95:
+            product_id = rng.randint(1, products)
+            if router.add_to_cart(user_id, product_id, 1):
+                router.remove_from_cart(user_id, product_id, 1)
+                calls += 1
+        else:
+            router.add_to_cart(user_id, rng.randint(1, products), 1)
+            router.checkout(user_id)
+            calls += 1
+        calls += 1
+    results.put(calls)
+
+
+# Benchmark of the sharded store: the same shopping mix with 1, 2, 4... shards (up to --shards, one client process per
+# shard), throughput should grow about linearly with shards as long as there are free cores
+def bench_sharded(args):
+    context = multiprocessing.get_context('fork')
+    if args.kdf_iterations is not None:
+        shop.configure_password_hashing(iterations=args.kdf_iterations)
+    max_shards = args.shards or os.cpu_count() or 1
+    counts = [1]
+    while counts[-1] * 2 <= max_shards:
+        counts.append(counts[-1] * 2)
+    if counts[-1] != max_shards:
+        counts.append(max_shards)
+    print(f"{os.cpu_count()} cores, {args.products} products, {args.seconds}s per run")
+    baseline = None
+    for shards in counts:
+        with tempfile.TemporaryDirectory() as workdir:
+            sharded = shop.ShardedStore(workdir, shards=shards, routers=shards + 1).start()
+            setup = sharded.router(shards)
+            products = list(synthetic_products(args.products))
+            for product in products:
+                product.quantity = 10 ** 9
+            setup.add_products(products)
+            users = [setup.signup(f"shopper{i}", "Password123", "Bench", "Shopper", "-") for i in range(20 * shards)]
+            results = context.Queue()
+            clients = [context.Process(target=sharded_client, args=(sharded.router(i), users, args.products, args.seconds, results)) for i in range(shards)]
+            for client in clients:
+                client.start()
+            calls = sum(results.get() for client in clients)
+            for client in clients:
+                client.join()
+            sharded.stop()
+        throughput = calls / args.seconds
+        baseline = baseline or throughput
+        print(f"  {shards:>3} shards: {throughput:>10.0f} calls/sec  x{throughput / baseline:.2f}")
+
+
+# Run in a new Python process by the startup benchmark: loads the main file the way running it does (compiled from source,
+# not imported) then sets up the store like the menu does, and prints how long each part took
+STARTUP_SCRIPT = """
+import json, runpy, sys, time
+start = time.perf_counter()
+shop = runpy.run_path(sys.argv[1], run_name='startup')
+loaded = time.perf_counter()
+store, user_db, order_store, sessions, admin = shop['setup_store']()
+ready = time.perf_counter()
+print(json.dumps({'load_ms': (loaded - start) * 1000, 'setup_ms': (ready - loaded) * 1000, 'modules': len(sys.modules),
+                  'products': len(store.products), 'users': len(user_db.users)}))
+sessions.close()
+order_store.close()
+store.journal.close(snapshot=False)
+"""
+
+
+# Benchmark of how long the program takes to start with --users users and --products products already saved:
+# the first start parses users.txt (and saves its snapshot), the later ones load the snapshots
+def bench_startup(args):
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "shopping cart using python oop.py")
+    with tempfile.TemporaryDirectory() as workdir:
+        write_synthetic_users(os.path.join(workdir, 'users.txt'), args.users, shop.password_hasher.hash("Password123"))
+        store = shop.Store()
+        journal = store.journal = shop.InventoryJournal(os.path.join(workdir, 'inventory'), store)
+        journal.open()
+        for product in synthetic_products(args.products):
+            store.add_product(product)
+        journal.close()
+        print(f"{args.users} users, {args.products} products")
+        print(f"  {'run':<14}{'process ms':>12}{'load ms':>10}{'setup ms':>10}{'modules':>9}")
+        for run in ['first start', 'second start', 'third start']:
+            start = time.perf_counter()
+            output = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT, path], cwd=workdir, capture_output=True, text=True, check=True).stdout
+            elapsed = (time.perf_counter() - start) * 1000
+            result = json.loads(output.strip().splitlines()[-1])
+            print(f"  {run:<14}{elapsed:>12.0f}{result['load_ms']:>10.0f}{result['setup_ms']:>10.0f}{result['modules']:>9}")
+
+
+# Benchmark of the catalog import/export pipeline in rows/sec: a full load into an empty store, a nightly style sync
+# changing prices and stock of every product (with some new products, deletes and bad rows), then an export
+def bench_catalog_import(args):
+    with tempfile.TemporaryDirectory() as workdir:
+        for file_format in ['csv', 'jsonl']:
+            store = shop.Store(compact=args.compact)
+            sync = shop.CatalogSync(store)
+            full = os.path.join(workdir, f"full.{file_format}")
+            changes = os.path.join(workdir, f"changes.{file_format}")
+            write_catalog_file(full, file_format, synthetic_products(args.products))
+            write_changes_file(changes, file_format, args.products)
+            print(f"{file_format}, {args.products} products:")
+            report = sync.import_file(full)
+            print(f"  full load    {report.rows / report.seconds:>10.0f} rows/sec  ({report.added} added)")
+            report = sync.import_file(changes, os.path.join(workdir, 'rejects.csv'))
+            print(f"  sync         {report.rows / report.seconds:>10.0f} rows/sec  ({report.updated} updated, {report.added} added, {report.removed} removed, {report.rejected} rejected)")
+            start = time.perf_counter()
+            count = sync.export_file(os.path.join(workdir, f"export.{file_format}"))
+            print(f"  export       {count / (time.perf_counter() - start):>10.0f} rows/sec")
+
+
+# Function to write products to a CSV or JSON lines file for the import benchmark
+def write_catalog_file(filename, file_format, products):
+    with open(filename, 'w', newline='') as file:
+        if file_format == 'csv':
+            writer = csv.writer(file)
+            writer.writerow(shop.CatalogSync.FIELDS)
+            for product in products:
+                writer.writerow([product.product_id, product.name, product.price, product.description, product.quantity])
+        else:
+            for product in products:
+                file.write(json.dumps({'product_id': product.product_id, 'name': product.name, 'price': product.price,
+                                       'description': product.description, 'quantity': product.quantity}) + '\n')
+
+
+# Function to write the nightly changes for the import benchmark: new prices and stock for every product, 1% new
+# products, 1% deletes and 0.1% invalid rows
+def write_changes_file(filename, file_format, count):
+    rng = random.Random(count)
+    with open(filename, 'w', newline='') as file:
+        writer = csv.writer(file) if file_format == 'csv' else None
+        if writer is not None:
+            writer.writerow(shop.CatalogSync.FIELDS + ['action'])
+        for product_id in range(1, count + count // 100 + 1):
+            roll = rng.random()
+            if product_id > count:
+                row = [product_id, f"New product {product_id}", round(rng.uniform(5, 500), 2), "Added by the nightly sync", rng.randint(0, 100), '']
+            elif roll < 0.01:
+                row = [product_id, '', '', '', '', 'delete']
+            elif roll < 0.011:
+                row = [product_id, '', 'free', '', '-5', '']
+            else:
+                row = [product_id, '', round(rng.uniform(5, 500), 2), '', rng.randint(0, 500), '']
+            if writer is not None:
+                writer.writerow(row)
+            else:
+                file.write(json.dumps({name: value for name, value in zip(shop.CatalogSync.FIELDS + ['action'], row) if value != ''}) + '\n')
+
+
+# Benchmark of cart re-pricing: a cart with --cart-lines lines under --rules pricing rules (percent off, buy X get Y
+# and quantity tiers spread over the products and categories), the time of one add/remove priced incrementally
+# against pricing the whole cart again after every change as a cart without incremental pricing would
+def bench_pricing(args):
+    rng = random.Random(args.rules)
+    products = list(synthetic_products(max(args.products, args.cart_lines)))
+    for product in products:
+        product.quantity = args.stock
+    categories = {f"category-{index}": [] for index in range(100)}
+    for product in products:
+        categories[f"category-{product.product_id % 100}"].append(product.product_id)
+    rules = [shop.PercentOff(5)]
+    for index in range(args.rules):
+        target = {'category': f"category-{rng.randrange(100)}"} if index % 10 == 0 else {'product_ids': (rng.randint(1, len(products)),)}
+        kind = index % 3
+        if kind == 0:
+            rules.append(shop.PercentOff(rng.choice([5, 10, 12.5, 20]), **target))
+        elif kind == 1:
+            rules.append(shop.BuyXGetY(rng.randint(1, 3), 1, rng.choice([50, 100]), **target))
+        else:
+            rules.append(shop.QuantityTier(((3, 5), (10, 10), (50, 15)), **target))
+    engine = shop.PricingEngine()
+    start = time.perf_counter()
+    engine.compile(rules, categories)
+    print(f"{len(rules)} rules over {len(products)} products compiled in {(time.perf_counter() - start) * 1000:.1f} ms")
+    cart = shop.ShoppingCart(shop.Customer(1, "bench", "Password123", "Bench", "User", "1 Bench St"), shop.InventoryReservations(), engine)
+    with contextlib.redirect_stdout(io.StringIO()):
+        for product in products[:args.cart_lines]:
+            cart.add_product(product, rng.randint(1, 20))
+    changes = [(products[rng.randrange(args.cart_lines)], rng.randint(1, 5)) for _ in range(1000)]
+    operations = itertools.cycle(changes)
+
+    def incremental():
+        product, quantity = next(operations)
+        cart.add_product(product, quantity)
+        cart.remove_product(product.product_id, quantity)
+        return cart.total_price
+
+    def full():
+        product, quantity = next(operations)
+        cart.add_product(product, quantity)
+        cart._reprice_all()
+        cart.remove_product(product.product_id, quantity)
+        cart._reprice_all()
+        return cart.total_price
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        incremental_rate = rate(incremental, args.seconds)
+        full_rate = rate(full, args.seconds)
+    print(f"cart of {len(cart.lines)} lines, one add and one remove each:")
+    print(f"  incremental  {incremental_rate:>10.0f} changes/sec  ({1e6 / incremental_rate:.1f} us each)")
+    print(f"  full         {full_rate:>10.0f} changes/sec  ({1e6 / full_rate:.1f} us each)")
+
+
+BENCHMARKS = {
+    'login': bench_login,
+    'memory': bench_memory,
+    'stress-reservations': stress_reservations,
+    'workflows': bench_workflows,
+    'journal': bench_journal,
+    'sharded': bench_sharded,
+    'startup': bench_startup,
+    'catalog-import': bench_catalog_import,
+    'pricing': bench_pricing,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Shopping cart benchmarks")
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--seconds', type=float, default=1.0, help="how long to run each measurement")
+    parser.add_argument('--threads', type=int, default=32, help="number of concurrent shoppers")
+    parser.add_argument('--operations', type=int, default=2000, help="cart operations per shopper")
+    parser.add_argument('--products', type=int, default=None, help="number of products (default: 3 for stress-reservations, 200000 otherwise)")
+    parser.add_argument('--stock', type=int, default=2000, help="starting stock of every product")
+    parser.add_argument('--catalog-sizes', type=lambda value: [int(size) for size in value.split(',')], default=[1000, 100000],
+                        help="comma separated catalog sizes for workflows, e.g. 1000,100000,10000000")
+    parser.add_argument('--users', type=int, default=10000, help="synthetic users for workflows and startup")
+    parser.add_argument('--compact', action='store_true', help="use the compact (columnar) catalog for workflows, journal and catalog-import")
+    parser.add_argument('--kdf-iterations', type=int, default=None, help="PBKDF2 iterations for workflows and sharded (default: the application's setting)")
+    parser.add_argument('--kdf-operations', type=int, default=50, help="signups/logins to time in workflows (each pays the full hashing cost)")
+    parser.add_argument('--output', default='bench_results.json', help="where workflows saves its JSON results")
+    parser.add_argument('--compare', help="earlier workflows JSON results to compare against")
+    parser.add_argument('--shards', type=int, default=None, help="most shards for sharded (default: one per core)")
+    parser.add_argument('--snapshot-every', type=int, default=100000, help="journal events between snapshots")
+    parser.add_argument('--cart-lines', type=int, default=10000, help="lines in the cart for pricing")
+    parser.add_argument('--rules', type=int, default=10000, help="pricing rules for pricing")
+    args = parser.parse_args()
+    if args.products is None:
+        args.products = 3 if args.benchmark == 'stress-reservations' else 200000
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == "__main__":
+    main()
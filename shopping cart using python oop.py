@@ -1,323 +1,3987 @@
 # Modules used.
 import os
+import sys
+import atexit
+import importlib.util
 from abc import ABC, abstractmethod
 import datetime
 import re
-from colorama import Fore, Style, init
+import json
+import csv
+import pickle
+import threading
+import sqlite3
+import secrets
+import itertools
+import zlib
+import hashlib
+import hmac
+import time
+import functools
+import cProfile
+from collections import OrderedDict, namedtuple
+from decimal import Decimal, ROUND_HALF_UP
+import math
+import heapq
+from bisect import bisect_left, insort
+from array import array
+from operator import attrgetter
 
-# Initialize colorama for colored terminal text
-init(autoreset=True)
 
+# Function to import a module the first time one of its attributes is used instead of right away, keeping startup fast
+# for modules most runs never touch. Returns None if the module isn't installed.
+def lazy_import(name):
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        return None
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+# Only the API server needs asyncio and urllib, only the sharded store needs multiprocessing and only old user files need ast
+asyncio = lazy_import('asyncio')
+gzip = lazy_import('gzip')
+urllib_parse = lazy_import('urllib.parse')
+multiprocessing = lazy_import('multiprocessing')
+ast = lazy_import('ast')
+
+# NumPy is only needed for the catalog analytics (pip install numpy)
+np = lazy_import('numpy')
+
+
+# LazyColors class standing in for colorama's Fore and Style, colorama is imported and initialized (with autoreset)
+# when the first colour is used and every colour is kept on the object after its first use
+# The import happens under a lock, so threads printing their first colour at once never see a half imported colorama.
+class LazyColors:
+    lock = threading.Lock()
+    colorama = None
+
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, attribute):
+        colorama = LazyColors.colorama
+        if colorama is None:
+            with LazyColors.lock:
+                if LazyColors.colorama is None:
+                    import colorama
+                    colorama.init(autoreset=True)
+                    LazyColors.colorama = colorama
+                colorama = LazyColors.colorama
+        value = getattr(getattr(colorama, self.name), attribute)
+        setattr(self, attribute, value)
+        return value
+
+
+Fore = LazyColors('Fore')
+Style = LazyColors('Style')
+
+
+# Product class representing a product in the store
+# __slots__ keeps every product small, there's no per-instance __dict__
+class Product:
+    __slots__ = ('product_id', 'name', 'price', 'description', 'quantity')
+
+    def __init__(self, product_id, name, price, description, quantity):
+        self.product_id = product_id
+        self.name = name
+        self.price = price
+        self.description = description
+        self.quantity = quantity
+
+# Method to decrease the quantity of the product
+    def update_quantity(self, quantity):
+        self.quantity -= quantity
+
+# Method to increase the quantity of the product
+    def increase_quantity(self, quantity):
+        self.quantity += quantity
+
+# Method to display the product information
+    def display_product_info(self):
+        return f"{Fore.CYAN}Product ID: {self.product_id}, Name: {self.name}, Description: {self.description}, Price: {self.price}, Quantity: {self.quantity}{Style.RESET_ALL}"
+
+# Method to compare two products by their ID (Operator overloading used)
+    def __eq__(self, other):
+        if isinstance(other, Product): 
+            return self.product_id == other.product_id
+        return False
+    
+
+
+# PasswordHasher class turning passwords into salted hashes with a standard key derivation function
+# Hashes are stored as "pbkdf2_sha256$iterations$salt$hash" or "scrypt$n$r$p$salt$hash", so the cost used is kept
+# with every hash and old hashes still verify after the cost settings are changed.
+class PasswordHasher:
+    ALGORITHMS = ('pbkdf2_sha256', 'scrypt')
+
+    def __init__(self, algorithm='pbkdf2_sha256', iterations=200000, n=2**14, r=8, p=1, salt_size=16):
+        if algorithm not in self.ALGORITHMS:
+            raise ValueError(f"Unknown password hashing algorithm: {algorithm}")
+        self.algorithm = algorithm
+        self.iterations = iterations
+        self.n = n
+        self.r = r
+        self.p = p
+        self.salt_size = salt_size
+
+    @staticmethod
+    def _derive(password, salt, algorithm, params):
+        if algorithm == 'pbkdf2_sha256':
+            return hashlib.pbkdf2_hmac('sha256', password.encode(), salt, params[0])
+        n, r, p = params
+        return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p, maxmem=128 * n * r * p + 2**20, dklen=32)
+
+# Method to hash a password with a new random salt
+    def hash(self, password):
+        salt = os.urandom(self.salt_size)
+        params = (self.iterations,) if self.algorithm == 'pbkdf2_sha256' else (self.n, self.r, self.p)
+        digest = self._derive(password, salt, self.algorithm, params)
+        return '$'.join([self.algorithm] + [str(value) for value in params] + [salt.hex(), digest.hex()])
+
+# Method to check a password against a stored hash (in constant time)
+    def verify(self, password, encoded):
+        try:
+            algorithm, *fields = encoded.split('$')
+            params = tuple(int(value) for value in fields[:-2])
+            salt, expected = bytes.fromhex(fields[-2]), bytes.fromhex(fields[-1])
+        except (AttributeError, ValueError, IndexError):
+            return False
+        if algorithm not in self.ALGORITHMS:
+            return False
+        return hmac.compare_digest(self._derive(password, salt, algorithm, params), expected)
+
+# Method to check if a hash was made with different settings than the current ones
+    def needs_rehash(self, encoded):
+        params = (self.iterations,) if self.algorithm == 'pbkdf2_sha256' else (self.n, self.r, self.p)
+        return not encoded.startswith('$'.join([self.algorithm] + [str(value) for value in params]) + '$')
+
+
+
+# VerificationCache class remembering recent successful password checks so re-authenticating doesn't pay the full hashing cost
+# Entries are keyed by an HMAC (with a per-process random key) of the stored hash and the password, so no password is kept
+# in memory and changing a password makes its old entries useless. The oldest entries are dropped past max_entries or after ttl seconds.
+class VerificationCache:
+    def __init__(self, max_entries=10000, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.secret = os.urandom(32)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _key(self, password, encoded):
+        return hmac.new(self.secret, (encoded + '\0' + password).encode(), hashlib.sha256).digest()
+
+# Method to check if a password was recently verified against this hash
+    def check(self, password, encoded):
+        if self.max_entries <= 0:
+            return False
+        key = self._key(password, encoded)
+        now = time.monotonic()
+        with self.lock:
+            expires_at = self.entries.get(key)
+            if expires_at is None:
+                return False
+            if expires_at < now:
+                del self.entries[key]
+                return False
+            self.entries.move_to_end(key)
+            return True
+
+# Method to remember a successful verification
+    def add(self, password, encoded):
+        if self.max_entries <= 0:
+            return
+        key = self._key(password, encoded)
+        now = time.monotonic()
+        with self.lock:
+            self.entries[key] = now + self.ttl
+            self.entries.move_to_end(key)
+            while self.entries:
+                oldest_key, expires_at = next(iter(self.entries.items()))
+                if len(self.entries) <= self.max_entries and expires_at >= now:
+                    break
+                del self.entries[oldest_key]
+
+# Method to forget all remembered verifications
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+# Password hashing settings used for new passwords, change them with configure_password_hashing
+password_hasher = PasswordHasher()
+verification_cache = VerificationCache()
+
+# Function to change the password hashing cost and the verification cache settings
+def configure_password_hashing(algorithm='pbkdf2_sha256', iterations=200000, n=2**14, r=8, p=1, cache_size=10000, cache_ttl=300):
+    global password_hasher, verification_cache
+    password_hasher = PasswordHasher(algorithm, iterations, n, r, p)
+    verification_cache = VerificationCache(cache_size, cache_ttl)
+
+# Function to check a password against a stored hash, going through the verification cache first
+def verify_password(password, encoded):
+    if verification_cache.check(password, encoded):
+        return True
+    if password_hasher.verify(password, encoded):
+        verification_cache.add(password, encoded)
+        return True
+    return False
+
+
+
+# Abstract User class representing a user of the system
+# Only a salted hash of the password is kept, pass password_hash instead of password when loading a stored user.
+class User(ABC):
+    def __init__(self, user_id, username, password, first_name, last_name, address, password_hash=None):
+        self.user_id = user_id
+        self.username = username
+        self.password_hash = password_hash if password_hash is not None else password_hasher.hash(password)
+        self.first_name = first_name
+        self.last_name = last_name
+        self.address = address
+        self.shopping_history = []
+
+# Abstract method for user login, to be implemented by subclasses
+    @abstractmethod
+    def login(self, username, password, user_db=None):
+        pass
+
+# Method to create a user account
+    def create_account(self):
+        pass
+
+# Method to check a password against the user's stored hash
+# With a user_db, a hash made with older hashing settings is replaced by a new one after a successful check and saved
+    def check_password(self, password, user_db=None):
+        if not verify_password(password, self.password_hash):
+            return False
+        if user_db is not None and password_hasher.needs_rehash(self.password_hash):
+            self.set_password(password)
+            user_db.add_user(self)
+        return True
+
+# Method to change the user's password (save the user afterwards with UserDatabase.add_user)
+    def set_password(self, password):
+        self.password_hash = password_hasher.hash(password)
+
+# Method to get the user's orders one by one, from the order store when there is one (read a page at a time)
+    def iter_shopping_history(self, order_store=None, page_size=20):
+        if order_store is None:
+            yield from self.shopping_history
+            return
+        for page in order_store.orders_for_user(self, page_size):
+            yield from page
+
+# Method to view shopping history of the user, with an order store the orders are shown a page at a time
+# Each page is built as one string and written to the terminal at once
+    def view_shopping_history(self, order_store=None, page_size=10):
+        if order_store is None:
+            write_output("".join(order.view_order_details() + "\n" for order in self.shopping_history))
+            return
+        shown = 0
+        for page in order_store.orders_for_user(self, page_size):
+            write_output("".join(order.view_order_details() + "\n" for order in page))
+            shown += len(page)
+            if len(page) < page_size or not prompt_yes_no("Show more orders? (yes/no): "):
+                break
+        if shown == 0:
+            print(Fore.YELLOW + "You haven't placed any orders yet" + Style.RESET_ALL)
+
+
+
+# Customer class inheriting from User
+# The cart is only made when it's first used, a SessionManager hands out carts on login and takes them back when idle.
+# Once a SessionManager has handled the customer, the cart always comes from it (a new session if the last one ended).
+class Customer(User):
+    def __init__(self, user_id, username, password, first_name, last_name, address, password_hash=None):
+        super().__init__(user_id, username, password, first_name, last_name, address, password_hash)
+        self._cart = None
+        self.session_manager = None
+
+    @property
+    def cart(self):
+        if self._cart is None:
+            if self.session_manager is not None:
+                return self.session_manager.touch(self)
+            self._cart = ShoppingCart(self)
+        return self._cart
+
+    @cart.setter
+    def cart(self, cart):
+        self._cart = cart
+
+# Method for customer login
+    def login(self, username, password, user_db=None):
+      while True:
+        if self.username == username and self.check_password(password, user_db):
+            print(Fore.GREEN + "Login successful!" + Style.RESET_ALL)
+            break
+        else:
+            print(Fore.RED + "Invalid credentials" + Style.RESET_ALL)
+            username = input("Enter your username: ")
+            password = input("Enter your password: ")
+
+
+
+# Admin class inheriting from User
+class Admin(User):
+    def __init__(self, user_id, username, password, first_name, last_name, address, password_hash=None):
+        super().__init__(user_id, username, password, first_name, last_name, address, password_hash)
+
+# Method for admin login
+    def login(self, username, password, user_db=None):
+      while True:
+        if self.username == username and self.check_password(password, user_db):
+            print(Fore.GREEN + "Admin login successful!" + Style.RESET_ALL)
+            break
+        else:
+            print(Fore.RED + "Invalid admin credentials" + Style.RESET_ALL)
+            username = input("Enter admin username: ")
+            password = input("Enter admin password: ")
+
+# Method to add a product to the store (that doesn't already exist) for users to purchase
+    def add_product(self, store, product):
+        return store.add_product(product)
+
+# Method to remove a product from the store by ID
+    def remove_product(self, store, product_id):
+        return store.remove_product(product_id)
+
+# Method to change the prices of many products at once by a percentage, see CatalogAnalytics.bulk_price_change
+    def bulk_update_prices(self, store, percent, **filters):
+        return CatalogAnalytics(store).bulk_price_change(percent, **filters)
+
+# Method to update product information, the store's indexes and journal follow the change
+    def update_product_info(self, store, product, name=None, price=None, description=None, quantity=None):
+        old_name = product.name
+        old_description = product.description
+        if name is not None:
+            product.name = name
+        if price is not None:
+            product.price = price
+        if description is not None:
+            product.description = description
+        if quantity is not None:
+            product.quantity = quantity
+        store.product_updated(product, old_name, old_description)
+
+
+
+# Function to turn a price into a whole number of cents (rounding half up), so totals don't drift like floats do
+def to_cents(price):
+    return int((Decimal(str(price)) * 100).quantize(Decimal('1'), rounding=ROUND_HALF_UP))
+
+# Function to turn a number of cents back into a Decimal amount
+def from_cents(cents):
+    return Decimal(cents).scaleb(-2)
+
+
+
+# InventoryReservations class taking stock out of products while it sits in a cart, safe with many carts at once
+# Checking and taking stock happens under a lock picked by product ID (lock striping), so two carts can never both
+# take the last item, while carts working on different products rarely wait on each other.
+# Every cart holding stock has an expiry time that moves forward on each change, when a cart is left alone for
+# longer than ttl seconds expire() empties it and the stock goes back to the products.
+# Stock in a cart is only held, not sold: when the cart's store has a journal the journal just keeps count of it, and
+# sell() journals it as sold once the cart checks out, so after a crash stock that was in carts is back on the shelf.
+class InventoryReservations:
+    def __init__(self, ttl=900, stripes=64):
+        self.ttl = ttl
+        self.stripes = [threading.Lock() for _ in range(stripes)]
+        self.lock = threading.Lock()
+        self.expires = {}
+        self.carts = {}
+        self.heap = []
+        self.reaper = None
+        self.stop_event = threading.Event()
+
+# Method to get the lock guarding a product's stock
+    def lock_for(self, product_id):
+        return self.stripes[hash(product_id) % len(self.stripes)]
+
+# Method to get the locks guarding several products, in a fixed order so threads locking several products can't deadlock
+    def locks_for(self, product_ids):
+        indexes = sorted({hash(product_id) % len(self.stripes) for product_id in product_ids})
+        return [self.stripes[i] for i in indexes]
+
+# Method to get the journal of the store a cart shops in, None when there is none
+    @staticmethod
+    def journal_of(cart):
+        store = getattr(cart, 'store', None)
+        return store.journal if store is not None else None
+
+# Method to move stock from a product into a cart (a negative quantity gives it back), needs the product's lock
+    @staticmethod
+    def hold(journal, product, quantity):
+        if journal is not None:
+            journal.hold(product, quantity)
+        elif quantity > 0:
+            product.update_quantity(quantity)
+        else:
+            product.increase_quantity(-quantity)
+
+# Method to take stock for a cart, returns False (and takes nothing) if there isn't enough left
+# The cart calls touch() once its lines reflect the change
+    def reserve(self, cart, product, quantity):
+        journal = self.journal_of(cart)
+        with self.lock_for(product.product_id):
+            if quantity > product.quantity:
+                return False
+            self.hold(journal, product, quantity)
+        return True
+
+# Method to apply several stock changes all at once, changes is a list of (product, quantity) where a positive
+# quantity takes stock and a negative one gives it back. Nothing is changed unless every product has enough stock,
+# returns a dict of product ID -> stock available for the products that didn't (empty when the changes were applied).
+    def reserve_many(self, cart, changes):
+        journal = self.journal_of(cart)
+        locks = self.locks_for([product.product_id for product, quantity in changes])
+        for lock in locks:
+            lock.acquire()
+        try:
+            shortages = {product.product_id: product.quantity for product, quantity in changes if quantity > product.quantity}
+            if shortages:
+                return shortages
+            for product, quantity in changes:
+                if quantity:
+                    self.hold(journal, product, quantity)
+            return {}
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+# Method to give stock held by a cart back to the product (reserve() takes it, so quantity has to be at least 1)
+    def release(self, cart, product, quantity):
+        if quantity <= 0:
+            raise ValueError(f"Can't release {quantity} of product {product.product_id}")
+        journal = self.journal_of(cart)
+        with self.lock_for(product.product_id):
+            self.hold(journal, product, -quantity)
+
+# Method to turn stock held by a cart into sold stock, sold is a list of (product, quantity)
+    def sell(self, cart, sold):
+        journal = self.journal_of(cart)
+        if journal is not None:
+            for product, quantity in sold:
+                journal.sell(product, quantity)
+
+# Method to push a cart's expiry time forward, or stop tracking it once it's empty
+    def touch(self, cart):
+        with self.lock:
+            if not cart.lines:
+                self.expires.pop(cart.cart_id, None)
+                self.carts.pop(cart.cart_id, None)
+                return
+            expires_at = time.monotonic() + self.ttl
+            self.expires[cart.cart_id] = expires_at
+            self.carts[cart.cart_id] = cart
+            heapq.heappush(self.heap, (expires_at, cart.cart_id))
+
+# Method to turn a cart's held stock into sold stock when it checks out
+    def commit(self, cart):
+        with self.lock:
+            self.expires.pop(cart.cart_id, None)
+            self.carts.pop(cart.cart_id, None)
+
+# Method to check if a cart's expiry time has passed
+    def is_expired(self, cart, now):
+        with self.lock:
+            expires_at = self.expires.get(cart.cart_id)
+            return expires_at is not None and expires_at <= now
+
+# Method to empty every cart whose expiry time has passed, returns how many carts were emptied
+# A cart with an on_expire callback (a SessionManager's carts) is handed to it instead, so it can be saved first.
+    def expire(self, now=None):
+        now = time.monotonic() if now is None else now
+        due = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                expires_at, cart_id = heapq.heappop(self.heap)
+                # The heap keeps old entries of carts that were touched again, only the latest time counts
+                if self.expires.get(cart_id) == expires_at:
+                    due.append(self.carts[cart_id])
+        emptied = 0
+        for cart in due:
+            if cart.on_expire is not None:
+                emptied += bool(cart.on_expire(cart, now))
+                continue
+            with cart.lock:
+                if not self.is_expired(cart, now):
+                    continue
+                cart.release_all()
+                emptied += 1
+        return emptied
+
+# Method to start a background thread that expires abandoned carts every interval seconds
+    def start_reaper(self, interval=30):
+        if self.reaper is not None:
+            return
+        self.stop_event.clear()
+
+        def run():
+            while not self.stop_event.wait(interval):
+                self.expire()
+        self.reaper = threading.Thread(target=run, name="reservation-reaper", daemon=True)
+        self.reaper.start()
+
+# Method to stop the background expiry thread
+    def stop_reaper(self):
+        if self.reaper is not None:
+            self.stop_event.set()
+            self.reaper.join()
+            self.reaper = None
+
+
+# Reservations used by carts that aren't given their own
+inventory_reservations = InventoryReservations()
+
+
+
+# Result of ShoppingCart.apply_batch: applied maps product ID -> net quantity change, errors is a list of
+# (line number, product ID, message) and order is the Order when the batch also checked out
+BatchResult = namedtuple('BatchResult', ['ok', 'applied', 'errors', 'total_price', 'order'])
+
+
+
+# Pricing rules. A line rule without product_ids or category applies to every product, percents may have decimals (12.5).
+# PercentOff takes percent off the line, BuyXGetY makes `get` of every `buy + get` items percent (100 = free) cheaper,
+# QuantityTier takes the percent of the highest tier the line's quantity reaches off the line (tiers are (minimum, percent)),
+# and Coupon takes percent and/or a fixed amount off the whole cart once it reaches min_total.
+PercentOff = namedtuple('PercentOff', ['percent', 'product_ids', 'category'], defaults=((), None))
+BuyXGetY = namedtuple('BuyXGetY', ['buy', 'get', 'percent', 'product_ids', 'category'], defaults=(100, (), None))
+QuantityTier = namedtuple('QuantityTier', ['tiers', 'product_ids', 'category'], defaults=((), None))
+Coupon = namedtuple('Coupon', ['code', 'percent', 'amount', 'min_total'], defaults=(0, 0, 0))
+
+PRICING_RULE_TYPES = {'percent_off': PercentOff, 'buy_x_get_y': BuyXGetY, 'quantity_tier': QuantityTier, 'coupon': Coupon}
+
+
+# Function to turn a percent into whole basis points (hundredths of a percent), so discounts are worked out in integers
+def basis_points(percent):
+    points = int((Decimal(str(percent)) * 100).quantize(Decimal('1'), rounding=ROUND_HALF_UP))
+    if not 0 <= points <= 10000:
+        raise ValueError(f"A discount must be between 0 and 100 percent, not {percent}")
+    return points
+
+
+# PricingEngine class working out the discounts of cart lines and coupons
+# compile() turns the rules into one dict of product ID -> tuple of discount functions (every rule with its numbers
+# already worked out), so pricing a line only runs the rules of that product. The stores don't have categories, so
+# category rules are resolved through a {category: product IDs} mapping given to compile(). A line gets its single
+# best discount (line rules don't stack), coupons come off the total after that. Carts price only the line that
+# changed and price all their lines again when they see the engine's version has changed.
+class PricingEngine:
+    def __init__(self, rules=(), categories=None):
+        self.version = 0
+        self.compile(rules, categories)
+
+# Method to compile a list of rules, replacing the current ones
+    def compile(self, rules, categories=None):
+        categories = categories or {}
+        by_product = {}
+        everywhere = []
+        coupons = {}
+        for rule in rules:
+            if isinstance(rule, Coupon):
+                coupons[rule.code.strip().upper()] = (basis_points(rule.percent), to_cents(rule.amount), to_cents(rule.min_total))
+                continue
+            discount = self.compile_rule(rule)
+            if not rule.product_ids and rule.category is None:
+                everywhere.append(discount)
+                continue
+            product_ids = set(rule.product_ids)
+            if rule.category is not None:
+                product_ids.update(categories.get(rule.category, ()))
+            for product_id in product_ids:
+                by_product.setdefault(product_id, []).append(discount)
+        self.everywhere = tuple(everywhere)
+        self.by_product = {product_id: tuple(discounts) + self.everywhere for product_id, discounts in by_product.items()}
+        self.coupons = coupons
+        self.version += 1
+
+# Method to turn one line rule into a function of (unit price in cents, quantity) giving the discount in cents
+    @staticmethod
+    def compile_rule(rule):
+        if isinstance(rule, PercentOff):
+            points = basis_points(rule.percent)
+            return lambda unit_cents, quantity: (unit_cents * quantity * points + 5000) // 10000
+        if isinstance(rule, BuyXGetY):
+            if rule.buy < 1 or rule.get < 1:
+                raise ValueError("buy and get must both be at least 1")
+            group, get, points = rule.buy + rule.get, rule.get, basis_points(rule.percent)
+            return lambda unit_cents, quantity: (unit_cents * (quantity // group) * get * points + 5000) // 10000
+        if isinstance(rule, QuantityTier):
+            tiers = sorted(((minimum, basis_points(percent)) for minimum, percent in rule.tiers), reverse=True)
+
+            def tiered(unit_cents, quantity):
+                for minimum, points in tiers:
+                    if quantity >= minimum:
+                        return (unit_cents * quantity * points + 5000) // 10000
+                return 0
+            return tiered
+        raise TypeError(f"Unknown pricing rule {rule!r}")
+
+# Method to get the discount in cents of one cart line
+    def line_discount(self, product_id, unit_cents, quantity):
+        best = 0
+        for discount in self.by_product.get(product_id, self.everywhere):
+            amount = discount(unit_cents, quantity)
+            if amount > best:
+                best = amount
+        return min(best, unit_cents * quantity)
+
+# Method to get the total in cents of some OrderLines after their line discounts
+    def lines_total_cents(self, lines):
+        return sum(line.total_cents - self.line_discount(line.product_id, line.unit_cents, line.quantity) for line in lines)
+
+# Method to check if a coupon code exists
+    def has_coupon(self, code):
+        return code is not None and code.strip().upper() in self.coupons
+
+# Method to get a coupon's discount in cents on a cart total (0 for an unknown code or a total below its minimum)
+    def coupon_discount(self, code, total_cents):
+        coupon = self.coupons.get(code) if code is not None else None
+        if coupon is None:
+            return 0
+        points, amount_cents, min_total_cents = coupon
+        if total_cents < min_total_cents:
+            return 0
+        return min(total_cents, (total_cents * points + 5000) // 10000 + amount_cents)
+
+
+# Function to read pricing rules from a JSON file: {"categories": {name: [product IDs]}, "rules": [{"type": ..., ...}]}
+# where type is percent_off, buy_x_get_y, quantity_tier or coupon and the other keys are the rule's fields
+def load_pricing_rules(filename):
+    with open(filename) as file:
+        data = json.load(file)
+    rules = []
+    for fields in data.get('rules', []):
+        fields = dict(fields)
+        rule_type = PRICING_RULE_TYPES.get(fields.pop('type', None))
+        if rule_type is None:
+            raise ValueError(f"Unknown pricing rule type in {fields}")
+        if 'product_ids' in fields:
+            fields['product_ids'] = tuple(fields['product_ids'])
+        if 'tiers' in fields:
+            fields['tiers'] = tuple(tuple(tier) for tier in fields['tiers'])
+        rules.append(rule_type(**fields))
+    return rules, data.get('categories', {})
+
+
+# Pricing engine used by carts that aren't given their own
+pricing_engine = PricingEngine()
+
+
+# Function to replace the rules of the default pricing engine, carts price themselves again on their next change
+def configure_pricing(rules, categories=None):
+    pricing_engine.compile(rules, categories)
+
+
+
+# ShoppingCart class representing a shopping cart for a user
+# Lines are kept in a dict keyed by product ID as [product, quantity, unit price in cents], adding a product that is
+# already in the cart merges into its line, and the total is kept up to date in cents as lines change.
+# Stock is taken and given back through InventoryReservations, the cart's own lock keeps its lines consistent.
+# Discounts come from a PricingEngine: only the changed line is priced again (discounts keeps each line's discount)
+# and total_price is the total after line discounts and the cart's coupon.
+class ShoppingCart:
+    def __init__(self, user, reservations=None, pricing=None, store=None):
+        self.cart_id = id(self)
+        self.user = user
+        self.store = store
+        self.reservations = reservations if reservations is not None else inventory_reservations
+        self.pricing = pricing if pricing is not None else pricing_engine
+        self.lock = threading.RLock()
+        self.lines = {}
+        self.total_cents = 0
+        self.discounts = {}
+        self.discount_cents = 0
+        self.coupon = None
+        self.pricing_version = self.pricing.version
+        self.on_expire = None
+
+# The cart's contents as a list of (product, quantity) pairs
+    @property
+    def products(self):
+        return [(product, quantity) for product, quantity, unit_cents in self.lines.values()]
+
+    @property
+    def total_price(self):
+        line_discounts, coupon_discount = self.discount_breakdown()
+        return from_cents(self.total_cents - line_discounts - coupon_discount)
+
+# Method to get the cart's (line discounts, coupon discount) in cents
+    def discount_breakdown(self):
+        with self.lock:
+            if self.pricing_version != self.pricing.version:
+                self._reprice_all()
+            return self.discount_cents, self.pricing.coupon_discount(self.coupon, self.total_cents - self.discount_cents)
+
+# Method to use a coupon code on the cart, returns False if there's no such coupon
+    def apply_coupon(self, code):
+        if not self.pricing.has_coupon(code):
+            return False
+        self.coupon = code.strip().upper()
+        return True
+
+# Works out the discount of one line again after it changed
+    def _reprice(self, product_id):
+        if self.pricing_version != self.pricing.version:
+            self._reprice_all()
+            return
+        old = self.discounts.pop(product_id, 0)
+        line = self.lines.get(product_id)
+        new = self.pricing.line_discount(product_id, line[2], line[1]) if line is not None else 0
+        if new:
+            self.discounts[product_id] = new
+        self.discount_cents += new - old
+
+# Works out the discount of every line again (when the pricing rules changed)
+    def _reprice_all(self):
+        version = self.pricing.version
+        self.discounts = {}
+        for product_id, (product, quantity, unit_cents) in self.lines.items():
+            discount = self.pricing.line_discount(product_id, unit_cents, quantity)
+            if discount:
+                self.discounts[product_id] = discount
+        self.discount_cents = sum(self.discounts.values())
+        self.pricing_version = version
+
+# Method to get how many of a product are in the cart
+    def quantity_of(self, product_id):
+        line = self.lines.get(product_id)
+        return line[1] if line else 0
+
+# Method to add a product to the cart, returns True if the stock could be reserved
+    def add_product(self, product, quantity=1):
+        if quantity <= 0:
+            print(Fore.RED + "Quantity must be at least 1" + Style.RESET_ALL)
+            return False
+        with self.lock:
+            if not self.reservations.reserve(self, product, quantity):
+                print(Fore.RED + "Insufficient stock available" + Style.RESET_ALL)
+                return False
+            self._add_line(product, quantity)
+            self.reservations.touch(self)
+            return True
+
+    def _add_line(self, product, quantity):
+        unit_cents = to_cents(product.price)
+        line = self.lines.get(product.product_id)
+        if line is None:
+            self.lines[product.product_id] = [product, quantity, unit_cents]
+            self.total_cents += unit_cents * quantity
+        else:
+            # The whole line is priced at the product's current price
+            self.total_cents -= line[1] * line[2]
+            line[1] += quantity
+            line[2] = unit_cents
+            self.total_cents += line[1] * unit_cents
+        self._reprice(product.product_id)
+
+# Method to remove a product from the cart, returns False (and removes nothing) if it can't
+    def remove_product(self, product_id, quantity=None):
+        if quantity is not None and quantity <= 0:
+            print(Fore.RED + "Quantity must be at least 1" + Style.RESET_ALL)
+            return False
+        with self.lock:
+            line = self.lines.get(product_id)
+            if line is None:
+                print(Fore.RED + "Product not found in cart" + Style.RESET_ALL)
+                return False
+            product, qty = line[0], line[1]
+            removed = self._remove_line(product_id, quantity)
+            self.reservations.release(self, product, removed)
+            self.reservations.touch(self)
+            if quantity and quantity > qty:
+                print(Fore.YELLOW + f"You tried to remove {quantity}, but only {qty} were in the cart. All items removed." + Style.RESET_ALL)
+            return True
+
+# Takes up to quantity (or everything when it's None) off a line, returns how many were taken off
+    def _remove_line(self, product_id, quantity=None):
+        line = self.lines[product_id]
+        product, qty, unit_cents = line
+        if quantity is None or quantity >= qty:
+            del self.lines[product_id]
+            quantity = qty
+        else:
+            line[1] = qty - quantity
+        self.total_cents -= unit_cents * quantity
+        self._reprice(product_id)
+        return quantity
+
+# Method to apply many (product ID, quantity) changes in one call, a positive quantity adds to the cart and a negative one removes
+# Everything is checked first (products exist, enough in the cart to remove, enough stock to add) and the changes are
+# applied all together or not at all. With checkout=True the cart is checked out straight after. Returns a BatchResult.
+    def apply_batch(self, store, changes, checkout=False, order_store=None):
+        with self.lock:
+            errors = []
+            net = {}
+            products = {}
+            for line_number, (product_id, quantity) in enumerate(changes, 1):
+                if not isinstance(quantity, int) or isinstance(quantity, bool) or quantity == 0:
+                    errors.append((line_number, product_id, "Quantity must be a non-zero whole number"))
+                    continue
+                product = store.get_product(product_id)
+                if product is None and product_id in self.lines:
+                    product = self.lines[product_id][0]
+                if product is None:
+                    errors.append((line_number, product_id, "Product not found"))
+                    continue
+                products[product_id] = product
+                net[product_id] = net.get(product_id, 0) + quantity
+            for product_id, quantity in net.items():
+                if quantity < 0 and -quantity > self.quantity_of(product_id):
+                    errors.append((None, product_id, f"Cannot remove {-quantity}, only {self.quantity_of(product_id)} in the cart"))
+            if not errors:
+                shortages = self.reservations.reserve_many(self, [(products[product_id], quantity) for product_id, quantity in net.items() if quantity])
+                for product_id, available in shortages.items():
+                    errors.append((None, product_id, f"Insufficient stock: requested {net[product_id]}, available {available}"))
+            if errors:
+                return BatchResult(False, {}, errors, self.total_price, None)
+            for product_id, quantity in net.items():
+                if quantity > 0:
+                    self._add_line(products[product_id], quantity)
+                elif quantity < 0:
+                    self._remove_line(product_id, -quantity)
+            self.reservations.touch(self)
+            applied = {product_id: quantity for product_id, quantity in net.items() if quantity}
+            total_price = self.total_price
+            order = self.checkout(order_store) if checkout and self.lines else None
+            return BatchResult(True, applied, [], total_price, order)
+
+# Method to empty the cart and give all of its stock back (used when an abandoned cart expires)
+    def release_all(self):
+        with self.lock:
+            lines, self.lines = self.lines, {}
+            self.total_cents = 0
+            self._reprice_all()
+            for product, quantity, unit_cents in lines.values():
+                self.reservations.release(self, product, quantity)
+            self.reservations.touch(self)
+
+# Method to view the cart contents
+    def view_cart(self):
+        output = [f"{product.display_product_info()}, Quantity you've added: {quantity}\n" for product, quantity in self.products]
+        line_discounts, coupon_discount = self.discount_breakdown()
+        if line_discounts:
+            output.append(f"{Fore.GREEN}Discounts: -{from_cents(line_discounts)}{Style.RESET_ALL}\n")
+        if coupon_discount:
+            output.append(f"{Fore.GREEN}Coupon {self.coupon}: -{from_cents(coupon_discount)}{Style.RESET_ALL}\n")
+        output.append(f"{Fore.YELLOW}Total price: {self.total_price}{Style.RESET_ALL}\n")
+        write_output("".join(output))
+
+# Method to checkout the cart and create an order, with an order store the order is saved there instead of kept in memory
+    def checkout(self, order_store=None):
+        with self.lock:
+            lines = tuple(OrderLine(product.product_id, product.name, unit_cents, quantity) for product, quantity, unit_cents in self.lines.values())
+            order = Order(self.user, lines, self.total_price, datetime.datetime.now())
+            if order_store is not None:
+                order_store.add_order(order)
+            else:
+                self.user.shopping_history.append(order)
+            self.reservations.sell(self, [(product, quantity) for product, quantity, unit_cents in self.lines.values()])
+            self.lines = {}
+            self.total_cents = 0
+            self.coupon = None
+            self._reprice_all()
+            self.reservations.commit(self)
+        return order
+
+
+
+# OrderLine class, an immutable snapshot of one line of an order taken at checkout
+# Orders keep these instead of the live products, so later changes to a product don't change old orders.
+class OrderLine(namedtuple('OrderLine', ['product_id', 'name', 'unit_cents', 'quantity'])):
+    __slots__ = ()
+
+    @property
+    def unit_price(self):
+        return from_cents(self.unit_cents)
+
+    @property
+    def total_cents(self):
+        return self.unit_cents * self.quantity
+
+
+
+# Order class representing an order made by a user, lines is a tuple of OrderLine
+# Orders saved in an OrderStore get their ID from it, other orders are numbered by a counter in this process.
+class Order:
+    __slots__ = ('order_id', 'user', 'lines', 'total_price', 'date')
+    next_ids = itertools.count(1)
+
+    def __init__(self, user, lines, total_price, date, order_id=None):
+        self.order_id = order_id if order_id is not None else next(Order.next_ids)
+        self.user = user
+        self.lines = tuple(lines)
+        self.total_price = total_price
+        self.date = date
+
+# Method to view order details
+    def view_order_details(self):
+        details = [f"{Fore.MAGENTA}Order ID: {self.order_id}, Date: {self.date}{Style.RESET_ALL}\n"]
+        for line in self.lines:
+            details.append(f"{Fore.CYAN}Product ID: {line.product_id}, Name: {line.name}, Price: {line.unit_price}{Style.RESET_ALL}, Quantity you've purchased: {line.quantity}\n")
+        discount = from_cents(sum(line.total_cents for line in self.lines)) - self.total_price
+        if discount > 0:
+            details.append(f"{Fore.GREEN}Discounts: -{discount}{Style.RESET_ALL}\n")
+        details.append(f"{Fore.YELLOW}Total price: {self.total_price}{Style.RESET_ALL}")
+        return "".join(details)
+
+
+
+# BackgroundWriter class doing a store's writes on its own thread, so callers never wait for the disk
+# Writes are queued under a key and a newer write of a key replaces the queued one (writes queued with key None never
+# do). write_batch(values) is called with everything queued once flush_interval seconds have passed since the oldest
+# queued write or max_pending writes are queued, so a crash loses at most about flush_interval seconds of writes.
+# barrier() waits until everything queued so far is written and flush() writes it now. A batch that fails is queued
+# again and retried, barrier() raises its error. close() (also run at exit) writes what is left and stops the thread.
+class BackgroundWriter:
+    def __init__(self, write_batch, name, flush_interval=0.05, max_pending=1000):
+        self.write_batch = write_batch
+        self.name = name
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.condition = threading.Condition()
+        self.pending = {}
+        self.unkeyed = itertools.count()
+        self.first_queued_at = 0
+        self.queued_seq = 0
+        self.written_seq = 0
+        self.flush_requested = False
+        self.error = None
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name=f"{name}-writer", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+# Method to queue a write
+    def submit(self, key, value):
+        with self.condition:
+            if self.closed:
+                raise RuntimeError(f"The {self.name} writer is closed")
+            if not self.pending:
+                self.first_queued_at = time.monotonic()
+                self.condition.notify_all()
+            self.pending[(None, next(self.unkeyed)) if key is None else key] = value
+            self.queued_seq += 1
+            if len(self.pending) == self.max_pending:
+                self.condition.notify_all()
+
+# Method to wait until everything queued so far is written
+    def barrier(self):
+        with self.condition:
+            seq = self.queued_seq
+            while self.written_seq < seq:
+                if self.error is not None:
+                    raise self.error
+                if not self.thread.is_alive():
+                    raise RuntimeError(f"The {self.name} writer is closed")
+                self.condition.wait()
+
+# Method to write everything queued so far now and wait for it
+    def flush(self):
+        with self.condition:
+            if self.pending:
+                self.flush_requested = True
+                self.condition.notify_all()
+        self.barrier()
+
+# The writer thread: waits for the first write, gives more writes until the interval is up (or enough are queued)
+# to pile up, then writes them all in one batch
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                deadline = self.first_queued_at + self.flush_interval
+                while not self.closed and not self.flush_requested and len(self.pending) < self.max_pending:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                batch, self.pending = self.pending, {}
+                seq = self.queued_seq
+                self.flush_requested = False
+            try:
+                self.write_batch(list(batch.values()))
+            except Exception as error:
+                print(Fore.RED + f"Writing to the {self.name} store failed: {error}" + Style.RESET_ALL)
+                with self.condition:
+                    # The failed writes go back in front of the ones queued since, newer values of a key still win
+                    self.pending = {**batch, **self.pending}
+                    self.first_queued_at = time.monotonic()
+                    self.error = error
+                    self.condition.notify_all()
+                    if self.closed:
+                        return
+                continue
+            with self.condition:
+                self.written_seq = seq
+                self.error = None
+                self.condition.notify_all()
+
+# Method to write what is left and stop the thread, later writes raise RuntimeError
+    def close(self):
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+        atexit.unregister(self.close)
+
+
+
+# OrderStore class saving orders in a local SQLite database so the shopping history survives restarts
+# Orders are inserted by a BackgroundWriter, so placing an order doesn't wait for the database. Reading flushes queued
+# orders first. Order IDs are handed out before the order is written, so they are reserved ID_BLOCK at a time: the
+# highest reserved ID is saved (and synced) before any ID of the block is used, and after a restart IDs carry on past
+# it, so an ID given to an order lost in a crash is never given to another one (AUTOINCREMENT never reuses one either).
+# SQLite keeps indexes by user and by date, reading goes a page at a time using the last seen key, so no query has to
+# skip over rows it already returned. An order placed by a sharded checkout keeps the checkout's txn_id, so the shards
+# can find out later whether that checkout went through.
+class OrderStore:
+    ID_BLOCK = 1000
+
+    def __init__(self, filename, flush_interval=0.05, max_pending=1000):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS orders ("
+                "order_id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, "
+                "date TEXT NOT NULL, total_cents INTEGER NOT NULL, lines TEXT NOT NULL, txn_id TEXT)"
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS orders_by_user ON orders (user_id, order_id)")
+            self.connection.execute("CREATE UNIQUE INDEX IF NOT EXISTS orders_by_txn ON orders (txn_id) WHERE txn_id IS NOT NULL")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS orders_by_date ON orders (date, order_id)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS order_ids (reserved INTEGER NOT NULL)")
+            last_id = self.connection.execute(
+                "SELECT MAX(seq) FROM (SELECT seq FROM sqlite_sequence WHERE name = 'orders' UNION ALL SELECT MAX(order_id) FROM orders "
+                "UNION ALL SELECT MAX(reserved) FROM order_ids)"
+            ).fetchone()[0]
+        self.id_lock = threading.Lock()
+        self.next_id = (last_id or 0) + 1
+        self.reserved_id = last_id or 0
+        self.writer = BackgroundWriter(self.write_orders, 'orders', flush_interval, max_pending)
+
+# Method to hand out the next order ID, reserving (and syncing) a new block of IDs when the current one is used up
+    def allocate_order_id(self):
+        with self.id_lock:
+            if self.next_id > self.reserved_id:
+                reserved = self.next_id + self.ID_BLOCK - 1
+                with self.lock:
+                    self.connection.execute("PRAGMA synchronous=FULL")
+                    with self.connection:
+                        self.connection.execute("DELETE FROM order_ids")
+                        self.connection.execute("INSERT INTO order_ids (reserved) VALUES (?)", (reserved,))
+                    self.connection.execute("PRAGMA synchronous=NORMAL")
+                self.reserved_id = reserved
+            order_id = self.next_id
+            self.next_id += 1
+            return order_id
+
+# Method to save an order, the order gets its ID right away and is written in the background
+    def add_order(self, order, txn_id=None):
+        order.order_id = self.allocate_order_id()
+        lines = [list(line) for line in order.lines]
+        self.writer.submit(order.order_id, (order.order_id, order.user.user_id, order.date.isoformat(), to_cents(order.total_price), json.dumps(lines), txn_id))
+        return order
+
+# Method to get the ID of the order placed by a sharded checkout, None if that checkout placed no order
+    def order_id_for_txn(self, txn_id):
+        self.writer.flush()
+        with self.lock:
+            row = self.connection.execute("SELECT order_id FROM orders WHERE txn_id = ?", (txn_id,)).fetchone()
+        return row[0] if row is not None else None
+
+# Method called by the writer thread to insert a batch of orders in one transaction
+    def write_orders(self, rows):
+        with self.lock, self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO orders (order_id, user_id, date, total_cents, lines, txn_id) VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+# Method to wait until every order added so far is in the database
+    def flush(self):
+        self.writer.flush()
+
+    def _build_order(self, row, user_for):
+        order_id, user_id, date, total_cents, lines = row
+        # Lines are [product_id, name, unit_cents, quantity]
+        lines = [OrderLine(*line) for line in json.loads(lines)]
+        return Order(user_for(user_id), lines, from_cents(total_cents), datetime.datetime.fromisoformat(date), order_id)
+
+    def _pages(self, query, params, key, user_for, page_size):
+        self.writer.flush()
+        last = None
+        while True:
+            with self.lock:
+                rows = self.connection.execute(query(last), params + (last or ()) + (page_size,)).fetchall()
+            if not rows:
+                return
+            yield [self._build_order(row, user_for) for row in rows]
+            if len(rows) < page_size:
+                return
+            last = key(rows[-1])
+
+# Method to get a user's orders, oldest first, as pages (lists) of at most page_size orders read one page at a time
+    def orders_for_user(self, user, page_size=20):
+        def query(last):
+            after = " AND order_id > ?" if last else ""
+            return f"SELECT order_id, user_id, date, total_cents, lines FROM orders WHERE user_id = ?{after} ORDER BY order_id LIMIT ?"
+        return self._pages(query, (user.user_id,), lambda row: (row[0],), lambda user_id: user, page_size)
+
+# Method to get all orders placed from start up to (not including) end, as pages, the user of each order is looked up with
+# get_user (for example UserDatabase.get_user)
+    def orders_between(self, start, end, get_user=None, page_size=100):
+        def query(last):
+            after = " AND (date, order_id) > (?, ?)" if last else ""
+            return f"SELECT order_id, user_id, date, total_cents, lines FROM orders WHERE date >= ? AND date < ?{after} ORDER BY date, order_id LIMIT ?"
+        return self._pages(query, (start.isoformat(), end.isoformat()), lambda row: (row[2], row[0]), get_user or (lambda user_id: None), page_size)
+
+# Method to count the orders of a user
+    def count_for_user(self, user):
+        self.writer.flush()
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM orders WHERE user_id = ?", (user.user_id,)).fetchone()[0]
+
+# Method to write the queued orders and close the database
+    def close(self):
+        self.writer.close()
+        with self.lock:
+            self.connection.close()
+
+
+
+# ProductCatalog class keeping the store's products in hash indexes
+# Products are kept in an insertion ordered dict keyed by ID, so lookups and removals are O(1) and iteration still follows the order they were added in.
+# The name index maps a lower case name to the IDs of the products carrying it, exact name lookups check the few products it finds.
+class ProductCatalog:
+    def __init__(self, products=None):
+        self.by_id = {}
+        self.by_name = {}
+        self.max_id = 0
+        for product in products or []:
+            self.add(product)
+
+# Method to add a product, replacing any product that already has the same ID, returns the product as the catalog keeps it
+    def add(self, product):
+        if product.product_id in self.by_id:
+            self.remove(product.product_id)
+        self.by_id[product.product_id] = product
+        self._index_name(product.product_id, product.name)
+        if isinstance(product.product_id, int) and product.product_id > self.max_id:
+            self.max_id = product.product_id
+        return product
+
+# Method to remove a product by ID, returns the removed product or None
+    def remove(self, product_id):
+        product = self.by_id.pop(product_id, None)
+        if product is not None:
+            self._unindex_name(product_id, product.name)
+        return product
+
+# Method to get a product by ID
+    def get(self, product_id):
+        return self.by_id.get(product_id)
+
+# Method to find all products with a given name
+    def find_by_name(self, name, ignore_case=False):
+        ids = self.by_name.get(name.lower())
+        if ids is None:
+            return []
+        if not isinstance(ids, dict):
+            ids = (ids,)
+        products = [self.get(product_id) for product_id in ids]
+        if ignore_case:
+            return products
+        return [product for product in products if product.name == name]
+
+# Method to move a product to its new name in the name index after it was renamed
+    def reindex(self, product, old_name):
+        if old_name != product.name and product.product_id in self:
+            self._unindex_name(product.product_id, old_name)
+            self._index_name(product.product_id, product.name)
+
+# Method to get the next unused product ID
+    def next_id(self):
+        return self.max_id + 1
+
+# A name used by one product maps straight to its ID, a dict of IDs is only made once a second product shares the name
+    def _index_name(self, product_id, name):
+        key = name.lower()
+        ids = self.by_name.get(key)
+        if ids is None:
+            # An already lower case name shares its string with the product
+            self.by_name[name if key == name else key] = product_id
+        elif isinstance(ids, dict):
+            ids[product_id] = None
+        elif ids != product_id:
+            self.by_name[key] = {ids: None, product_id: None}
+
+    def _unindex_name(self, product_id, name):
+        key = name.lower()
+        ids = self.by_name.get(key)
+        if isinstance(ids, dict):
+            ids.pop(product_id, None)
+            if len(ids) == 1:
+                self.by_name[key] = next(iter(ids))
+        elif ids == product_id:
+            del self.by_name[key]
+
+    def __iter__(self):
+        return iter(self.by_id.values())
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def __contains__(self, product):
+        if isinstance(product, Product):
+            return product.product_id in self.by_id
+        return product in self.by_id
+
+
+
+# Function making a ProductView property that reads and writes one column of a ColumnarCatalog
+def column_property(column, attribute, intern_strings=False):
+    def get(self):
+        row = self.catalog.row_of.get(self.product_id)
+        if row is None:
+            return getattr(self.catalog.retired[self.product_id], attribute)
+        return getattr(self.catalog, column)[row]
+
+    def set(self, value):
+        row = self.catalog.row_of.get(self.product_id)
+        if row is None:
+            setattr(self.catalog.retired[self.product_id], attribute, value)
+            return
+        getattr(self.catalog, column)[row] = sys.intern(value) if intern_strings else value
+    return property(get, set)
+
+
+
+# ProductView class, a Product whose information lives in the columns of a ColumnarCatalog
+# All the Product methods work on it, reading and changing the catalog's columns directly.
+class ProductView(Product):
+    __slots__ = ('catalog',)
+
+    def __init__(self, catalog, product_id):
+        self.catalog = catalog
+        self.product_id = product_id
+
+    name = column_property('names', 'name')
+    price = column_property('prices', 'price')
+    description = column_property('descriptions', 'description', intern_strings=True)
+    quantity = column_property('quantities', 'quantity')
+
+
+
+# ColumnarCatalog class, a compact catalog for stores with millions of products
+# Instead of one object per product, IDs, prices and quantities are kept in typed arrays and names and descriptions in
+# lists, one row per product. Descriptions are interned since many products share one (names are mostly unique, so
+# interning them would only grow the interning table). Lookups hand out small ProductView
+# objects over a row. Removing moves the last row into the gap, so it stays O(1) but changes the iteration order.
+# A removed product's information is kept in retired so views still held elsewhere (e.g. in carts) keep working.
+class ColumnarCatalog(ProductCatalog):
+    def __init__(self, products=None):
+        self.ids = array('q')
+        self.prices = array('d')
+        self.quantities = array('q')
+        self.names = []
+        self.descriptions = []
+        self.row_of = {}
+        self.retired = {}
+        super().__init__(products)
+
+# Method to add a product (its ID has to be a whole number), returns a ProductView of it
+    def add(self, product):
+        product_id = product.product_id
+        name, description = product.name, sys.intern(product.description)
+        row = self.row_of.get(product_id)
+        if row is None:
+            self.row_of[product_id] = len(self.ids)
+            self.ids.append(product_id)
+            self.prices.append(product.price)
+            self.quantities.append(product.quantity)
+            self.names.append(name)
+            self.descriptions.append(description)
+        else:
+            self._unindex_name(product_id, self.names[row])
+            self.prices[row] = product.price
+            self.quantities[row] = product.quantity
+            self.names[row] = name
+            self.descriptions[row] = description
+        self.retired.pop(product_id, None)
+        self._index_name(product_id, name)
+        if product_id > self.max_id:
+            self.max_id = product_id
+        return ProductView(self, product_id)
+
+# Method to remove a product by ID, returns a plain Product with its information or None
+    def remove(self, product_id):
+        row = self.row_of.pop(product_id, None)
+        if row is None:
+            return None
+        product = Product(product_id, self.names[row], self.prices[row], self.descriptions[row], self.quantities[row])
+        self._unindex_name(product_id, product.name)
+        last = len(self.ids) - 1
+        if row != last:
+            for column in (self.ids, self.prices, self.quantities, self.names, self.descriptions):
+                column[row] = column[last]
+            self.row_of[self.ids[row]] = row
+        for column in (self.ids, self.prices, self.quantities, self.names, self.descriptions):
+            column.pop()
+        self.retired[product_id] = product
+        return product
+
+# Method to get a product by ID
+    def get(self, product_id):
+        if product_id in self.row_of:
+            return ProductView(self, product_id)
+        return None
+
+    def __iter__(self):
+        for product_id in self.ids:
+            yield ProductView(self, product_id)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, product):
+        if isinstance(product, Product):
+            return product.product_id in self.row_of
+        return product in self.row_of
+
+
+
+# Pattern used to split product names, descriptions and search queries into words
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+# Function to split text into lower case search tokens
+def tokenize(text):
+    return TOKEN_PATTERN.findall(str(text).lower())
+
+
+
+# SearchIndex class providing full-text and prefix search over the products of a store
+# It keeps an inverted index (token -> {product ID: weight}) and a sorted list of all tokens for prefix lookups with bisect.
+# The Store calls product_added/product_removed/product_updated, so only the words of the changed product are re-indexed.
+# Matching products are fetched from the store's catalog, the index itself only keeps product IDs.
+# Products added in bulk (products_added, e.g. when a snapshot is loaded at startup) are only indexed at the first search.
+class SearchIndex:
+    NAME_WEIGHT = 3
+    DESCRIPTION_WEIGHT = 1
+    PREFIX_FACTOR = 0.5
+    MAX_EXPANSIONS = 64
+
+    def __init__(self, catalog):
+        self.catalog = catalog
+        self.postings = {}
+        self.product_tokens = {}
+        self.tokens = []
+        self.pending = []
+        self.lock = threading.Lock()
+
+# Method to work out the weight of each token in a product's name and description
+    def _weigh(self, product):
+        weights = {}
+        for token in tokenize(product.description):
+            weights[token] = weights.get(token, 0) + self.DESCRIPTION_WEIGHT
+        for token in tokenize(product.name):
+            weights[token] = weights.get(token, 0) + self.NAME_WEIGHT
+        return weights
+
+    def _add_posting(self, token, product_id, weight):
+        postings = self.postings.get(token)
+        if postings is None:
+            postings = self.postings[token] = {}
+            insort(self.tokens, token)
+        postings[product_id] = weight
+
+    def _remove_posting(self, token, product_id):
+        postings = self.postings.get(token)
+        if postings is None:
+            return
+        postings.pop(product_id, None)
+        if not postings:
+            del self.postings[token]
+            i = bisect_left(self.tokens, token)
+            if i < len(self.tokens) and self.tokens[i] == token:
+                del self.tokens[i]
+
+# Method to index a new product
+    def product_added(self, product):
+        if product.product_id in self.product_tokens:
+            self.product_removed(product)
+        weights = self._weigh(product)
+        for token, weight in weights.items():
+            self._add_posting(token, product.product_id, weight)
+        self.product_tokens[product.product_id] = weights
+
+# Method to take many new products at once, they're indexed when the index is next used
+    def products_added(self, products):
+        self.pending.extend(product.product_id for product in products)
+
+# Method to index the products added in bulk, all postings first and the sorted token list once at the end
+    def catch_up(self):
+        if not self.pending:
+            return
+        with self.lock:
+            product_ids, self.pending = self.pending, []
+            for product_id in product_ids:
+                product = self.catalog.get(product_id)
+                if product is None:
+                    continue
+                if product_id in self.product_tokens:
+                    self.product_removed(product)
+                weights = self._weigh(product)
+                for token, weight in weights.items():
+                    postings = self.postings.get(token)
+                    if postings is None:
+                        postings = self.postings[token] = {}
+                    postings[product_id] = weight
+                self.product_tokens[product_id] = weights
+            self.tokens = sorted(self.postings)
+
+# Method to drop a product from the index
+    def product_removed(self, product):
+        weights = self.product_tokens.pop(product.product_id, None)
+        for token in weights or ():
+            self._remove_posting(token, product.product_id)
+
+# Method to re-index a product after its name or description changed, only touching the tokens that differ
+    def product_updated(self, product, old_name=None, old_description=None):
+        old_weights = self.product_tokens.get(product.product_id)
+        if old_weights is None:
+            return
+        new_weights = self._weigh(product)
+        if new_weights == old_weights:
+            return
+        for token in old_weights:
+            if token not in new_weights:
+                self._remove_posting(token, product.product_id)
+        for token, weight in new_weights.items():
+            if old_weights.get(token) != weight:
+                self._add_posting(token, product.product_id, weight)
+        self.product_tokens[product.product_id] = new_weights
+
+# Method to get the indexed tokens starting with a prefix (in alphabetical order)
+    def expand_prefix(self, prefix, limit=None):
+        matches = []
+        i = bisect_left(self.tokens, prefix)
+        while i < len(self.tokens) and self.tokens[i].startswith(prefix):
+            matches.append(self.tokens[i])
+            if limit is not None and len(matches) >= limit:
+                break
+            i += 1
+        return matches
+
+# Method to search the index, every query word may be a whole word or the start of one
+# Products have to match all query words, whole word matches score higher than prefix matches and rarer words count for more.
+    def search(self, query, limit=10):
+        return [product for score, product in self.search_scored(query, limit)]
+
+# Method to search and keep the scores, returns (score, product) pairs best first (used to merge results of several indexes)
+    def search_scored(self, query, limit=10):
+        self.catch_up()
+        terms = tokenize(query)
+        if not terms:
+            return []
+        total = len(self.product_tokens) or 1
+        scores = None
+        for term in terms:
+            term_scores = {}
+            for token in self.expand_prefix(term, self.MAX_EXPANSIONS):
+                postings = self.postings[token]
+                factor = 1.0 if token == term else self.PREFIX_FACTOR
+                idf = math.log(1 + total / len(postings))
+                for product_id, weight in postings.items():
+                    score = weight * idf * factor
+                    if score > term_scores.get(product_id, 0):
+                        term_scores[product_id] = score
+            if scores is None:
+                scores = term_scores
+            else:
+                scores = {product_id: score + term_scores[product_id] for product_id, score in scores.items() if product_id in term_scores}
+            if not scores:
+                return []
+        best = heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+        products = [self.catalog.get(product_id) for product_id, score in best]
+        return [(scores[product.product_id], product) for product in sorted(products, key=lambda product: (-scores[product.product_id], product.name))]
+
+# Method to suggest words for autocomplete, the words found in the most products come first
+    def autocomplete(self, prefix, limit=10):
+        self.catch_up()
+        prefix = prefix.strip().lower()
+        if not prefix:
+            return []
+        candidates = self.expand_prefix(prefix, self.MAX_EXPANSIONS * 16)
+        return heapq.nsmallest(limit, candidates, key=lambda token: (-len(self.postings[token]), token))
+
+
+
+# Function to write text to the terminal with a single write call
+def write_output(text):
+    sys.stdout.write(text)
+    sys.stdout.flush()
+
+
+
+# ProductRenderer class turning pages of products into text for the terminal
+# Formatted product lines are cached by product ID together with the information they were made from, so a line is
+# only formatted again once that product changes. A page is built in one list and joined into one string.
+class ProductRenderer:
+    SORT_KEYS = ('product_id', 'name', 'price', 'quantity')
+
+    def __init__(self, max_cached=100000):
+        self.max_cached = max_cached
+        self.lines = OrderedDict()
+
+# Method to get a product's display line, from the cache when the product hasn't changed
+    def render_product(self, product):
+        state = (product.name, product.price, product.description, product.quantity)
+        cached = self.lines.get(product.product_id)
+        if cached is not None and cached[0] == state:
+            return cached[1]
+        line = product.display_product_info()
+        self.lines[product.product_id] = (state, line)
+        if len(self.lines) > self.max_cached:
+            self.lines.popitem(last=False)
+        return line
+
+# Method to get one page of products, sorted by one of SORT_KEYS or in catalog order when sort_key is None
+# Only offset + page_size products are kept while sorting, not the whole catalog
+    def page(self, products, page_size=20, offset=0, sort_key=None, reverse=False):
+        if sort_key is None:
+            return list(itertools.islice(products, offset, offset + page_size))
+        if sort_key not in self.SORT_KEYS:
+            raise ValueError(f"Can't sort products by {sort_key}")
+        pick = heapq.nlargest if reverse else heapq.nsmallest
+        return pick(offset + page_size, products, key=attrgetter(sort_key))[offset:]
+
+# Method to render a page of a store's products as one string, with a page header when there's more than one page
+    def render_page(self, store, page_size=20, offset=0, sort_key=None, reverse=False):
+        total = len(store.products)
+        output = []
+        if total > page_size:
+            output.append(f"{Fore.BLUE}Page {offset // page_size + 1} of {(total + page_size - 1) // page_size} ({total} products){Style.RESET_ALL}\n")
+        for product in self.page(store.products, page_size, offset, sort_key, reverse):
+            output.append(self.render_product(product))
+            output.append("\n")
+        return "".join(output)
+
+# Listener methods, a removed product's line is dropped, changed products are noticed when they're rendered
+    def product_added(self, product):
+        pass
+
+    def product_removed(self, product):
+        self.lines.pop(product.product_id, None)
+
+    def product_updated(self, product, old_name=None, old_description=None):
+        pass
+
+
+
+# InventoryJournal class, a write-ahead log making the store's products and stock survive restarts
+# Every stock change and every product added, removed or updated is appended to the log as one JSON line. A writer thread
+# writes whatever piled up and fsyncs it once (group commit), so an event is on disk within about commit_delay seconds
+# and barrier() waits until everything so far is. Stock changes of a product that pile up between other events are
+# merged into one event with their total.
+# Stock held in carts isn't journaled: hold() only counts it, so snapshots and product events write the stock on the
+# shelf, and sell() journals it once the cart checks out. After a crash the stock that was in carts is on the shelf again.
+# Each store has its own journal (open() makes it the store's journal).
+# A sharded checkout's prepare is journaled with the stock it takes out of the cart, so a shard that crashes while the
+# checkout is undecided still has that stock taken after a restart, and knows it has the checkout (journal.prepared)
+# to settle. Aborting puts the stock back, back on the shelf after a restart since carts aren't journaled.
+# Every snapshot_every events the whole catalog is written to a snapshot and the log starts a new segment, the old
+# segments are deleted, so opening the journal only reads the latest snapshot plus the events after it.
+class InventoryJournal:
+    SNAPSHOT_FILE = 'snapshot.pickle'
+
+    def __init__(self, directory, store, commit_delay=0.002, snapshot_every=100000):
+        self.directory = directory
+        self.store = store
+        self.commit_delay = commit_delay
+        self.snapshot_every = snapshot_every
+        self.lock = threading.Lock()
+        self.io_lock = threading.Lock()
+        self.durable = threading.Condition(threading.Lock())
+        self.pending = []
+        self.deltas = {}
+        self.held = {}
+        self.prepared = {}
+        self.seq = 0
+        self.durable_seq = 0
+        self.since_snapshot = 0
+        self.file = None
+        self.writer = None
+        self.error = None
+        self.closed = False
+        os.makedirs(directory, exist_ok=True)
+
+# Method to rebuild the store from the snapshot and the log, then start journaling, returns how many events were replayed
+# Call it before anything else changes the store, a store that had nothing journaled yet is left as it is.
+    def open(self):
+        snapshot_seq = self.load_snapshot()
+        self.seq = snapshot_seq
+        replayed = 0
+        for name in self.segments():
+            replayed += self.replay_segment(os.path.join(self.directory, name), snapshot_seq)
+        self.durable_seq = self.seq
+        self.since_snapshot = replayed
+        self.file = open(os.path.join(self.directory, f"{self.seq + 1:020d}.log"), 'a')
+        self.store.listeners.append(self)
+        self.store.journal = self
+        self.writer = threading.Thread(target=self.run_writer, name="inventory-journal", daemon=True)
+        self.writer.start()
+        return replayed
+
+# Method to check if anything was ever journaled (so setup code knows whether to add its default products)
+    def is_empty(self):
+        return self.seq == 0
+
+# Method to list the log segments, oldest first (a segment is named after the first event it can hold)
+    def segments(self):
+        return sorted(name for name in os.listdir(self.directory) if name.endswith('.log'))
+
+# Method to load the latest snapshot into the store, returns the last event it includes
+# Snapshots are pickles (protocol 5) of the product rows
+    def load_snapshot(self):
+        filename = os.path.join(self.directory, self.SNAPSHOT_FILE)
+        if not os.path.exists(filename):
+            return 0
+        with open(filename, 'rb') as file:
+            snapshot = pickle.load(file)
+        self.prepared = snapshot['prepared']
+        self.store.add_products(Product(product_id, name, price, description, quantity) for product_id, name, price, description, quantity in snapshot['rows'])
+        return snapshot['seq']
+
+# Method to apply the events of one segment that came after the snapshot, returns how many were applied
+# A crash can leave half a line at the end of the log, the segment is cut back to the last whole event.
+    def replay_segment(self, filename, snapshot_seq):
+        applied = 0
+        good_size = 0
+        with open(filename, 'rb') as file:
+            for line in file:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    break
+                if not line.endswith(b'\n'):
+                    break
+                good_size += len(line)
+                self.seq = max(self.seq, event['seq'])
+                if event['seq'] > snapshot_seq:
+                    self.apply(event)
+                    applied += 1
+        if good_size < os.path.getsize(filename):
+            print(Fore.YELLOW + f"Ignoring an incomplete event at the end of {filename}" + Style.RESET_ALL)
+            with open(filename, 'r+b') as file:
+                file.truncate(good_size)
+        return applied
+
+# Method to apply one event to the store
+    def apply(self, event):
+        op = event['op']
+        if op == 'qty':
+            product = self.store.get_product(event['id'])
+            if product is not None:
+                product.quantity += event['delta']
+        elif op == 'add':
+            product_id, name, price, description, quantity = event['product']
+            self.store.add_product(Product(product_id, name, price, description, quantity))
+        elif op == 'remove':
+            self.store.remove_product(event['id'])
+        elif op == 'update':
+            product_id, name, price, description, quantity = event['product']
+            product = self.store.get_product(product_id)
+            if product is not None:
+                old_name, old_description = product.name, product.description
+                product.name, product.price, product.description, product.quantity = name, price, description, quantity
+                self.store.product_updated(product, old_name, old_description)
+        elif op == 'prepare':
+            for product_id, quantity, unit_cents in event['lines']:
+                product = self.store.get_product(product_id)
+                if product is not None:
+                    product.quantity -= quantity
+            self.prepared[event['txn']] = (event['user'], event['lines'])
+        elif op == 'end_prepare':
+            user_id, lines = self.prepared.pop(event['txn'], (None, []))
+            if not event['committed']:
+                for product_id, quantity, unit_cents in lines:
+                    product = self.store.get_product(product_id)
+                    if product is not None:
+                        product.quantity += quantity
+        elif op == 'prices':
+            changed = []
+            for product_id, price in event['prices']:
+                product = self.store.get_product(product_id)
+                if product is not None:
+                    product.price = price
+                    changed.append(product_id)
+            self.store.prices_updated(changed)
+
+# Method to turn the merged stock changes into events, needs self.lock
+    def append_deltas_locked(self):
+        deltas, self.deltas = self.deltas, {}
+        for product_id, delta in deltas.items():
+            if delta:
+                self.seq += 1
+                self.pending.append(f'{{"seq":{self.seq},"op":"qty","id":{json.dumps(product_id)},"delta":{delta}}}\n')
+
+# Method to queue an event (a JSON line without its sequence number), needs self.lock, returns its sequence number
+    def append_locked(self, body):
+        if self.deltas:
+            self.append_deltas_locked()
+        self.seq += 1
+        self.pending.append(f'{{"seq":{self.seq},{body}\n')
+        return self.seq
+
+    def wake_writer(self):
+        with self.durable:
+            self.durable.notify_all()
+
+# Method to add a stock change to the merged ones, needs self.lock, returns True if the writer has to be woken up
+    def add_delta_locked(self, product_id, delta):
+        first = not self.deltas and not self.pending
+        self.deltas[product_id] = self.deltas.get(product_id, 0) + delta
+        return first
+
+# Method to change a product's stock by delta and journal it, both under one lock so snapshots never see one without the other
+    def change_quantity(self, product, delta):
+        if self.store.get_product(product.product_id) is None:
+            product.quantity += delta
+            return
+        with self.lock:
+            product.quantity += delta
+            first = self.add_delta_locked(product.product_id, delta)
+        if first:
+            self.wake_writer()
+
+# Method to move quantity of a product's stock into a cart (a negative quantity gives it back), nothing is journaled
+    def hold(self, product, quantity):
+        if self.store.get_product(product.product_id) is None:
+            product.quantity -= quantity
+            return
+        with self.lock:
+            product.quantity -= quantity
+            held = self.held.get(product.product_id, 0) + quantity
+            if held:
+                self.held[product.product_id] = held
+            else:
+                self.held.pop(product.product_id, None)
+
+# Method to journal held stock as sold, the product's stock doesn't change (it already left when it was held)
+    def sell(self, product, quantity):
+        if self.store.get_product(product.product_id) is None:
+            return
+        with self.lock:
+            held = self.held.get(product.product_id, 0) - quantity
+            if held > 0:
+                self.held[product.product_id] = held
+            else:
+                self.held.pop(product.product_id, None)
+            first = self.add_delta_locked(product.product_id, -quantity)
+        if first:
+            self.wake_writer()
+
+# Method to journal a sharded checkout's prepare, lines is a list of (product, quantity, unit_cents) held by a cart
+# that now belong to the checkout. The product's stock doesn't change, the journal stops counting it as held.
+    def prepare(self, txn_id, user_id, lines):
+        with self.lock:
+            rows = []
+            for product, quantity, unit_cents in lines:
+                held = self.held.get(product.product_id, 0) - quantity
+                if held > 0:
+                    self.held[product.product_id] = held
+                else:
+                    self.held.pop(product.product_id, None)
+                rows.append([product.product_id, quantity, unit_cents])
+            self.prepared[txn_id] = (user_id, rows)
+            seq = self.append_locked(f'"op":"prepare","txn":{json.dumps(txn_id)},"user":{json.dumps(user_id)},"lines":{json.dumps(rows)}}}')
+        self.wake_writer()
+        return seq
+
+# Method to journal how a prepared checkout ended. An aborted checkout's stock goes back into a cart (held again)
+# when to_cart is True, or back on the shelf when its cart is gone (after a restart).
+    def end_prepare(self, txn_id, committed, to_cart=True):
+        with self.lock:
+            if txn_id not in self.prepared:
+                return None
+            user_id, rows = self.prepared.pop(txn_id)
+            if not committed:
+                for product_id, quantity, unit_cents in rows:
+                    product = self.store.get_product(product_id)
+                    if product is None:
+                        continue
+                    if to_cart:
+                        self.held[product_id] = self.held.get(product_id, 0) + quantity
+                    else:
+                        product.quantity += quantity
+            seq = self.append_locked(f'"op":"end_prepare","txn":{json.dumps(txn_id)},"committed":{json.dumps(bool(committed))}}}')
+        self.wake_writer()
+        return seq
+
+# Methods called by the store as one of its listeners, the product's whole state is journaled as it is at that moment
+# (with the stock held in carts counted as on the shelf), product_state needs self.lock
+    def product_state(self, product):
+        return json.dumps([product.product_id, product.name, product.price, product.description, product.quantity + self.held.get(product.product_id, 0)])
+
+    def product_added(self, product):
+        with self.lock:
+            self.append_locked(f'"op":"add","product":{self.product_state(product)}}}')
+        self.wake_writer()
+
+    def product_removed(self, product):
+        with self.lock:
+            self.held.pop(product.product_id, None)
+            self.append_locked(f'"op":"remove","id":{json.dumps(product.product_id)}}}')
+        self.wake_writer()
+
+    def product_updated(self, product, old_name, old_description):
+        with self.lock:
+            self.append_locked(f'"op":"update","product":{self.product_state(product)}}}')
+        self.wake_writer()
+
+    def prices_updated(self, product_ids):
+        with self.lock:
+            prices = [[product_id, self.store.get_product(product_id).price] for product_id in product_ids]
+            self.append_locked(f'"op":"prices","prices":{json.dumps(prices)}}}')
+        self.wake_writer()
+
+# Method to wait until event seq (everything journaled so far by default) is on disk
+    def barrier(self, seq=None):
+        if seq is None:
+            with self.lock:
+                self.append_deltas_locked()
+                seq = self.seq
+        with self.durable:
+            while self.durable_seq < seq:
+                if self.error is not None:
+                    raise RuntimeError(f"The inventory journal's writer stopped: {self.error}")
+                if self.closed or self.writer is None or not self.writer.is_alive():
+                    raise RuntimeError("The inventory journal is closed")
+                self.durable.wait()
+
+# Method to write and fsync everything queued so far, returns the last event written
+    def flush(self):
+        with self.io_lock:
+            with self.lock:
+                self.append_deltas_locked()
+                batch, self.pending = self.pending, []
+                seq = self.seq
+            if batch:
+                self.file.write("".join(batch))
+                self.file.flush()
+                os.fsync(self.file.fileno())
+            self.since_snapshot += len(batch)
+        with self.durable:
+            self.durable_seq = max(self.durable_seq, seq)
+            self.durable.notify_all()
+        return seq
+
+# The writer thread: waits for events, lets more arrive for commit_delay seconds, then writes them all with one fsync
+# If writing fails the thread stops and keeps the error, so barrier() raises instead of waiting forever
+    def run_writer(self):
+        try:
+            while True:
+                with self.durable:
+                    while not self.pending and not self.deltas and not self.closed:
+                        self.durable.wait()
+                if self.closed:
+                    return
+                time.sleep(self.commit_delay)
+                self.flush()
+                if self.since_snapshot >= self.snapshot_every:
+                    self.snapshot()
+        except Exception as error:
+            print(Fore.RED + f"The inventory journal stopped writing: {error}" + Style.RESET_ALL)
+            with self.durable:
+                self.error = error
+                self.durable.notify_all()
+
+# Method to write a snapshot of every product and start a new log segment, the segments it covers are then deleted
+# The rows are read under the store's lock, so products can't be added or removed while they are copied
+    def snapshot(self):
+        with self.io_lock:
+            with self.store.lock, self.lock:
+                self.append_deltas_locked()
+                seq = self.seq
+                batch, self.pending = self.pending, []
+                held = self.held
+                rows = [(product.product_id, product.name, product.price, product.description, product.quantity + held.get(product.product_id, 0))
+                        for product in self.store.products]
+                prepared = dict(self.prepared)
+            # Events up to seq go to the old segment, everything after it to a new one
+            self.file.write("".join(batch))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.file = open(os.path.join(self.directory, f"{seq + 1:020d}.log"), 'a')
+            self.since_snapshot = 0
+        with self.durable:
+            self.durable_seq = max(self.durable_seq, seq)
+            self.durable.notify_all()
+        filename = os.path.join(self.directory, self.SNAPSHOT_FILE)
+        with open(filename + '.tmp', 'wb') as file:
+            pickle.dump({'seq': seq, 'date': datetime.datetime.now(), 'rows': rows, 'prepared': prepared}, file, protocol=5)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(filename + '.tmp', filename)
+        current = f"{seq + 1:020d}.log"
+        for name in self.segments():
+            if name < current:
+                os.remove(os.path.join(self.directory, name))
+        return seq
+
+# Method to write everything out, take a final snapshot (so the next start has nothing to replay) and stop journaling
+    def close(self, snapshot=True):
+        if self.writer is None or self.closed:
+            return
+        if snapshot:
+            self.snapshot()
+        self.flush()
+        with self.durable:
+            self.closed = True
+            self.durable.notify_all()
+        self.writer.join()
+        self.file.close()
+        if self in self.store.listeners:
+            self.store.listeners.remove(self)
+
+
+
+# Store class representing the online store, Store(compact=True) keeps the products in a ColumnarCatalog
+# Anything in Store.listeners (the search index and the renderer by default) is told when products are added, removed or updated.
+# Store.journal is the InventoryJournal keeping the products on disk, if there is one.
+# Adding and removing products happens under Store.lock, so a thread going over the whole catalog (the journal's
+# snapshots) can hold it to see the catalog without it changing size.
+class Store:
+    def __init__(self, compact=False):
+        self.lock = threading.RLock()
+        self.catalog = ColumnarCatalog() if compact else ProductCatalog()
+        self.search_index = SearchIndex(self.catalog)
+        self.renderer = ProductRenderer()
+        self.listeners = [self.search_index, self.renderer]
+        self.journal = None
+
+# Store.products iterates over the catalog, assigning a list to it rebuilds the catalog
+    @property
+    def products(self):
+        return self.catalog
+
+    @products.setter
+    def products(self, products):
+        for product in list(self.catalog):
+            self.remove_product(product.product_id)
+        for product in products:
+            self.add_product(product)
+
+# Method to add a product to the store, returns the product as the store keeps it
+    def add_product(self, product):
+        with self.lock:
+            product = self.catalog.add(product)
+            for listener in self.listeners:
+                listener.product_added(product)
+        return product
+
+# Method to add many products at once, listeners that have products_added get them all in one call
+    def add_products(self, products):
+        with self.lock:
+            added = [self.catalog.add(product) for product in products]
+            for listener in self.listeners:
+                if hasattr(listener, 'products_added'):
+                    listener.products_added(added)
+                else:
+                    for product in added:
+                        listener.product_added(product)
+        return added
+
+# Method to remove a product from the store by ID, returns the removed product or None
+    def remove_product(self, product_id):
+        with self.lock:
+            product = self.catalog.remove(product_id)
+            if product is not None:
+                for listener in self.listeners:
+                    listener.product_removed(product)
+        return product
+
+# Method to get a product by its ID
+    def get_product(self, product_id):
+        return self.catalog.get(product_id)
+
+# Method to change a product's stock for good (restocking, imports), journaled when the store has a journal
+    def change_quantity(self, product, delta):
+        if self.journal is not None:
+            self.journal.change_quantity(product, delta)
+        else:
+            product.increase_quantity(delta)
+
+# Method to tell the listeners that the prices of many products were changed at once (by CatalogAnalytics)
+    def prices_updated(self, product_ids):
+        for listener in self.listeners:
+            if hasattr(listener, 'prices_updated'):
+                listener.prices_updated(product_ids)
+
+# Method to update the indexes after a product's information was changed
+    def product_updated(self, product, old_name, old_description):
+        self.catalog.reindex(product, old_name)
+        for listener in self.listeners:
+            listener.product_updated(product, old_name, old_description)
+
+# Method to get the ID to use for the next new product
+    def next_product_id(self):
+        return self.catalog.next_id()
+
+# Method to display the products, all of them or one page (page_size products starting at offset, optionally sorted)
+    def display_all_products(self, page_size=None, offset=0, sort_key=None, reverse=False):
+        write_output(self.renderer.render_page(self, page_size or max(len(self.products), 1), offset, sort_key, reverse))
+
+    def search_product(self, name, ignore_case=False):
+        matches = self.catalog.find_by_name(name, ignore_case)
+        return matches[0] if matches else None
+
+# Method to search product names and descriptions, returns the best matching products first
+    def search(self, query, limit=10):
+        return self.search_index.search(query, limit)
+
+# Method to suggest search words starting with what the user typed so far
+    def autocomplete(self, prefix, limit=10):
+        return self.search_index.autocomplete(prefix, limit)
+
+
+
+
+# CatalogAnalytics class for catalog-wide reports and bulk price changes with NumPy
+# The catalog is read into arrays (for a ColumnarCatalog the arrays are views straight onto its columns, nothing is copied)
+# and every calculation is done on whole arrays at once. Filters select products by price, stock or ID.
+# With a normal catalog most of the time goes into reading the products into arrays, use Store(compact=True) for big catalogs.
+# Don't add products to a compact store from another thread while an analytics call is running.
+class CatalogAnalytics:
+    def __init__(self, store):
+        if np is None:
+            raise RuntimeError("NumPy is needed for catalog analytics, install it with: pip install numpy")
+        self.store = store
+
+# Method to read the catalog into (ids, prices, quantities, products) arrays, products is None for a ColumnarCatalog
+    def _columns(self):
+        catalog = self.store.catalog
+        if isinstance(catalog, ColumnarCatalog):
+            ids = np.frombuffer(catalog.ids, dtype=np.int64) if len(catalog) else np.zeros(0, dtype=np.int64)
+            prices = np.frombuffer(catalog.prices, dtype=np.float64) if len(catalog) else np.zeros(0)
+            quantities = np.frombuffer(catalog.quantities, dtype=np.int64) if len(catalog) else np.zeros(0, dtype=np.int64)
+            return ids, prices, quantities, None
+        products = list(catalog)
+        count = len(products)
+        ids = np.fromiter((product.product_id for product in products), dtype=np.int64, count=count)
+        prices = np.fromiter((product.price for product in products), dtype=np.float64, count=count)
+        quantities = np.fromiter((product.quantity for product in products), dtype=np.int64, count=count)
+        return ids, prices, quantities, products
+
+# Method to build the mask of products matching the filters
+    @staticmethod
+    def _select(ids, prices, quantities, min_price=None, max_price=None, min_quantity=None, max_quantity=None, product_ids=None):
+        mask = np.ones(len(ids), dtype=bool)
+        if min_price is not None:
+            mask &= prices >= min_price
+        if max_price is not None:
+            mask &= prices <= max_price
+        if min_quantity is not None:
+            mask &= quantities >= min_quantity
+        if max_quantity is not None:
+            mask &= quantities <= max_quantity
+        if product_ids is not None:
+            mask &= np.isin(ids, np.fromiter(product_ids, dtype=np.int64))
+        return mask
+
+# Method to get the value of all stock (price x quantity, summed in cents) of the products matching the filters
+    def total_stock_value(self, **filters):
+        ids, prices, quantities, products = self._columns()
+        mask = self._select(ids, prices, quantities, **filters)
+        cents = np.rint(prices[mask] * 100).astype(np.int64)
+        return from_cents(int(np.dot(cents, quantities[mask])))
+
+# Method to get the products with at most threshold items in stock, lowest stock first
+    def low_stock(self, threshold=5, limit=None):
+        ids, prices, quantities, products = self._columns()
+        rows = np.flatnonzero(quantities <= threshold)
+        rows = rows[np.argsort(quantities[rows], kind='stable')]
+        if limit is not None:
+            rows = rows[:limit]
+        if products is not None:
+            return [products[row] for row in rows]
+        return [self.store.get_product(int(ids[row])) for row in rows]
+
+# Method to count the products in price bands, returns (counts, band edges) as lists
+    def price_histogram(self, bins=10, **filters):
+        ids, prices, quantities, products = self._columns()
+        mask = self._select(ids, prices, quantities, **filters)
+        if not mask.any():
+            return [], []
+        counts, edges = np.histogram(prices[mask], bins=bins)
+        return counts.tolist(), [round(float(edge), 2) for edge in edges]
+
+# Method to change the price of every product matching the filters by a percentage (e.g. -10 for 10% off),
+# new prices are rounded to cents and never go below zero. Returns how many products were changed.
+    def bulk_price_change(self, percent, **filters):
+        ids, prices, quantities, products = self._columns()
+        mask = self._select(ids, prices, quantities, **filters)
+        rows = np.flatnonzero(mask)
+        new_prices = np.maximum(np.round(prices[rows] * (1 + percent / 100), 2), 0)
+        if products is None:
+            # prices is a view onto the catalog's column, so this writes the new prices straight into the catalog
+            prices[rows] = new_prices
+        else:
+            for row, price in zip(rows.tolist(), new_prices.tolist()):
+                products[row].price = price
+        changed_ids = ids[rows].tolist()
+        del ids, prices, quantities
+        self.store.prices_updated(changed_ids)
+        return len(changed_ids)
+
+
+
+# Result of CatalogSync.import_file, errors holds the first few rejects as (line number, reason)
+ImportReport = namedtuple('ImportReport', ['rows', 'added', 'updated', 'removed', 'unchanged', 'rejected', 'errors', 'seconds'])
+
+
+# CatalogSync class importing and exporting the catalog as CSV or JSON lines files (optionally .gz compressed)
+# Files are streamed a row at a time and applied in batches, so a file with millions of products is never held in memory.
+# Every row is an upsert by product_id: a new product needs a name, price and quantity, for an existing one blank fields
+# keep their current value. A row with action "delete" removes the product. Invalid rows are skipped and written to a
+# rejects file with the reason. Stock changes are made under the same locks carts use, so carts never lose stock.
+class CatalogSync:
+    FIELDS = ['product_id', 'name', 'price', 'description', 'quantity']
+    MAX_ERRORS = 20
+
+    def __init__(self, store, batch_size=10000, reservations=None):
+        self.store = store
+        self.batch_size = batch_size
+        self.reservations = reservations if reservations is not None else inventory_reservations
+
+# Method to work out a file's format from its name, 'csv' or 'jsonl'
+    @staticmethod
+    def file_format(filename, file_format=None):
+        if file_format is not None:
+            return file_format
+        name = filename[:-3] if filename.endswith('.gz') else filename
+        if name.endswith('.csv'):
+            return 'csv'
+        if name.endswith(('.jsonl', '.json', '.ndjson')):
+            return 'jsonl'
+        raise ValueError(f"Can't tell the format of {filename}, use a .csv or .jsonl file")
+
+    @staticmethod
+    def open_file(filename, mode):
+        if filename.endswith('.gz'):
+            return gzip.open(filename, mode + 't', encoding='utf-8', newline='')
+        return open(filename, mode, encoding='utf-8', newline='')
+
+# Generator of (line number, row) for every row of a file, a row is a dict (a line that isn't valid JSON gives its error instead)
+    def read_rows(self, filename, file_format=None):
+        file_format = self.file_format(filename, file_format)
+        with self.open_file(filename, 'r') as file:
+            if file_format == 'csv':
+                reader = csv.DictReader(file)
+                for row in reader:
+                    yield reader.line_num, row
+            else:
+                for line_number, line in enumerate(file, 1):
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        row = json.loads(line)
+                    except ValueError as error:
+                        yield line_number, ValueError(f"Invalid JSON: {error}")
+                        continue
+                    yield line_number, row if isinstance(row, dict) else ValueError("Each line must be a JSON object")
+
+# Method to check a row and convert its values, returns (action, product ID, fields) where fields only holds the
+# values the row sets. Raises ValueError with the reason when the row is invalid.
+    @staticmethod
+    def validate(row):
+        if isinstance(row, Exception):
+            raise row
+
+        def present(name):
+            value = row.get(name)
+            return value is not None and value != ''
+
+        try:
+            if isinstance(row.get('product_id'), float) or isinstance(row.get('product_id'), bool):
+                raise ValueError
+            product_id = int(row.get('product_id'))
+        except (TypeError, ValueError):
+            raise ValueError("product_id must be a whole number")
+        if product_id < 1:
+            raise ValueError("product_id must be at least 1")
+        action = row.get('action') or 'upsert'
+        if not isinstance(action, str):
+            raise ValueError("action must be upsert or delete")
+        action = action.strip().lower()
+        if action == 'delete':
+            return action, product_id, {}
+        if action != 'upsert':
+            raise ValueError(f"Unknown action {action!r}, use upsert or delete")
+        fields = {}
+        if present('name'):
+            fields['name'] = str(row['name']).strip()
+        if present('description'):
+            fields['description'] = str(row['description'])
+        if present('price'):
+            try:
+                if isinstance(row['price'], bool):
+                    raise ValueError
+                price = float(row['price'])
+            except (TypeError, ValueError):
+                raise ValueError("price must be a number")
+            if not math.isfinite(price) or price < 0:
+                raise ValueError("price must be a number of at least 0")
+            fields['price'] = price
+        if present('quantity'):
+            quantity = row['quantity']
+            try:
+                if isinstance(quantity, float) or isinstance(quantity, bool):
+                    raise ValueError
+                quantity = int(quantity)
+            except (TypeError, ValueError):
+                raise ValueError("quantity must be a whole number")
+            if quantity < 0:
+                raise ValueError("quantity must be at least 0")
+            fields['quantity'] = quantity
+        return action, product_id, fields
+
+# Method to import a file into the store, invalid rows go to rejects_filename (CSV or JSON lines, by its name) if given
+    def import_file(self, filename, rejects_filename=None, file_format=None):
+        start = time.perf_counter()
+        counts = {'rows': 0, 'added': 0, 'updated': 0, 'removed': 0, 'unchanged': 0, 'rejected': 0}
+        errors = []
+        rejects = self.open_rejects(rejects_filename)
+
+        def reject(line_number, reason, row):
+            counts['rejected'] += 1
+            if len(errors) < self.MAX_ERRORS:
+                errors.append((line_number, reason))
+            if rejects is not None:
+                rejects(line_number, reason, row)
+
+        try:
+            batch = []
+            for line_number, row in self.read_rows(filename, file_format):
+                counts['rows'] += 1
+                try:
+                    batch.append((line_number, row) + self.validate(row))
+                except ValueError as error:
+                    reject(line_number, str(error), row)
+                    continue
+                if len(batch) >= self.batch_size:
+                    self.apply_batch(batch, counts, reject)
+                    batch = []
+            self.apply_batch(batch, counts, reject)
+        finally:
+            if rejects is not None:
+                rejects.close()
+        return ImportReport(errors=errors, seconds=time.perf_counter() - start, **counts)
+
+# Method to make the function writing one reject (line number, reason, row), it has a close() to finish the file
+    def open_rejects(self, rejects_filename):
+        if rejects_filename is None:
+            return None
+        file = self.open_file(rejects_filename, 'w')
+        if self.file_format(rejects_filename) == 'csv':
+            writer = csv.writer(file)
+            writer.writerow(['line', 'reason', 'row'])
+
+            def write(line_number, reason, row):
+                writer.writerow([line_number, reason, row if isinstance(row, Exception) else json.dumps(row)])
+        else:
+            def write(line_number, reason, row):
+                file.write(json.dumps({'line': line_number, 'reason': reason, 'row': None if isinstance(row, Exception) else row}) + '\n')
+        write.close = file.close
+        return write
+
+# Method to apply one batch of validated rows: new products are added together at the end of the batch and the price
+# changes are passed on to the store's listeners in one call
+    def apply_batch(self, batch, counts, reject):
+        new_products = {}
+        repriced = []
+        for line_number, row, action, product_id, fields in batch:
+            if action == 'delete':
+                removed = new_products.pop(product_id, None) is not None
+                removed = self.store.remove_product(product_id) is not None or removed
+                counts['removed' if removed else 'unchanged'] += 1
+                continue
+            product = new_products.get(product_id) or self.store.get_product(product_id)
+            if product is None:
+                missing = [name for name in ('name', 'price', 'quantity') if name not in fields]
+                if missing:
+                    reject(line_number, f"A new product needs {', '.join(missing)}", row)
+                    continue
+                new_products[product_id] = Product(product_id, fields['name'], fields['price'], fields.get('description', ''), fields['quantity'])
+                counts['added'] += 1
+                continue
+            if product_id in new_products:
+                for name, value in fields.items():
+                    setattr(product, name, value)
+                counts['updated'] += 1
+                continue
+            changed = self.update_product(product, fields)
+            if changed == 'price':
+                repriced.append(product_id)
+            counts['updated' if changed else 'unchanged'] += 1
+        if new_products:
+            self.store.add_products(new_products.values())
+        if repriced:
+            self.store.prices_updated(repriced)
+
+# Method to update an existing product, returns False when nothing changed, 'price' when only the price (and stock)
+# changed and True otherwise
+    def update_product(self, product, fields):
+        changed = False
+        if 'quantity' in fields:
+            with self.reservations.lock_for(product.product_id):
+                delta = fields['quantity'] - product.quantity
+                if delta:
+                    self.store.change_quantity(product, delta)
+                    changed = True
+        old_name, old_description = product.name, product.description
+        renamed = fields.get('name', old_name) != old_name or fields.get('description', old_description) != old_description
+        repriced = fields.get('price', product.price) != product.price
+        if renamed:
+            product.name = fields.get('name', old_name)
+            product.description = fields.get('description', old_description)
+            if repriced:
+                product.price = fields['price']
+            self.store.product_updated(product, old_name, old_description)
+            return True
+        if repriced:
+            product.price = fields['price']
+            return 'price'
+        return changed
+
+# Method to export the catalog to a file (CSV or JSON lines, by its name), written to a temporary file first and
+# swapped in when complete. Returns how many products were written.
+    def export_file(self, filename, file_format=None):
+        file_format = self.file_format(filename, file_format)
+        temp_filename = filename + '.tmp' + ('.gz' if filename.endswith('.gz') else '')
+        count = 0
+        with self.open_file(temp_filename, 'w') as file:
+            if file_format == 'csv':
+                writer = csv.writer(file)
+                writer.writerow(self.FIELDS)
+                for product in self.store.products:
+                    writer.writerow([product.product_id, product.name, product.price, product.description, product.quantity])
+                    count += 1
+            else:
+                for product in self.store.products:
+                    file.write(json.dumps({'product_id': product.product_id, 'name': product.name, 'price': product.price,
+                                           'description': product.description, 'quantity': product.quantity}) + '\n')
+                    count += 1
+        os.replace(temp_filename, filename)
+        return count
+
+
+
+# UserView class giving list-like access to the users of a UserDatabase
+# Users are only built from their stored records when they are iterated over or looked up.
+class UserView:
+    def __init__(self, database):
+        self.database = database
+
+    def __len__(self):
+        return len(self.database.records)
+
+    def __iter__(self):
+        for user_id in list(self.database.records):
+            yield self.database.get_user(user_id)
+
+    def __contains__(self, user):
+        return isinstance(user, User) and user.user_id in self.database.records
+
+
+
+# UserDatabase class for managing user data
+# The file is an append-only log with one JSON record per line, a later record for a user ID replaces the earlier one.
+# Loading only reads the records, Admin/Customer objects are created the first time a user is used.
+# Records are appended by a BackgroundWriter, so adding a user never waits for the disk, and the writer compacts the log
+# once it holds too many replaced records by rewriting only the latest record of every user.
+# Usernames and roles are indexed so logins and signup checks don't depend on the number of users.
+# The indexes are also kept in a binary snapshot next to the file (users.txt.snapshot), so startup doesn't parse every line.
+class UserDatabase:
+    COMPACT_MIN_RECORDS = 1000
+    COMPACT_RATIO = 2
+    SNAPSHOT_SUFFIX = '.snapshot'
+    SNAPSHOT_MIN_LINES = 1000
+
+    def __init__(self, filename, flush_interval=0.05, max_pending=1000):
+        self.filename = filename
+        self.lock = threading.RLock()
+        self.file_lock = threading.Lock()
+        self.records = {}
+        self.loaded = {}
+        self.by_username = {}
+        self.by_role = {'Admin': set(), 'Customer': set()}
+        self.next_user_id = 1
+        self.log_records = 0
+        self.needs_compaction = False
+        self.users = self.load_users()
+        self.writer = BackgroundWriter(self.write_records, 'users', flush_interval, max_pending)
+
+# Method to turn a user into the record that is written to the file
+    @staticmethod
+    def user_to_record(user):
+        return {
+            'type': 'Admin' if isinstance(user, Admin) else 'Customer',
+            'user_id': user.user_id,
+            'username': user.username,
+            'password_hash': user.password_hash,
+            'first_name': user.first_name,
+            'last_name': user.last_name,
+            'address': user.address
+        }
+
+# Method to build an Admin or Customer from a stored record
+    @staticmethod
+    def user_from_record(record):
+        user_class = Admin if record['type'] == 'Admin' else Customer
+        return user_class(record['user_id'], record['username'], None, record['first_name'], record['last_name'], record['address'], record['password_hash'])
+
+# Method to replace the plaintext password of a record from an older file with a hash
+    @staticmethod
+    def upgrade_record(record):
+        if 'password' in record:
+            record = dict(record)
+            record['password_hash'] = password_hasher.hash(record.pop('password'))
+        return record
+
+# Method to parse one line of the file, older files written with str(dict) are still read (safely, without eval)
+    @staticmethod
+    def parse_record(line):
+        try:
+            return json.loads(line)
+        except ValueError:
+            return ast.literal_eval(line)
+
+# Method to add a record to the username and role indexes, dropping whatever the user's previous record indexed
+    def _index(self, record):
+        user_id = record['user_id']
+        previous = self.records.get(user_id)
+        if previous is not None:
+            if self.by_username.get(previous['username']) == user_id:
+                del self.by_username[previous['username']]
+            self.by_role[previous['type']].discard(user_id)
+        self.records[user_id] = record
+        self.by_username[record['username']] = user_id
+        self.by_role[record['type']].add(user_id)
+        if isinstance(user_id, int) and user_id >= self.next_user_id:
+            self.next_user_id = user_id + 1
+
+# Method to load the indexes from the snapshot file, returns how many bytes of the users file it covers (0 if there
+# is no usable snapshot, e.g. the users file was rewritten since). The snapshot is a pickle the program wrote itself.
+    def load_snapshot(self, file):
+        try:
+            with open(self.filename + self.SNAPSHOT_SUFFIX, 'rb') as snapshot_file:
+                snapshot = pickle.load(snapshot_file)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ValueError):
+            return 0
+        status = os.fstat(file.fileno())
+        if snapshot.get('inode') != status.st_ino or snapshot.get('offset', 0) > status.st_size:
+            return 0
+        file.seek(snapshot['offset'] - len(snapshot['tail']))
+        if file.read(len(snapshot['tail'])) != snapshot['tail']:
+            return 0
+        self.records = snapshot['records']
+        self.by_username = snapshot['by_username']
+        self.by_role = snapshot['by_role']
+        self.next_user_id = snapshot['next_user_id']
+        self.log_records = snapshot['log_records']
+        return snapshot['offset']
+
+# Method to copy the indexes (to save them in a snapshot), needs self.lock while other threads may add users
+    def copy_indexes(self):
+        return {'records': dict(self.records), 'by_username': dict(self.by_username), 'by_role': {role: set(user_ids) for role, user_ids in self.by_role.items()},
+                'next_user_id': self.next_user_id, 'log_records': self.log_records}
+
+# Method to write indexes (from copy_indexes) to the snapshot file, offset is how much of the users file they cover
+# The last bytes before offset are kept too, so a users file that was replaced by another one isn't mistaken for it
+    def save_snapshot(self, offset, indexes):
+        with open(self.filename, 'rb') as file:
+            inode = os.fstat(file.fileno()).st_ino
+            file.seek(max(offset - 64, 0))
+            tail = file.read(offset - max(offset - 64, 0))
+        snapshot = dict(indexes, inode=inode, offset=offset, tail=tail)
+        temp_filename = self.filename + self.SNAPSHOT_SUFFIX + '.tmp'
+        with open(temp_filename, 'wb') as file:
+            pickle.dump(snapshot, file, protocol=5)
+        os.replace(temp_filename, self.filename + self.SNAPSHOT_SUFFIX)
+
+# Method to load users from a file, the file is streamed line by line and only the records are kept
+# The indexes start from the snapshot when there is one, so only the lines appended after it are parsed,
+# and a new snapshot is saved once enough lines had to be parsed.
+    def load_users(self):
+        self.records = {}
+        self.loaded = {}
+        self.by_username = {}
+        self.by_role = {'Admin': set(), 'Customer': set()}
+        self.log_records = 0
+        parsed = 0
+        try:
+            with open(self.filename, 'rb') as file:
+                offset = self.load_snapshot(file)
+                file.seek(offset)
+                for line in file:
+                    if line.endswith(b'\n'):
+                        offset += len(line)
+                    parsed += 1
+                    line = line.decode('utf-8', errors='replace').strip()
+                    if not line:
+                        continue
+                    try:
+                        record = self.parse_record(line)
+                        self._index(record)
+                    except (ValueError, SyntaxError, KeyError, TypeError):
+                        # A torn or corrupt line (e.g. from a crash while appending) is skipped and dropped at the next compaction
+                        self.needs_compaction = True
+                        continue
+                    # Files written by older versions (str(dict) lines, plaintext passwords) are rewritten once
+                    if not line.startswith('{"') or 'password' in record:
+                        self.needs_compaction = True
+                    self.log_records += 1
+        except FileNotFoundError:
+            pass
+        if self.needs_compaction:
+            self.save_users()
+        elif parsed >= self.SNAPSHOT_MIN_LINES:
+            self.save_snapshot(offset, self.copy_indexes())
+        return UserView(self)
+
+# Method to save users to a file, the whole log is rewritten with one record per user and swapped in atomically
+# Only copying the records and swapping the files happen under self.lock, so adding users doesn't wait for the disk.
+# Nothing is appended meanwhile (file_lock), users added after the copy are appended to the new file once it's in place.
+    def save_users(self):
+        with self.file_lock:
+            with self.lock:
+                for user in list(self.loaded.values()):
+                    self._index(self.user_to_record(user))
+                for user_id, record in self.records.items():
+                    if 'password' in record:
+                        self.records[user_id] = self.upgrade_record(record)
+                records = list(self.records.values())
+                indexes = self.copy_indexes() if len(records) >= self.SNAPSHOT_MIN_LINES else None
+            temp_filename = self.filename + '.tmp'
+            with open(temp_filename, 'w') as file:
+                for record in records:
+                    file.write(json.dumps(record) + '\n')
+                file.flush()
+                os.fsync(file.fileno())
+            with self.lock:
+                os.replace(temp_filename, self.filename)
+                self.log_records = len(records)
+                self.needs_compaction = False
+            if indexes is not None:
+                indexes['log_records'] = len(records)
+                self.save_snapshot(os.path.getsize(self.filename), indexes)
+
+# Method to get a user by ID, the user object is created on first use
+    def get_user(self, user_id):
+        user = self.loaded.get(user_id)
+        if user is None:
+            record = self.records.get(user_id)
+            if record is None:
+                return None
+            # setdefault keeps the first object if two threads build the same user at once
+            user = self.loaded.setdefault(user_id, self.user_from_record(record))
+        return user
+
+# Method to find a user by username, optionally only if they have the given role ('Admin' or 'Customer')
+    def find_user(self, username, role=None):
+        user_id = self.by_username.get(username)
+        if user_id is None or (role is not None and user_id not in self.by_role[role]):
+            return None
+        return self.get_user(user_id)
+
+# Method to get all users with a given role
+    def users_with_role(self, role):
+        for user_id in list(self.by_role[role]):
+            yield self.get_user(user_id)
+
+# Method to hand out a new user ID, safe to call from several threads at once
+    def allocate_user_id(self):
+        with self.lock:
+            user_id = self.next_user_id
+            self.next_user_id += 1
+            return user_id
+
+# Method to add a user to the database (or store the changes of an existing one), the user's record is appended to
+# the file by the background writer (only the newest record of a user queued before it writes is appended)
+# Raises ValueError if the username already belongs to another user, the check and the indexing happen under one lock.
+    def add_user(self, user):
+        record = self.user_to_record(user)
+        with self.lock:
+            owner = self.by_username.get(user.username)
+            if owner is not None and owner != user.user_id:
+                raise ValueError(f"Username {user.username} already exists")
+            self._index(record)
+            self.loaded[user.user_id] = user
+            self.writer.submit(user.user_id, json.dumps(record) + '\n')
+
+# Method called by the writer thread to append a batch of records, the log is compacted once it has grown too long
+    def write_records(self, lines):
+        with self.file_lock:
+            with open(self.filename, 'a') as file:
+                file.write("".join(lines))
+                file.flush()
+                os.fsync(file.fileno())
+            self.log_records += len(lines)
+        with self.lock:
+            due = self.log_records > self.COMPACT_MIN_RECORDS and self.log_records > self.COMPACT_RATIO * len(self.records)
+        if due:
+            self.save_users()
+
+# Method to wait until every user added so far is in the file
+    def flush(self):
+        self.writer.flush()
+
+# Method to write the queued users and stop the writer
+    def close(self):
+        self.writer.close()
+
+# Method to check if a username already exists
+    def username_exists(self, username):
+        return username in self.by_username
+
+
+# Helper functions for user input and validation
+
+
+# Function to check if the input is valid (not empty and does not contain digits)
+def is_valid_input(value):
+    return value.strip() and not any(char.isdigit() for char in value)
+
+# Function to get valid input from the user
+def get_valid_input(prompt):
+    while True:
+        value = input(prompt)
+        if is_valid_input(value):
+            return value
+        else:
+            print(Fore.RED + "Invalid input. Please enter a valid name." + Style.RESET_ALL)
+
+# Patterns used by the password and username checks, compiled once
+UPPERCASE_PATTERN = re.compile(r"[A-Z]")
+DIGIT_PATTERN = re.compile(r"[0-9]")
+
+# Function to make sure the user enters a valid password
+def is_valid_password(password):
+    if len(password) < 8:
+        return False, "Password must be at least 8 characters long"
+    if not UPPERCASE_PATTERN.search(password):
+        return False, "Password must contain at least one uppercase letter"
+    if not DIGIT_PATTERN.search(password):
+        return False, "Password must contain at least one number"
+    return True, ""
+
+# Function to validate a username based on specific criteria
+def is_valid_username(username):
+    if len(username) < 8:
+        return False, "Username must be at least 8 characters long."
+    if not any(char.isalpha() for char in username):
+        return False, "Username must contain at least one alphabet."
+    if not DIGIT_PATTERN.search(username):
+        return False, "Username must contain at least one number"
+    return True, ""
+
+# Function to clear the terminal screen for a cleaner output
+def clear_terminal():
+    os.system('cls' if os.name == 'nt' else 'clear')
+
+# Function to let the user page through the store's products, it returns as soon as everything fit on one page
+def browse_products(store, page_size=10):
+    offset = 0
+    sort_key = None
+    while True:
+        store.display_all_products(page_size, offset, sort_key)
+        if len(store.products) <= page_size:
+            return
+        action = input("n = next page, p = previous page, s = sort, q = done: ").strip().lower()
+        if action == 'n' and offset + page_size < len(store.products):
+            offset += page_size
+        elif action == 'p':
+            offset = max(offset - page_size, 0)
+        elif action == 's':
+            key = input("Sort by (product_id, name, price, quantity): ").strip()
+            if key in ProductRenderer.SORT_KEYS:
+                sort_key = key
+                offset = 0
+            else:
+                print(Fore.RED + "Invalid sort key" + Style.RESET_ALL)
+        elif action == 'q':
+            return
+
+# Function to prompt the user with a yes/no question and validate the response
+def prompt_yes_no(message):
+    while True:
+        response = input(message).strip().lower()
+        if response in ['yes', 'no']:
+            return response == 'yes'
+        else:
+            print(Fore.RED + "Invalid input. Please enter 'yes' or 'no'." + Style.RESET_ALL)
+
+
+
+
+# OperationStats class holding the call count, error count and latency histogram of one instrumented operation
+class OperationStats:
+    # Upper bounds of the latency buckets in seconds (the last bucket takes everything slower)
+    BUCKETS = (0.000001, 0.000005, 0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.lock = threading.Lock()
+
+# Method to record one call
+    def record(self, seconds, failed):
+        bucket = bisect_left(self.BUCKETS, seconds)
+        with self.lock:
+            self.calls += 1
+            self.errors += failed
+            self.total_seconds += seconds
+            self.counts[bucket] += 1
+
+# Method to set everything back to zero
+    def clear(self):
+        with self.lock:
+            self.calls = 0
+            self.errors = 0
+            self.total_seconds = 0.0
+            self.counts = [0] * (len(self.BUCKETS) + 1)
+
+# Method to estimate a latency percentile (0-100) from the histogram, gives the upper bound of the bucket it falls in
+    def percentile(self, percent):
+        if self.calls == 0:
+            return 0.0
+        wanted = self.calls * percent / 100
+        seen = 0
+        for bound, count in zip(self.BUCKETS + (math.inf,), self.counts):
+            seen += count
+            if seen >= wanted:
+                return bound
+        return math.inf
+
+    def to_json(self):
+        with self.lock:
+            return {'calls': self.calls, 'errors': self.errors, 'total_seconds': self.total_seconds,
+                    'p50_seconds': self.percentile(50), 'p99_seconds': self.percentile(99),
+                    'buckets': {str(bound): count for bound, count in zip(self.BUCKETS + ('+Inf',), self.counts)}}
+
+
+
+# Metrics class instrumenting the hot operations of the store with call counts, error counts and latency histograms
+# Nothing is wrapped until enable() is called, and disable() puts the original methods back, so with metrics off the
+# store runs exactly the code it would without this class. profile() runs every call of one operation under cProfile.
+# A call is an error when it raises, or for the operations that report failure by returning False (a cart change
+# without enough stock, a wrong password) when it returns something false. A login keeps asking until the password
+# is right, so wrong passwords show up as errors of User.check_password.
+class Metrics:
+    # (class name, method name, whether a false result is an error) of every instrumented operation, the classes are
+    # looked up when metrics are enabled
+    OPERATIONS = (
+        ('ShoppingCart', 'add_product', True), ('ShoppingCart', 'remove_product', True), ('ShoppingCart', 'checkout', False),
+        ('Store', 'search_product', False),
+        ('UserDatabase', 'load_users', False), ('UserDatabase', 'save_users', False), ('UserDatabase', 'add_user', False),
+        ('User', 'check_password', True), ('Customer', 'login', False), ('Admin', 'login', False),
+    )
+
+    def __init__(self):
+        self.stats = {}
+        self.originals = {}
+        self.profiler = None
+        self.profile_name = None
+        self.profile_file = None
+        self.profile_lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.originals)
+
+# Method to wrap every instrumented operation (calling it again does nothing)
+    def enable(self):
+        if self.enabled:
+            return
+        for class_name, method_name, false_fails in self.OPERATIONS:
+            cls = globals()[class_name]
+            original = cls.__dict__[method_name]
+            name = f"{class_name}.{method_name}"
+            stats = self.stats.setdefault(name, OperationStats(name))
+            self.originals[(cls, method_name)] = original
+            setattr(cls, method_name, self.wrap(original, stats, false_fails))
+
+# Method to put the original methods back (the collected numbers are kept until reset())
+    def disable(self):
+        for (cls, method_name), original in self.originals.items():
+            setattr(cls, method_name, original)
+        self.originals = {}
+        self.stop_profile()
+
+# Method to forget every collected number
+    def reset(self):
+        for stats in self.stats.values():
+            stats.clear()
+
+# Method to make the timing wrapper of one operation, false_fails counts a false result as an error
+    def wrap(self, method, stats, false_fails=False):
+        name = stats.name
+        perf_counter = time.perf_counter
+
+        @functools.wraps(method)
+        def timed(*args, **kwargs):
+            profiler = self.profiler if self.profile_name == name else None
+            if profiler is not None:
+                return self.call_profiled(profiler, method, stats, false_fails, args, kwargs)
+            start = perf_counter()
+            try:
+                result = method(*args, **kwargs)
+            except BaseException:
+                stats.record(perf_counter() - start, 1)
+                raise
+            stats.record(perf_counter() - start, int(false_fails and not result))
+            return result
+        return timed
+
+# Method to run one call of the profiled operation under the profiler (only one thread is profiled at a time)
+    def call_profiled(self, profiler, method, stats, false_fails, args, kwargs):
+        if not self.profile_lock.acquire(blocking=False):
+            profiler = None
+        start = time.perf_counter()
+        failed = 1
+        try:
+            if profiler is not None:
+                result = profiler.runcall(method, *args, **kwargs)
+            else:
+                result = method(*args, **kwargs)
+            failed = int(false_fails and not result)
+            return result
+        finally:
+            stats.record(time.perf_counter() - start, failed)
+            if profiler is not None:
+                self.profile_lock.release()
+
+# Method to run every call of one operation (e.g. 'ShoppingCart.checkout') under cProfile until stop_profile(),
+# the profile is then written to filename (read it with: python -m pstats filename)
+    def profile(self, name, filename):
+        if name not in {f"{class_name}.{method_name}" for class_name, method_name, false_fails in self.OPERATIONS}:
+            raise ValueError(f"{name} is not an instrumented operation")
+        self.stop_profile()
+        self.enable()
+        self.profile_file = filename
+        self.profiler = cProfile.Profile()
+        self.profile_name = name
+
+# Method to stop profiling and write the profile to disk, returns the file name (None when nothing was profiled)
+    def stop_profile(self):
+        profiler, filename = self.profiler, self.profile_file
+        if profiler is None:
+            return None
+        self.profile_name = None
+        self.profiler = None
+        self.profile_file = None
+        with self.profile_lock:
+            profiler.dump_stats(filename)
+        return filename
+
+# Method to get every collected number as JSON data
+    def snapshot(self):
+        return {name: stats.to_json() for name, stats in sorted(self.stats.items())}
+
+# Method to get the collected numbers in the Prometheus text format
+    def to_prometheus(self):
+        lines = ["# HELP shop_operation_seconds Latency of store operations.", "# TYPE shop_operation_seconds histogram"]
+        errors = ["# HELP shop_operation_errors_total Store operations that raised or reported failure.", "# TYPE shop_operation_errors_total counter"]
+        for name, data in self.snapshot().items():
+            label = f'operation="{name}"'
+            cumulative = 0
+            for bound, count in data['buckets'].items():
+                cumulative += count
+                lines.append(f'shop_operation_seconds_bucket{{{label},le="{bound}"}} {cumulative}')
+            lines.append(f"shop_operation_seconds_sum{{{label}}} {data['total_seconds']}")
+            lines.append(f"shop_operation_seconds_count{{{label}}} {data['calls']}")
+            errors.append(f"shop_operation_errors_total{{{label}}} {data['errors']}")
+        return "\n".join(lines + errors) + "\n"
+
+# Method to write the numbers to a file, Prometheus text for .prom/.txt files and JSON otherwise
+    def dump(self, filename):
+        if filename.endswith(('.prom', '.txt')):
+            text = self.to_prometheus()
+        else:
+            text = json.dumps(self.snapshot(), indent=2)
+        temp_name = filename + '.tmp'
+        with open(temp_name, 'w') as file:
+            file.write(text)
+        os.replace(temp_name, filename)
+        return filename
+
+
+metrics = Metrics()
+
+
+
+
+# APIError exception, raised by StoreAPI handlers to answer with an HTTP error status
+class APIError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+# A parsed API request: params holds the query string, body the JSON body and match the groups of the matched route
+APIRequest = namedtuple('APIRequest', ['method', 'path', 'params', 'body', 'token', 'match'])
+
+HTTP_REASONS = {200: "OK", 201: "Created", 400: "Bad Request", 401: "Unauthorized", 403: "Forbidden", 404: "Not Found",
+                405: "Method Not Allowed", 409: "Conflict", 413: "Payload Too Large", 500: "Internal Server Error"}
+
+
+# Function to turn a product into JSON data
+def product_to_json(product):
+    return {'product_id': product.product_id, 'name': product.name, 'description': product.description,
+            'price': product.price, 'quantity': product.quantity}
+
+# Function to turn an order into JSON data, money amounts are strings so no precision is lost
+def order_to_json(order):
+    return {'order_id': order.order_id, 'date': order.date.isoformat(), 'total_price': str(order.total_price),
+            'lines': [{'product_id': line.product_id, 'name': line.name, 'unit_price': str(line.unit_price), 'quantity': line.quantity} for line in order.lines]}
+
+
+
+# StoreAPI class exposing the store's operations as JSON request handlers
+# Logging in returns a token that is sent back as "Authorization: Bearer <token>". Password hashing and file/database
+# writes run in a thread pool so they never hold up the event loop, everything else is quick in-memory work.
+class StoreAPI:
+    MAX_PAGE_SIZE = 100
+
+    def __init__(self, store, user_db, order_store=None, session_manager=None, session_ttl=3600):
+        self.store = store
+        self.user_db = user_db
+        self.order_store = order_store
+        self.session_manager = session_manager if session_manager is not None else SessionManager(store)
+        self.session_ttl = session_ttl
+        self.sessions = {}
+        self.routes = [
+            ('GET', r'/products', self.list_products),
+            ('GET', r'/products/(\d+)', self.get_product),
+            ('GET', r'/search', self.search),
+            ('GET', r'/autocomplete', self.autocomplete),
+            ('POST', r'/signup', self.signup),
+            ('POST', r'/login', self.login),
+            ('POST', r'/logout', self.logout),
+            ('GET', r'/cart', self.view_cart),
+            ('POST', r'/cart/add', self.cart_add),
+            ('POST', r'/cart/remove', self.cart_remove),
+            ('POST', r'/cart/batch', self.cart_batch),
+            ('POST', r'/cart/coupon', self.cart_coupon),
+            ('POST', r'/cart/checkout', self.checkout),
+            ('GET', r'/orders', self.orders),
+            ('GET', r'/metrics', self.get_metrics),
+            ('POST', r'/admin/products', self.admin_add_product),
+            ('DELETE', r'/admin/products/(\d+)', self.admin_remove_product),
+            ('PATCH', r'/admin/products/(\d+)', self.admin_update_product),
+        ]
+        self.routes = [(method, re.compile(pattern + '$'), handler) for method, pattern, handler in self.routes]
+
+# Method to run a blocking call in the thread pool
+    @staticmethod
+    async def blocking(func, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+# Method to answer a request, returns (status, JSON data)
+    async def dispatch(self, method, path, params=None, body=None, token=None):
+        allowed = False
+        for route_method, pattern, handler in self.routes:
+            match = pattern.match(path)
+            if match is None:
+                continue
+            allowed = True
+            if route_method != method:
+                continue
+            try:
+                return await handler(APIRequest(method, path, params or {}, body or {}, token, match.groups()))
+            except APIError as error:
+                return error.status, {'error': error.message}
+        if allowed:
+            return 405, {'error': f"{method} is not allowed on {path}"}
+        return 404, {'error': f"Nothing at {path}"}
+
+# Methods to read and check request values
+    @staticmethod
+    def int_value(values, name, default=None, minimum=None):
+        value = values.get(name, default)
+        if value is None:
+            raise APIError(400, f"{name} is required")
+        try:
+            if isinstance(value, (bool, float)):
+                raise ValueError
+            value = int(value)
+        except (TypeError, ValueError):
+            raise APIError(400, f"{name} must be a whole number")
+        if minimum is not None and value < minimum:
+            raise APIError(400, f"{name} must be at least {minimum}")
+        return value
+
+    @staticmethod
+    def str_value(values, name):
+        value = values.get(name)
+        if not isinstance(value, str) or not value.strip():
+            raise APIError(400, f"{name} is required")
+        return value
+
+    def user_for(self, request, role=None):
+        session = self.sessions.get(request.token) if request.token else None
+        if session is None or session[1] < time.monotonic():
+            self.sessions.pop(request.token, None)
+            raise APIError(401, "Log in first")
+        user = self.user_db.get_user(session[0])
+        if user is None:
+            raise APIError(401, "Log in first")
+        if role == 'Admin' and not isinstance(user, Admin):
+            raise APIError(403, "Only admins can do this")
+        if role == 'Customer' and not isinstance(user, Customer):
+            raise APIError(403, "Only customers can do this")
+        self.sessions[request.token] = (user.user_id, time.monotonic() + self.session_ttl)
+        return user
+
+# Method to drop the tokens of sessions that timed out, returns how many were dropped
+    def end_expired_sessions(self):
+        now = time.monotonic()
+        expired = [token for token, (user_id, expires) in list(self.sessions.items()) if expires < now]
+        for token in expired:
+            self.sessions.pop(token, None)
+        return len(expired)
+
+# Method to get the cart of the logged in customer
+    def cart_for(self, request):
+        return self.session_manager.touch(self.user_for(request, 'Customer'))
+
+    @staticmethod
+    def cart_to_json(cart):
+        return {'lines': [{'product': product_to_json(product), 'quantity': quantity} for product, quantity in cart.products],
+                'discount': str(from_cents(sum(cart.discount_breakdown()))), 'coupon': cart.coupon, 'total_price': str(cart.total_price)}
+
+    def batch_response(self, cart, result):
+        if not result.ok:
+            raise APIError(409, "; ".join(message for line_number, product_id, message in result.errors))
+        data = self.cart_to_json(cart)
+        if result.order is not None:
+            data['order'] = order_to_json(result.order)
+        return 200, data
+
+# Catalog handlers
+    async def list_products(self, request):
+        page_size = min(self.int_value(request.params, 'limit', 20, 1), self.MAX_PAGE_SIZE)
+        offset = self.int_value(request.params, 'offset', 0, 0)
+        sort_key = request.params.get('sort')
+        try:
+            products = self.store.renderer.page(self.store.products, page_size, offset, sort_key, request.params.get('order') == 'desc')
+        except ValueError as error:
+            raise APIError(400, str(error))
+        return 200, {'total': len(self.store.products), 'offset': offset, 'products': [product_to_json(product) for product in products]}
+
+    async def get_product(self, request):
+        product = self.store.get_product(int(request.match[0]))
+        if product is None:
+            raise APIError(404, "Product not found")
+        return 200, product_to_json(product)
+
+    async def search(self, request):
+        limit = min(self.int_value(request.params, 'limit', 10, 1), self.MAX_PAGE_SIZE)
+        return 200, {'products': [product_to_json(product) for product in self.store.search(request.params.get('q', ''), limit)]}
+
+    async def autocomplete(self, request):
+        limit = min(self.int_value(request.params, 'limit', 10, 1), self.MAX_PAGE_SIZE)
+        return 200, {'suggestions': self.store.autocomplete(request.params.get('q', ''), limit)}
+
+# Account handlers
+    async def signup(self, request):
+        username = self.str_value(request.body, 'username')
+        password = self.str_value(request.body, 'password')
+        for valid, message in (is_valid_username(username), is_valid_password(password)):
+            if not valid:
+                raise APIError(400, message)
+        for field in ('first_name', 'last_name'):
+            if not is_valid_input(self.str_value(request.body, field)):
+                raise APIError(400, f"{field} must not contain digits")
+        if self.user_db.username_exists(username):
+            raise APIError(409, "Username already exists")
+        customer = await self.blocking(Customer, self.user_db.allocate_user_id(), username, password, request.body['first_name'], request.body['last_name'], request.body.get('address', ''))
+        try:
+            await self.blocking(self.user_db.add_user, customer)
+        except ValueError:
+            raise APIError(409, "Username already exists")
+        return 201, {'user_id': customer.user_id}
+
+    async def login(self, request):
+        username = self.str_value(request.body, 'username')
+        password = self.str_value(request.body, 'password')
+        user = self.user_db.find_user(username, 'Admin' if request.body.get('admin') else 'Customer')
+        if user is None or not await self.blocking(user.check_password, password, self.user_db):
+            raise APIError(401, "Invalid credentials")
+        if isinstance(user, Customer):
+            await self.blocking(self.session_manager.login, user)
+        token = secrets.token_urlsafe(32)
+        self.sessions[token] = (user.user_id, time.monotonic() + self.session_ttl)
+        return 200, {'token': token, 'user_id': user.user_id}
+
+    async def logout(self, request):
+        user = self.user_for(request)
+        del self.sessions[request.token]
+        if isinstance(user, Customer) and user.user_id not in (user_id for user_id, expires_at in self.sessions.values()):
+            await self.blocking(self.session_manager.logout, user)
+        return 200, {}
+
+# Cart handlers
+    async def view_cart(self, request):
+        return 200, self.cart_to_json(self.cart_for(request))
+
+    async def cart_add(self, request):
+        cart = self.cart_for(request)
+        change = (self.int_value(request.body, 'product_id'), self.int_value(request.body, 'quantity', 1, 1))
+        return self.batch_response(cart, cart.apply_batch(self.store, [change]))
+
+    async def cart_remove(self, request):
+        cart = self.cart_for(request)
+        product_id = self.int_value(request.body, 'product_id')
+        if not cart.quantity_of(product_id):
+            raise APIError(404, "Product not found in cart")
+        quantity = min(self.int_value(request.body, 'quantity', cart.quantity_of(product_id), 1), cart.quantity_of(product_id))
+        return self.batch_response(cart, cart.apply_batch(self.store, [(product_id, -quantity)]))
+
+    async def cart_batch(self, request):
+        cart = self.cart_for(request)
+        changes = request.body.get('changes')
+        if not isinstance(changes, list) or not all(isinstance(change, list) and len(change) == 2 and
+                                                    all(isinstance(value, int) and not isinstance(value, bool) for value in change)
+                                                    for change in changes):
+            raise APIError(400, "changes must be a list of [product_id, quantity] pairs of whole numbers")
+        result = await self.blocking(cart.apply_batch, self.store, [tuple(change) for change in changes], bool(request.body.get('checkout')), self.order_store)
+        return self.batch_response(cart, result)
+
+    async def cart_coupon(self, request):
+        cart = self.cart_for(request)
+        if not cart.apply_coupon(self.str_value(request.body, 'code')):
+            raise APIError(404, "Unknown coupon code")
+        return 200, self.cart_to_json(cart)
+
+    async def checkout(self, request):
+        cart = self.cart_for(request)
+        if not cart.lines:
+            raise APIError(400, "The cart is empty")
+        order = await self.blocking(cart.checkout, self.order_store)
+        return 200, order_to_json(order)
+
+    async def orders(self, request):
+        user = self.user_for(request, 'Customer')
+        limit = min(self.int_value(request.params, 'limit', 20, 1), self.MAX_PAGE_SIZE)
+        orders = await self.blocking(lambda: list(itertools.islice(user.iter_shopping_history(self.order_store, limit), limit)))
+        return 200, {'orders': [order_to_json(order) for order in orders]}
+
+# Handler for the operation metrics (admins only), empty until metrics.enable() is called
+    async def get_metrics(self, request):
+        self.user_for(request, 'Admin')
+        return 200, {'enabled': metrics.enabled, 'operations': metrics.snapshot()}
 
-# Product class representing a product in the store
-class Product:
-    def __init__(self, product_id, name, price, description, quantity):
-        self.product_id = product_id
-        self.name = name
-        self.price = price
-        self.description = description
-        self.quantity = quantity
+# Admin handlers
+    async def admin_add_product(self, request):
+        admin = self.user_for(request, 'Admin')
+        price = request.body.get('price')
+        if isinstance(price, bool) or not isinstance(price, (int, float)) or price < 0:
+            raise APIError(400, "price must be a number of at least 0")
+        product_id = self.int_value(request.body, 'product_id', self.store.next_product_id(), 1)
+        if self.store.get_product(product_id) is not None:
+            raise APIError(409, "A product with this ID already exists")
+        product = Product(product_id, self.str_value(request.body, 'name'), price, request.body.get('description', ''), self.int_value(request.body, 'quantity', 0, 0))
+        return 201, product_to_json(admin.add_product(self.store, product))
 
-# Method to decrease the quantity of the product
-    def update_quantity(self, quantity):
-        self.quantity -= quantity            
+    async def admin_remove_product(self, request):
+        admin = self.user_for(request, 'Admin')
+        if admin.remove_product(self.store, int(request.match[0])) is None:
+            raise APIError(404, "Product not found")
+        return 200, {}
 
-# Method to increase the quantity of the product
-    def increase_quantity(self, quantity):
-        self.quantity += quantity
+    async def admin_update_product(self, request):
+        admin = self.user_for(request, 'Admin')
+        product = self.store.get_product(int(request.match[0]))
+        if product is None:
+            raise APIError(404, "Product not found")
+        price = request.body.get('price')
+        if price is not None and (isinstance(price, bool) or not isinstance(price, (int, float)) or price < 0):
+            raise APIError(400, "price must be a number of at least 0")
+        quantity = self.int_value(request.body, 'quantity', None, 0) if 'quantity' in request.body else None
+        name = self.str_value(request.body, 'name') if 'name' in request.body else None
+        description = request.body.get('description')
+        if description is not None and not isinstance(description, str):
+            raise APIError(400, "description must be text")
+        admin.update_product_info(self.store, product, name, price, description, quantity)
+        return 200, product_to_json(product)
 
-# Method to display the product information
-    def display_product_info(self):
-        return f"{Fore.CYAN}Product ID: {self.product_id}, Name: {self.name}, Description: {self.description}, Price: {self.price}, Quantity: {self.quantity}{Style.RESET_ALL}"
 
-# Method to compare two products by their ID (Operator overloading used)
-    def __eq__(self, other):
-        if isinstance(other, Product): 
-            return self.product_id == other.product_id
-        return False
-    
 
+# StoreServer class, a small asyncio HTTP/1.1 server answering JSON requests with a StoreAPI
+# Connections are kept alive between requests, one coroutine per connection so thousands of sessions can be open at once.
+class StoreServer:
+    MAX_BODY = 1 << 20
+    IDLE_TIMEOUT = 60
 
-# Abstract User class representing a user of the system
-class User(ABC):
-    def __init__(self, user_id, username, password, first_name, last_name, address):
-        self.user_id = user_id
-        self.username = username
-        self.password = password
-        self.first_name = first_name
-        self.last_name = last_name
-        self.address = address
-        self.shopping_history = []
+    def __init__(self, api):
+        self.api = api
+        self.server = None
+        self.connections = {}
 
-# Abstract method for user login, to be implemented by subclasses
-    @abstractmethod
-    def login(self, username, password):
-        pass
+# Method to start listening, port 0 picks a free port (see the port property)
+    async def start(self, host='127.0.0.1', port=8080):
+        self.server = await asyncio.start_server(self.handle_connection, host, port)
+        return self.server
 
-# Method to create a user account
-    def create_account(self):
-        pass
+    @property
+    def port(self):
+        return self.server.sockets[0].getsockname()[1]
 
-# Method to view shopping history of the user
-    def view_shopping_history(self):
-        for order in self.shopping_history:
-            print(order.view_order_details())
+# Method to stop listening, end the open connections and wait for the server to close
+    async def close(self):
+        self.server.close()
+        # Closing a connection ends its handler at the next read
+        for writer in self.connections.values():
+            writer.close()
+        await asyncio.gather(*self.connections, return_exceptions=True)
+        await self.server.wait_closed()
 
+    async def handle_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self.connections[task] = writer
+        try:
+            while True:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), self.IDLE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    break
+                if not request_line:
+                    break
+                keep_alive = await self.handle_request(request_line, reader, writer)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            self.connections.pop(task, None)
+            writer.close()
 
+# Method to read one request and write its response, returns True if the connection should stay open
+    async def handle_request(self, request_line, reader, writer):
+        try:
+            method, target, version = request_line.decode('latin-1').split()
+        except ValueError:
+            self.respond(writer, 400, {'error': "Malformed request line"}, False)
+            return False
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+        try:
+            length = int(headers.get('content-length') or 0)
+        except ValueError:
+            length = -1
+        if length < 0:
+            self.respond(writer, 400, {'error': "Malformed Content-Length"}, False)
+            return False
+        if length > self.MAX_BODY:
+            self.respond(writer, 413, {'error': "Request body too large"}, False)
+            return False
+        body = {}
+        if length:
+            try:
+                body = json.loads(await reader.readexactly(length))
+            except ValueError:
+                self.respond(writer, 400, {'error': "The body must be JSON"}, keep_alive)
+                return keep_alive
+            if not isinstance(body, dict):
+                self.respond(writer, 400, {'error': "The body must be a JSON object"}, keep_alive)
+                return keep_alive
+        path, _, query = target.partition('?')
+        params = dict(urllib_parse.parse_qsl(query))
+        authorization = headers.get('authorization', '')
+        token = authorization[7:] if authorization.startswith('Bearer ') else None
+        try:
+            status, data = await self.api.dispatch(method, path, params, body, token)
+        except Exception:
+            status, data = 500, {'error': "Internal server error"}
+        self.respond(writer, status, data, keep_alive)
+        return keep_alive
 
-# Customer class inheriting from User
-class Customer(User):
-    def __init__(self, user_id, username, password, first_name, last_name, address):
-        super().__init__(user_id, username, password, first_name, last_name, address)
-        self.cart = ShoppingCart(self)
+    @staticmethod
+    def respond(writer, status, data, keep_alive):
+        payload = json.dumps(data).encode()
+        head = (f"HTTP/1.1 {status} {HTTP_REASONS.get(status, '')}\r\nContent-Type: application/json\r\n"
+                f"Content-Length: {len(payload)}\r\nConnection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+        writer.write(head.encode('latin-1') + payload)
 
-# Method for customer login
-    def login(self, username, password):
-      while True:
-        if self.username == username and self.password == password:
-            print(Fore.GREEN + "Login successful!" + Style.RESET_ALL)
-            break
-        else:
-            print(Fore.RED + "Invalid credentials" + Style.RESET_ALL)
-            username = input("Enter your username: ")
-            password = input("Enter your password: ")
 
 
+# LocalClient class for calling a StoreAPI in the same process without any sockets (for tests and benchmarks)
+# It remembers the token of the last login, so calls after client.login(...) are made as that user.
+class LocalClient:
+    def __init__(self, api):
+        self.api = api
+        self.token = None
 
-# Admin class inheriting from User
-class Admin(User):
-    def __init__(self, user_id, username, password, first_name, last_name, address):
-        super().__init__(user_id, username, password, first_name, last_name, address)
+    async def request(self, method, path, body=None, **params):
+        return await self.api.dispatch(method, path, {key: str(value) for key, value in params.items()}, body, self.token)
 
-# Method for admin login
-    def login(self, username, password):
-      while True:
-        if self.username == username and self.password == password:
-            print(Fore.GREEN + "Admin login successful!" + Style.RESET_ALL)
-            break
-        else:
-            print(Fore.RED + "Invalid admin credentials" + Style.RESET_ALL)
-            username = input("Enter admin username: ")
-            password = input("Enter admin password: ")
+    async def login(self, username, password, admin=False):
+        status, data = await self.request('POST', '/login', {'username': username, 'password': password, 'admin': admin})
+        if status == 200:
+            self.token = data['token']
+        return status, data
 
-# Method to add a product to the store (that doesn't already exist) for users to purchase
-    def add_product(self, store, product):
-        store.products.append(product)
 
-# Method to remove a product from the store by ID
-    def remove_product(self, store, product_id):
-        store.products = [product for product in store.products if product.product_id != product_id]
 
-# Method to update product information
-    def update_product_info(self, product, name=None, price=None, description=None, quantity=None):
-        if name:
-            product.name = name
-        if price:
-            product.price = price
-        if description:
-            product.description = description
-        if quantity:
-            product.quantity = quantity
+# Function to run the store as an HTTP/JSON API server until it's stopped with Ctrl+C
+def serve(host='127.0.0.1', port=8080):
+    store, user_db, order_store, sessions, admin = setup_store()
+    api = StoreAPI(store, user_db, order_store, sessions)
 
+    async def end_idle_sessions():
+        while True:
+            await asyncio.sleep(60)
+            await api.blocking(sessions.evict_idle)
+            api.end_expired_sessions()
 
+    async def run():
+        server = StoreServer(api)
+        await server.start(host, port)
+        sweeper = asyncio.create_task(end_idle_sessions())
+        print(Fore.GREEN + f"Serving the store API on http://{host}:{server.port}" + Style.RESET_ALL)
+        try:
+            await server.server.serve_forever()
+        finally:
+            sweeper.cancel()
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sessions.close()
+        order_store.close()
+        user_db.close()
+        store.journal.close()
 
-# ShoppingCart class representing a shopping cart for a user
-class ShoppingCart:
-    def __init__(self, user):
-        self.cart_id = id(self)
-        self.user = user
-        self.products = []
-        self.total_price = 0.0
 
-# Method to add a product to the cart
-    def add_product(self, product, quantity=1):
-        if quantity > product.quantity:
-            print(Fore.RED + "Insufficient stock available" + Style.RESET_ALL)
+
+# CartStore class saving the carts of customers whose session ended, in a local SQLite database
+# A cart is saved as its (product ID, quantity) lines and handed back (and removed) once when the customer returns.
+class CartStore:
+    def __init__(self, filename):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS carts (user_id INTEGER PRIMARY KEY, lines TEXT NOT NULL, saved_at TEXT NOT NULL)")
+
+# Method to save a user's cart lines (a list of (product ID, quantity)), an empty list removes the saved cart
+    def save(self, user_id, lines):
+        with self.lock, self.connection:
+            if lines:
+                self.connection.execute("INSERT OR REPLACE INTO carts (user_id, lines, saved_at) VALUES (?, ?, ?)",
+                                        (user_id, json.dumps(lines), datetime.datetime.now().isoformat()))
+            else:
+                self.connection.execute("DELETE FROM carts WHERE user_id = ?", (user_id,))
+
+# Method to take a user's saved cart lines out of the store, returns an empty list if nothing was saved
+    def take(self, user_id):
+        with self.lock, self.connection:
+            row = self.connection.execute("SELECT lines FROM carts WHERE user_id = ?", (user_id,)).fetchone()
+            if row is None:
+                return []
+            self.connection.execute("DELETE FROM carts WHERE user_id = ?", (user_id,))
+        return [tuple(line) for line in json.loads(row[0])]
+
+# Method to close the database
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+
+# SessionManager class keeping the carts of logged in customers in memory, and only theirs
+# Sessions are kept in least recently used order. A session is ended when the customer logs out, when it has been idle
+# for idle_ttl seconds, or when there are more than max_sessions sessions or more than max_cart_lines cart lines in
+# memory (the least recently used sessions go first). Ending a session saves the cart in the CartStore and gives its
+# stock back, the cart is rebuilt (with whatever stock is still there) the next time the customer logs in.
+# A session whose cart reservations expire before idle_ttl is up is ended the same way, so the cart is saved first.
+class SessionManager:
+    def __init__(self, store, cart_store=None, max_sessions=10000, max_cart_lines=1000000, idle_ttl=1800):
+        self.store = store
+        self.cart_store = cart_store
+        self.max_sessions = max_sessions
+        self.max_cart_lines = max_cart_lines
+        self.idle_ttl = idle_ttl
+        self.sessions = OrderedDict()
+        self.lock = threading.RLock()
+
+# Method to start (or continue) a customer's session, returns the customer's cart
+    def login(self, customer):
+        with self.lock:
+            if customer.user_id in self.sessions:
+                return self.touch(customer)
+            cart = ShoppingCart(customer, store=self.store)
+            cart.on_expire = self.cart_expired
+            customer.cart = cart
+            customer.session_manager = self
+            self.sessions[customer.user_id] = [customer, time.monotonic()]
+            if self.cart_store is not None:
+                self.restore(cart, self.cart_store.take(customer.user_id))
+            self.evict_over_limits()
+            return cart
+
+# Method to put saved lines back into a cart, taking only as much as is still in stock
+# Returns the (product ID, quantity) lines or parts of lines that couldn't be restored
+    def restore(self, cart, lines):
+        missing = []
+        for product_id, quantity in lines:
+            product = self.store.get_product(product_id)
+            available = min(quantity, product.quantity) if product is not None else 0
+            if available > 0 and not cart.apply_batch(self.store, [(product_id, available)]).ok:
+                available = 0
+            if available < quantity:
+                missing.append((product_id, quantity - available))
+        return missing
+
+# Method to mark a customer's session as used now, returns the customer's cart (starting a session if needed)
+    def touch(self, customer):
+        with self.lock:
+            session = self.sessions.get(customer.user_id)
+            if session is None:
+                return self.login(customer)
+            session[1] = time.monotonic()
+            self.sessions.move_to_end(customer.user_id)
+            return customer.cart
+
+# Method to end a customer's session, saving the cart and giving its stock back
+    def logout(self, customer):
+        with self.lock:
+            if customer.user_id in self.sessions:
+                self.evict(customer.user_id)
+
+    def evict(self, user_id):
+        customer, last_used = self.sessions.pop(user_id)
+        cart = customer._cart
+        if cart is None:
             return
-        product.update_quantity(quantity)
-        self.products.append((product, quantity))
-        self.total_price += product.price * quantity
+        with cart.lock:
+            if self.cart_store is not None:
+                self.cart_store.save(user_id, [(product_id, line[1]) for product_id, line in cart.lines.items()])
+            cart.release_all()
+        customer.cart = None
 
-# Method to remove a product from the cart
-    def remove_product(self, product_id, quantity=None):
-        found_product = False
-        for i, (product, qty) in enumerate(self.products):
-            if product.product_id == product_id:
-                found_product = True
-                if quantity is None or quantity >= qty:
-                    self.total_price -= product.price * qty
-                    product.increase_quantity(qty)
-                    self.products.pop(i)
-                    if quantity and quantity > qty:
-                        print(Fore.YELLOW + f"You tried to remove {quantity}, but only {qty} were in the cart. All items removed." + Style.RESET_ALL)
+# Method called by the reservations when a session's cart has been left alone for too long, ends the session
+# (saving the cart before its stock goes back), returns True if it did
+    def cart_expired(self, cart, now):
+        with self.lock:
+            customer = cart.user
+            if customer.user_id not in self.sessions or customer._cart is not cart or not cart.reservations.is_expired(cart, now):
+                return False
+            self.evict(customer.user_id)
+            return True
+
+# Method to end the sessions that have been idle for longer than idle_ttl, returns how many were ended
+    def evict_idle(self, now=None):
+        now = time.monotonic() if now is None else now
+        ended = 0
+        with self.lock:
+            while self.sessions:
+                user_id, (customer, last_used) = next(iter(self.sessions.items()))
+                if last_used + self.idle_ttl > now:
+                    break
+                self.evict(user_id)
+                ended += 1
+        return ended
+
+# Method to end the least recently used sessions while there are too many sessions or cart lines in memory
+    def evict_over_limits(self):
+        with self.lock:
+            lines = self.cart_lines()
+            while len(self.sessions) > self.max_sessions or (len(self.sessions) > 1 and lines > self.max_cart_lines):
+                user_id = next(iter(self.sessions))
+                cart = self.sessions[user_id][0]._cart
+                lines -= len(cart.lines) if cart is not None else 0
+                self.evict(user_id)
+
+# Method to count the cart lines held in memory by all sessions
+    def cart_lines(self):
+        return sum(len(customer._cart.lines) for customer, last_used in self.sessions.values() if customer._cart is not None)
+
+# Method to end every session, e.g. when the program exits
+    def close(self):
+        with self.lock:
+            for user_id in list(self.sessions):
+                self.evict(user_id)
+
+
+
+# ShardWorker class, one process of a ShardedStore owning every product with product_id % shards == index and every
+# user with user_id % shards == index, each with its own Store, UserDatabase, OrderStore and InventoryJournal on disk.
+# It answers (operation, arguments) messages from the routers one at a time (only the cart reaper runs beside it).
+# Carts are kept per shard too: a customer's cart is the lines it holds on every shard, taking stock from local products.
+# A checkout prepared for longer than prepare_timeout can't be recorded any more. Once it has waited twice as long the
+# shard asks the user's shard (through peers, a pipe to every other shard) whether the order was recorded: it commits
+# if it was and aborts if it wasn't, and after answering no the user's shard never records it. So a checkout whose
+# router died is settled the same way on every shard. Prepares are journaled, after a crash a shard settles the
+# checkouts it had prepared the same way.
+class ShardWorker:
+    def __init__(self, index, shards, directory, prepare_timeout=30, peers=None):
+        self.index = index
+        self.shards = shards
+        self.prepare_timeout = prepare_timeout
+        self.peers = peers or {}
+        directory = os.path.join(directory, f"shard-{index}")
+        os.makedirs(directory, exist_ok=True)
+        self.store = Store()
+        self.store.journal = InventoryJournal(os.path.join(directory, 'inventory'), self.store)
+        self.store.journal.open()
+        self.user_db = UserDatabase(os.path.join(directory, 'users.txt'))
+        self.order_store = OrderStore(os.path.join(directory, 'orders.db'))
+        self.reservations = InventoryReservations()
+        self.reservations.start_reaper()
+        self.carts = {}
+        self.prepared = {}
+        self.asked = {}
+        self.refused = set()
+        # Checkouts journaled as prepared before a restart have no cart any more, they are settled right away
+        for txn_id, (user_id, rows) in self.store.journal.prepared.items():
+            self.prepared[txn_id] = (user_id, None, {}, -math.inf)
+
+# Method to answer messages until a 'stop' message comes in, messages from other shards get no reply
+    def serve(self, connections):
+        connections = list(connections)
+        peer_shards = {connection: shard for shard, connection in self.peers.items()}
+        while connections:
+            self.settle_stale()
+            for connection in lazy_import('multiprocessing.connection').wait(connections + list(peer_shards), self.prepare_timeout):
+                try:
+                    operation, args = connection.recv()
+                except EOFError:
+                    if connection in peer_shards:
+                        del peer_shards[connection]
+                    else:
+                        connections.remove(connection)
+                    continue
+                if connection in peer_shards:
+                    self.peer_message(peer_shards[connection], operation, args)
+                    continue
+                try:
+                    reply = ('ok', getattr(self, 'op_' + operation)(*args))
+                except Exception as error:
+                    reply = ('error', f"{type(error).__name__}: {error}")
+                connection.send(reply)
+                if operation == 'stop':
+                    return
+
+# Method to settle the checkouts that were prepared too long ago, asking the user's shard how they ended
+# (again every prepare_timeout seconds while it doesn't answer)
+    def settle_stale(self, now=None):
+        now = time.monotonic() if now is None else now
+        for txn_id, (user_id, cart, lines, deadline) in list(self.prepared.items()):
+            if deadline + self.prepare_timeout >= now or self.asked.get(txn_id, -math.inf) + self.prepare_timeout >= now:
+                continue
+            user_shard = user_id % self.shards
+            if user_shard == self.index:
+                self.op_outcome(txn_id)
+            elif user_shard in self.peers:
+                self.asked[txn_id] = now
+                self.peers[user_shard].send(('outcome', (txn_id,)))
+
+# Method to handle a message from another shard: a question about a checkout's outcome or its answer
+    def peer_message(self, shard, operation, args):
+        if operation == 'outcome':
+            txn_id, = args
+            self.peers[shard].send(('settle', (txn_id, self.op_outcome(txn_id))))
+        elif operation == 'settle':
+            txn_id, committed = args
+            self.asked.pop(txn_id, None)
+            if committed:
+                self.op_commit(txn_id)
+            else:
+                self.op_abort(txn_id)
+
+# Method (on the user's shard) to decide how a checkout ended: True if its order was recorded. Otherwise the checkout
+# is aborted here and its order refused from now on, so the answer can't change. Returns the outcome.
+    def op_outcome(self, txn_id):
+        if self.order_store.order_id_for_txn(txn_id) is not None:
+            self.op_commit(txn_id)
+            return True
+        self.refused.add(txn_id)
+        self.op_abort(txn_id)
+        return False
+
+    def cart_for(self, user_id):
+        cart = self.carts.get(user_id)
+        if cart is None:
+            cart = self.carts[user_id] = ShoppingCart(user_id, self.reservations, store=self.store)
+        return cart
+
+    @staticmethod
+    def line_rows(lines):
+        return [(product.product_id, product.name, unit_cents, quantity) for product, quantity, unit_cents in lines.values()]
+
+# Product operations, products travel as (product_id, name, price, description, quantity) tuples
+    def op_add_products(self, rows):
+        for row in rows:
+            self.store.add_product(Product(*row))
+        return len(rows)
+
+    def op_remove_product(self, product_id):
+        return self.store.remove_product(product_id) is not None
+
+    def op_get_product(self, product_id):
+        product = self.store.get_product(product_id)
+        if product is None:
+            return None
+        return (product.product_id, product.name, product.price, product.description, product.quantity)
+
+    def op_product_count(self):
+        return len(self.store.products)
+
+    def op_search(self, query, limit):
+        return [(score, (product.product_id, product.name, product.price, product.description, product.quantity))
+                for score, product in self.store.search_index.search_scored(query, limit)]
+
+# User operations (only sent to the user's own shard), a new user gets an ID that maps back to this shard
+    def op_signup(self, username, password, first_name, last_name, address):
+        with self.user_db.lock:
+            if self.user_db.username_exists(username):
+                raise ValueError(f"Username {username} already exists")
+            user_id = self.user_db.next_user_id + (self.index - self.user_db.next_user_id) % self.shards
+            self.user_db.next_user_id = user_id + 1
+            self.user_db.add_user(Customer(user_id, username, password, first_name, last_name, address))
+        return user_id
+
+    def op_user_exists(self, user_id):
+        return self.user_db.get_user(user_id) is not None
+
+    def op_login(self, username, password):
+        user = self.user_db.find_user(username, 'Customer')
+        if user is None or not user.check_password(password, self.user_db):
+            return None
+        return user.user_id
+
+    def op_orders(self, user_id, limit):
+        user = self.user_db.get_user(user_id)
+        if user is None:
+            return []
+        orders = itertools.islice(user.iter_shopping_history(self.order_store, limit), limit)
+        return [(order.order_id, order.date, [tuple(line) for line in order.lines], order.total_price) for order in orders]
+
+# Cart operations: changes is a list of (product ID, quantity) for products of this shard, applied all or nothing
+    def op_cart_change(self, user_id, changes):
+        result = self.cart_for(user_id).apply_batch(self.store, changes)
+        return result.ok, result.errors
+
+    def op_cart(self, user_id):
+        cart = self.carts.get(user_id)
+        return self.line_rows(cart.lines) if cart is not None else []
+
+# Two-phase checkout. prepare moves the user's lines on this shard out of the cart into the transaction, keeping
+# their stock taken, and journals them before it returns them (the vote is an error reply). commit makes the sale
+# final, abort puts the lines back in the cart. The user's shard also checks the user exists and records the order
+# with the checkout's txn_id, the commit point, which is only accepted while the checkout hasn't timed out and the
+# shard hasn't answered that it aborted.
+    def op_prepare(self, txn_id, user_id, user_shard):
+        if user_shard and self.user_db.get_user(user_id) is None:
+            raise ValueError(f"No user with ID {user_id}")
+        if txn_id in self.refused:
+            raise ValueError(f"Checkout {txn_id} was aborted")
+        deadline = time.monotonic() + self.prepare_timeout
+        cart = self.carts.get(user_id)
+        if cart is None or not cart.lines:
+            if user_shard:
+                self.prepared[txn_id] = (user_id, None, {}, deadline)
+            return []
+        with cart.lock:
+            lines, cart.lines = cart.lines, {}
+            cart.total_cents = 0
+            cart._reprice_all()
+            self.reservations.touch(cart)
+            self.store.journal.prepare(txn_id, user_id, lines.values())
+        self.prepared[txn_id] = (user_id, cart, lines, deadline)
+        self.store.journal.barrier()
+        return self.line_rows(lines)
+
+    def op_commit(self, txn_id):
+        self.prepared.pop(txn_id, None)
+        self.asked.pop(txn_id, None)
+        if self.store.journal.end_prepare(txn_id, True) is not None:
+            self.store.journal.barrier()
+
+    def op_abort(self, txn_id):
+        user_id, cart, lines, deadline = self.prepared.pop(txn_id, (None, None, None, None))
+        self.asked.pop(txn_id, None)
+        self.store.journal.end_prepare(txn_id, False, to_cart=cart is not None)
+        if cart is None:
+            return
+        with cart.lock:
+            for product_id, (product, quantity, unit_cents) in lines.items():
+                line = cart.lines.get(product_id)
+                if line is None:
+                    cart.lines[product_id] = [product, quantity, unit_cents]
                 else:
-                    self.total_price -= product.price * quantity
-                    product.increase_quantity(quantity)
-                    self.products[i] = (product, qty - quantity)
-                break
-        if not found_product:
-            print(Fore.RED + "Product not found in cart" + Style.RESET_ALL)
+                    line[1] += quantity
+                cart.total_cents += unit_cents * quantity
+            cart._reprice_all()
+            self.reservations.touch(cart)
 
-# Method to view the cart contents
-    def view_cart(self):
-        for product, quantity in self.products:
-            print(f"{product.display_product_info()}, Quantity you've added: {quantity}")
-        print(f"{Fore.YELLOW}Total price: {self.total_price}{Style.RESET_ALL}")
-
-# Method to checkout the cart and create an order
-    def checkout(self):
-        order = Order(self.user, self.products, self.total_price, datetime.datetime.now())
-        self.user.shopping_history.append(order)
-        self.products = []
-        self.total_price = 0.0
-        return order
+    def op_record_order(self, txn_id, user_id, rows, date):
+        owner, cart, lines, deadline = self.prepared.get(txn_id, (None, None, None, None))
+        if deadline is None or deadline < time.monotonic() or txn_id in self.refused:
+            raise ValueError(f"Checkout {txn_id} timed out")
+        if cart is None:
+            del self.prepared[txn_id]
+        lines = [OrderLine(*row) for row in rows]
+        order = Order(self.user_db.get_user(user_id), lines, from_cents(pricing_engine.lines_total_cents(lines)), date)
+        self.order_store.add_order(order, txn_id)
+        # The recorded order is the commit point of the checkout, so it has to be on disk before anyone is told
+        self.order_store.flush()
+        return order.order_id
 
+    def op_stop(self):
+        self.reservations.stop_reaper()
+        for cart in list(self.carts.values()):
+            cart.release_all()
+        self.order_store.close()
+        self.user_db.close()
+        self.store.journal.close()
 
 
-# Order class representing an order made by a user
-class Order:
-    def __init__(self, user, products, total_price, date):
-        self.order_id = id(self)
-        self.user = user
-        self.products = products
-        self.total_price = total_price
-        self.date = date
+# Function run by every shard process
+def run_shard(index, shards, directory, connections, prepare_timeout=30, peers=None):
+    ShardWorker(index, shards, directory, prepare_timeout, peers).serve(connections)
 
-# Method to view order details
-    def view_order_details(self):
-        details = f"{Fore.MAGENTA}Order ID: {self.order_id}, Date: {self.date}{Style.RESET_ALL}\n"
-        for product, quantity in self.products:
-            details += f"{product.display_product_info()}, Quantity you've purchased: {quantity}\n"
-        details += f"{Fore.YELLOW}Total price: {self.total_price}{Style.RESET_ALL}"
-        return details
 
 
+# ShardError exception, raised by a ShardRouter when a shard answers a call with an error
+class ShardError(Exception):
+    pass
 
-# Store class representing the online store
-class Store:
-    def __init__(self):
-        self.products = []
 
-    def display_all_products(self):
-        for product in self.products:
-            print(product.display_product_info())
+# An order placed through a ShardRouter
+ShardedOrder = namedtuple('ShardedOrder', ['order_id', 'user_id', 'lines', 'total_price', 'date'])
 
-    def search_product(self, name):
-        for product in self.products:
-            if product.name == name:
-                return product
-        return None
 
+# ShardRouter class sending calls to the shard owning each product or user, products by product_id % shards and
+# users by user_id % shards (a new user is placed by a hash of the username so signup and login find the same shard).
+# A router only remembers which user IDs it has already checked, but it has one pipe per shard and sends one call at a
+# time, give every thread or process its own router. Checkouts spanning several shards are made consistent with
+# two-phase commit.
+class ShardRouter:
+    def __init__(self, router_id, connections):
+        self.router_id = router_id
+        self.connections = connections
+        self.shards = len(connections)
+        self.lock = threading.Lock()
+        self.txn_ids = itertools.count(1)
+        self.known_users = set()
 
+# Method to send calls ({shard: (operation, args)}) to several shards at once, returns {shard: ('ok'/'error', value)}
+    def call_many(self, calls):
+        with self.lock:
+            for shard, message in calls.items():
+                self.connections[shard].send(message)
+            return {shard: self.connections[shard].recv() for shard in calls}
 
+# Method to call one shard, raises ShardError if the shard answers with an error
+    def call(self, shard, operation, *args):
+        status, value = self.call_many({shard: (operation, args)})[shard]
+        if status == 'error':
+            raise ShardError(value)
+        return value
 
-# UserDatabase class for managing user data
-class UserDatabase:
-    def __init__(self, filename):
-        self.filename = filename
-        self.users = self.load_users()
+    def shard_of_product(self, product_id):
+        return product_id % self.shards
 
-# Method to load users from a file
-    def load_users(self):
-        users = []
-        try:
-            with open(self.filename, 'r') as file:
-                for line in file:
-                    user_data = eval(line.strip())
-                    if user_data['type'] == 'Admin':
-                        user = Admin(user_data['user_id'], user_data['username'], user_data['password'], user_data['first_name'], user_data['last_name'], user_data['address'])
-                    else:
-                        user = Customer(user_data['user_id'], user_data['username'], user_data['password'], user_data['first_name'], user_data['last_name'], user_data['address'])
-                    users.append(user)
-        except FileNotFoundError:
-            pass
-        return users
+    def shard_of_user(self, user_id):
+        return user_id % self.shards
 
-# Method to save users to a file
-    def save_users(self):
-        with open(self.filename, 'w') as file:
-            for user in self.users:
-                user_data = {
-                    'type': 'Admin' if isinstance(user, Admin) else 'Customer',
-                    'user_id': user.user_id,
-                    'username': user.username,
-                    'password': user.password,
-                    'first_name': user.first_name,
-                    'last_name': user.last_name,
-                    'address': user.address
-                }
-                file.write(str(user_data) + '\n')
-
- # Method to add a user to the database
-    def add_user(self, user):
-        self.users.append(user)
-        self.save_users()
+    def shard_of_username(self, username):
+        return zlib.crc32(username.encode()) % self.shards
 
-# Method to check if a username already exists
-    def username_exists(self, username):
-        return any(user.username == username for user in self.users)
+# Product methods
+    def add_products(self, products):
+        rows = {}
+        for product in products:
+            rows.setdefault(self.shard_of_product(product.product_id), []).append(
+                (product.product_id, product.name, product.price, product.description, product.quantity))
+        replies = self.call_many({shard: ('add_products', (shard_rows,)) for shard, shard_rows in rows.items()})
+        return sum(value for status, value in replies.values() if status == 'ok')
 
+    def remove_product(self, product_id):
+        return self.call(self.shard_of_product(product_id), 'remove_product', product_id)
 
-# Helper functions for user input and validation
+    def get_product(self, product_id):
+        row = self.call(self.shard_of_product(product_id), 'get_product', product_id)
+        return Product(*row) if row is not None else None
 
+    def product_count(self):
+        return sum(value for status, value in self.call_many({shard: ('product_count', ()) for shard in range(self.shards)}).values())
 
-# Function to check if the input is valid (not empty and does not contain digits)
-def is_valid_input(value):
-    return value.strip() and not any(char.isdigit() for char in value)
+# Method to search every shard and merge their best matches (each shard scores with its own word statistics)
+    def search(self, query, limit=10):
+        replies = self.call_many({shard: ('search', (query, limit)) for shard in range(self.shards)})
+        matches = [match for status, value in replies.values() if status == 'ok' for match in value]
+        return [Product(*row) for score, row in heapq.nsmallest(limit, matches, key=lambda match: (-match[0], match[1][1]))]
 
-# Function to get valid input from the user
-def get_valid_input(prompt):
-    while True:
-        value = input(prompt)
-        if is_valid_input(value):
-            return value
-        else:
-            print(Fore.RED + "Invalid input. Please enter a valid name." + Style.RESET_ALL)
+# User methods, login returns the user ID or None
+    def signup(self, username, password, first_name, last_name, address):
+        return self.call(self.shard_of_username(username), 'signup', username, password, first_name, last_name, address)
 
-# Function to make sure the user enters a valid password
-def is_valid_password(password):
-    if len(password) < 8:
-        return False, "Password must be at least 8 characters long"
-    if not re.search(r"[A-Z]", password):
-        return False, "Password must contain at least one uppercase letter"
-    if not re.search(r"[0-9]", password):
-        return False, "Password must contain at least one number"
-    return True, ""
+    def login(self, username, password):
+        return self.call(self.shard_of_username(username), 'login', username, password)
 
-# Function to validate a username based on specific criteria
-def is_valid_username(username):
-    if len(username) < 8:
-        return False, "Username must be at least 8 characters long."
-    if not any(char.isalpha() for char in username):
-        return False, "Username must contain at least one alphabet."
-    if not re.search(r"[0-9]", username):
-        return False, "Username must contain at least one number"
-    return True, ""
+    def orders(self, user_id, limit=20):
+        return [ShardedOrder(order_id, user_id, tuple(OrderLine(*row) for row in lines), total_price, date)
+                for order_id, date, lines, total_price in self.call(self.shard_of_user(user_id), 'orders', user_id, limit)]
 
-# Function to clear the terminal screen for a cleaner output
-def clear_terminal():
-    os.system('cls' if os.name == 'nt' else 'clear')
+# Method to check with the user's shard that a user exists (once per user), raises ShardError if not
+    def check_user(self, user_id):
+        if user_id in self.known_users:
+            return
+        if not self.call(self.shard_of_user(user_id), 'user_exists', user_id):
+            raise ShardError(f"No user with ID {user_id}")
+        self.known_users.add(user_id)
 
-# Function to prompt the user with a yes/no question and validate the response
-def prompt_yes_no(message):
-    while True:
-        response = input(message).strip().lower()
-        if response in ['yes', 'no']:
-            return response == 'yes'
-        else:
-            print(Fore.RED + "Invalid input. Please enter 'yes' or 'no'." + Style.RESET_ALL)
+# Cart methods, add_to_cart returns True if the stock could be taken (both raise ShardError for an unknown user)
+    def add_to_cart(self, user_id, product_id, quantity=1):
+        self.check_user(user_id)
+        ok, errors = self.call(self.shard_of_product(product_id), 'cart_change', user_id, [(product_id, quantity)])
+        return ok
 
+    def remove_from_cart(self, user_id, product_id, quantity):
+        self.check_user(user_id)
+        ok, errors = self.call(self.shard_of_product(product_id), 'cart_change', user_id, [(product_id, -quantity)])
+        return ok
 
+    def view_cart(self, user_id):
+        replies = self.call_many({shard: ('cart', (user_id,)) for shard in range(self.shards)})
+        return [OrderLine(*row) for status, value in replies.values() if status == 'ok' for row in value]
 
+# Method to checkout a user's cart across all shards, returns the ShardedOrder or None when the cart is empty
+# Phase one prepares every shard (a shard that can't prepare votes no by answering with an error), the order is
+# then recorded on the user's shard, which is the commit point, and phase two tells the shards holding lines to commit.
+# If anything fails before the commit point every prepared shard is told to abort and the lines go back to the cart.
+    def checkout(self, user_id):
+        txn_id = f"{self.router_id}:{next(self.txn_ids)}"
+        user_shard = self.shard_of_user(user_id)
+        votes = self.call_many({shard: ('prepare', (txn_id, user_id, shard == user_shard)) for shard in range(self.shards)})
+        participants = [shard for shard, (status, value) in votes.items() if status == 'ok' and value]
+        rows = [row for shard in participants for row in votes[shard][1]]
+        failed = [value for status, value in votes.values() if status == 'error']
+        if failed or not rows:
+            self.call_many({shard: ('abort', (txn_id,)) for shard in participants})
+            if failed:
+                raise ShardError(failed[0])
+            return None
+        date = datetime.datetime.now()
+        try:
+            order_id = self.call(user_shard, 'record_order', txn_id, user_id, rows, date)
+        except ShardError:
+            self.call_many({shard: ('abort', (txn_id,)) for shard in participants})
+            raise
+        self.call_many({shard: ('commit', (txn_id,)) for shard in participants})
+        lines = tuple(OrderLine(*row) for row in rows)
+        return ShardedOrder(order_id, user_id, lines, from_cents(pricing_engine.lines_total_cents(lines)), date)
 
-# Main function to run the store application
-def main():
+
+
+# ShardedStore class running the store as several worker processes (one per core by default) so it isn't held to one
+# core by the GIL. start() forks the shards, each keeping its data under directory/shard-<index>, and makes `routers`
+# routers (one per client thread or process, router(i) gets one). Start it before the parent starts any threads,
+# and fork any client processes after start() so they inherit their router's pipes.
+class ShardedStore:
+    def __init__(self, directory='shards', shards=None, routers=1, prepare_timeout=30):
+        self.directory = directory
+        self.prepare_timeout = prepare_timeout
+        self.shards = shards or os.cpu_count() or 1
+        self.router_count = routers
+        self.processes = []
+        self.routers = []
+
+    def start(self):
+        context = multiprocessing.get_context('fork')
+        pipes = [[context.Pipe() for shard in range(self.shards)] for router in range(self.router_count)]
+        # One pipe between every two shards, peer_pipes[a][b] is shard a's end of the pipe to shard b
+        peer_pipes = [{} for shard in range(self.shards)]
+        for a, b in itertools.combinations(range(self.shards), 2):
+            peer_pipes[a][b], peer_pipes[b][a] = context.Pipe()
+        for shard in range(self.shards):
+            process = context.Process(target=run_shard, name=f"shard-{shard}", daemon=True,
+                                      args=(shard, self.shards, self.directory, [pipes[router][shard][1] for router in range(self.router_count)],
+                                            self.prepare_timeout, peer_pipes[shard]))
+            process.start()
+            self.processes.append(process)
+        for router_pipes in pipes:
+            for parent_end, child_end in router_pipes:
+                child_end.close()
+        for shard_pipes in peer_pipes:
+            for connection in shard_pipes.values():
+                connection.close()
+        self.routers = [ShardRouter(router, [parent_end for parent_end, child_end in router_pipes]) for router, router_pipes in enumerate(pipes)]
+        return self
+
+    def router(self, index=0):
+        return self.routers[index]
+
+# Method to stop every shard, carts still open give their stock back and the journals take a final snapshot
+    def stop(self):
+        if not self.processes:
+            return
+        router = self.routers[0]
+        router.call_many({shard: ('stop', ()) for shard in range(self.shards)})
+        for process in self.processes:
+            process.join()
+        self.processes = []
+
+
+
+# Function to set up the store, the user database and the order store, used by both the menu and the API server
+def setup_store():
     store = Store()
     user_db = UserDatabase('users.txt')
+    order_store = OrderStore('orders.db')
+    sessions = SessionManager(store, CartStore('carts.db'))
 
-# Create an admin user (happens each time you run the code)
-    admin = Admin(1, "admin1", "Admin@123", "Admin", "User", "123 Admin St")
-    user_db.add_user(admin)
+# Create the admin user the first time the code is run
+    admin = user_db.find_user("admin1", 'Admin')
+    if admin is None:
+        admin = Admin(user_db.allocate_user_id() if user_db.get_user(1) else 1, "admin1", "Admin@123", "Admin", "User", "123 Admin St")
+        user_db.add_user(admin)
 
 # List of products we've used (not the brightest of ideas) but its something :)
     products = [
@@ -333,10 +3997,26 @@ def main():
         Product(10, "Mouse", 30, "Wireless mouse", 50)
     ]
 
-    for product in products:
-        admin.add_product(store, product)
+# Products and stock are kept in the inventory journal, the list above is only used the first time
+    store.journal = InventoryJournal('inventory', store)
+    store.journal.open()
+    if store.journal.is_empty():
+        for product in products:
+            admin.add_product(store, product)
+
+# Promotions are read from promotions.json when there is one
+    if os.path.exists('promotions.json'):
+        configure_pricing(*load_pricing_rules('promotions.json'))
+
+# Carts left alone for too long give their stock back
+    inventory_reservations.start_reaper()
+    return store, user_db, order_store, sessions, admin
+
 
-    
+
+# Main function to run the store application
+def main():
+    store, user_db, order_store, sessions, admin = setup_store()
 
     while True:
         clear_terminal()
@@ -352,8 +4032,6 @@ def main():
 
 
         if choice == '1':
-            user_id = len(user_db.users) + 1
-
 # Get and validate username
             while True:
                 username = input("Enter username: ")
@@ -381,9 +4059,12 @@ def main():
             last_name = get_valid_input("Enter last name: ")
             address = input("Enter address: ")
 
-            customer = Customer(user_id, username, password, first_name, last_name, address)
-            user_db.add_user(customer)
-            print(Fore.GREEN + "Customer account created successfully" + Style.RESET_ALL)
+            customer = Customer(user_db.allocate_user_id(), username, password, first_name, last_name, address)
+            try:
+                user_db.add_user(customer)
+                print(Fore.GREEN + "Customer account created successfully" + Style.RESET_ALL)
+            except ValueError:
+                print(Fore.RED + "Username already exists. Please try again with a different username." + Style.RESET_ALL)
             input("Press Enter to continue...")
 
 
@@ -392,9 +4073,10 @@ def main():
             # Customer login process
             username = input("Enter username: ")
             password = input("Enter password: ")
-            customer = next((u for u in user_db.users if isinstance(u, Customer) and u.username == username), None)
+            customer = user_db.find_user(username, 'Customer')
             if customer:
-                customer.login(username, password)
+                customer.login(username, password, user_db)
+                sessions.login(customer)
                 input("Press Enter to continue...")
             else:
                 print(Fore.RED + "Customer not found" + Style.RESET_ALL)
@@ -411,21 +4093,25 @@ def main():
                 print(Fore.YELLOW + "4. Remove Product from Cart" + Style.RESET_ALL)
                 print(Fore.YELLOW + "5. Checkout" + Style.RESET_ALL)
                 print(Fore.YELLOW + "6. View Shopping History" + Style.RESET_ALL)
-                print(Fore.YELLOW + "7. Logout" + Style.RESET_ALL)
+                print(Fore.YELLOW + "7. Search Products" + Style.RESET_ALL)
+                print(Fore.YELLOW + "8. Apply Coupon" + Style.RESET_ALL)
+                print(Fore.YELLOW + "9. Logout" + Style.RESET_ALL)
                 customer_choice = input("Enter your choice: ")
 
 
+                # The cart is fetched through the session manager for every action, a session that ended meanwhile
+                # (idle or expired) is started again with the cart it saved
                 if customer_choice == '1':
-                    customer.cart.view_cart()
+                    sessions.touch(customer).view_cart()
                     input("Press Enter to continue...")
 
                 elif customer_choice == '2':
-                    store.display_all_products()
+                    browse_products(store)
                     input("Press Enter to continue...")
 
                 elif customer_choice == '3':
                     while True:
-                        store.display_all_products()
+                        browse_products(store)
                         try:
                             product_id = int(input("Enter product ID to add: "))
                             quantity = int(input("Enter quantity: "))
@@ -433,9 +4119,9 @@ def main():
                             print(Fore.RED + "Invalid input. Please enter numeric values for product ID and quantity." + Style.RESET_ALL)
                             input("Press Enter to continue...")
                             continue
-                        product = next((p for p in store.products if p.product_id == product_id), None)
+                        product = store.get_product(product_id)
                         if product:
-                            customer.cart.add_product(product, quantity)
+                            sessions.touch(customer).add_product(product, quantity)
                         else:
                             print(Fore.RED + "Product not found" + Style.RESET_ALL)
                         if not prompt_yes_no("Do you want to add more products? (yes/no): "):
@@ -445,7 +4131,7 @@ def main():
                     
                 elif customer_choice == '4':
                     while True:
-                        customer.cart.view_cart()
+                        sessions.touch(customer).view_cart()
                         try:
                             product_id = int(input("Enter product ID to remove: "))
                             quantity = int(input("Enter quantity to remove: "))
@@ -453,25 +4139,50 @@ def main():
                             print(Fore.RED + "Invalid input. Please enter numeric values for product ID and quantity." + Style.RESET_ALL)
                             input("Press Enter to continue...")
                             continue
-                        customer.cart.remove_product(product_id, quantity)
+                        sessions.touch(customer).remove_product(product_id, quantity)
                         if not prompt_yes_no("Do you want to remove more products? (yes/no): "):
                             break
                     input("Press Enter to continue...")
 
 
                 elif customer_choice == '5':
-                    order = customer.cart.checkout()
+                    order = sessions.touch(customer).checkout(order_store)
                     print(Fore.GREEN + "Order placed successfully" + Style.RESET_ALL)
                     print(order.view_order_details())
                     input("Press Enter to continue...")
 
 
                 elif customer_choice == '6':
-                    customer.view_shopping_history()
+                    customer.view_shopping_history(order_store)
                     input("Press Enter to continue...")
 
 
                 elif customer_choice == '7':
+                    query = input("Enter search words: ")
+                    results = store.search(query)
+                    if results:
+                        for product in results:
+                            print(product.display_product_info())
+                    else:
+                        suggestions = store.autocomplete(tokenize(query)[-1]) if tokenize(query) else []
+                        print(Fore.RED + "No products matched your search" + Style.RESET_ALL)
+                        if suggestions:
+                            print(Fore.YELLOW + "Did you mean: " + ", ".join(suggestions) + Style.RESET_ALL)
+                    input("Press Enter to continue...")
+
+
+                elif customer_choice == '8':
+                    code = input("Enter coupon code: ")
+                    if sessions.touch(customer).apply_coupon(code):
+                        print(Fore.GREEN + "Coupon applied" + Style.RESET_ALL)
+                        sessions.touch(customer).view_cart()
+                    else:
+                        print(Fore.RED + "Unknown coupon code" + Style.RESET_ALL)
+                    input("Press Enter to continue...")
+
+
+                elif customer_choice == '9':
+                    sessions.logout(customer)
                     break
                 else:
                     print(Fore.RED + "Invalid choice" + Style.RESET_ALL)
@@ -483,9 +4194,9 @@ def main():
             # Admin login process
             username = input("Enter admin username: ")
             password = input("Enter admin password: ")
-            admin = next((u for u in user_db.users if isinstance(u, Admin) and u.username == username), None)
+            admin = user_db.find_user(username, 'Admin')
             if admin:
-                admin.login(username, password)
+                admin.login(username, password, user_db)
                 input("Press Enter to continue...")
             else:
                 print(Fore.RED + "Admin not found" + Style.RESET_ALL)
@@ -500,12 +4211,16 @@ def main():
                 print(Fore.MAGENTA + "2. Remove Product" + Style.RESET_ALL)
                 print(Fore.MAGENTA + "3. Update Product Info" + Style.RESET_ALL)
                 print(Fore.MAGENTA + "4. View All Products" + Style.RESET_ALL)
-                print(Fore.MAGENTA + "5. Logout" + Style.RESET_ALL)
+                print(Fore.MAGENTA + "5. Catalog Report" + Style.RESET_ALL)
+                print(Fore.MAGENTA + "6. Bulk Price Change" + Style.RESET_ALL)
+                print(Fore.MAGENTA + "7. Import Catalog (CSV/JSONL)" + Style.RESET_ALL)
+                print(Fore.MAGENTA + "8. Export Catalog (CSV/JSONL)" + Style.RESET_ALL)
+                print(Fore.MAGENTA + "9. Logout" + Style.RESET_ALL)
                 admin_choice = input("Enter your choice: ")
 
 
                 if admin_choice == '1':
-                    product_id = len(store.products) + 1
+                    product_id = store.next_product_id()
                     name = input("Enter product name: ")
                     try:
                         price = float(input("Enter product price: "))
@@ -522,34 +4237,36 @@ def main():
 
 
                 elif admin_choice == '2':
-                    store.display_all_products()
+                    browse_products(store)
                     try:
                         product_id = int(input("Enter product ID to remove: "))
                     except ValueError:
                         print(Fore.RED + "Invalid input. Please enter a numeric value for product ID." + Style.RESET_ALL)
                         input("Press Enter to continue...")
                         continue
-                    admin.remove_product(store, product_id)
-                    print(Fore.GREEN + "Product removed successfully" + Style.RESET_ALL)
+                    if admin.remove_product(store, product_id):
+                        print(Fore.GREEN + "Product removed successfully" + Style.RESET_ALL)
+                    else:
+                        print(Fore.RED + "Product not found" + Style.RESET_ALL)
                     input("Press Enter to continue...")
 
 
                 elif admin_choice == '3':
-                    store.display_all_products()
+                    browse_products(store)
                     try:
                         product_id = int(input("Enter product ID to update: "))
                     except ValueError:
                         print(Fore.RED + "Invalid input. Please enter a numeric value for product ID." + Style.RESET_ALL)
                         input("Press Enter to continue...")
                         continue
-                    product = next((p for p in store.products if p.product_id == product_id), None)
+                    product = store.get_product(product_id)
                     if product:
                         name = input("Enter new name (leave blank to keep current): ")
                         price = input("Enter new price (leave blank to keep current): ")
                         description = input("Enter new description (leave blank to keep current): ")
                         quantity = input("Enter new quantity (leave blank to keep current): ")
                         try:
-                            admin.update_product_info(product, name or None, float(price) if price else None, description or None, int(quantity) if quantity else None)
+                            admin.update_product_info(store, product, name or None, float(price) if price else None, description or None, int(quantity) if quantity else None)
                             print(Fore.GREEN + "Product updated successfully" + Style.RESET_ALL)
                         except ValueError:
                             print(Fore.RED + "Invalid input. Please enter valid numeric values for price and quantity." + Style.RESET_ALL)
@@ -559,12 +4276,74 @@ def main():
 
 
                 elif admin_choice == '4':
-                    store.display_all_products()
+                    browse_products(store)
                     input("Press Enter to continue...")
 
 
                 elif admin_choice == '5':
-                    
+                    try:
+                        analytics = CatalogAnalytics(store)
+                    except RuntimeError as error:
+                        print(Fore.RED + str(error) + Style.RESET_ALL)
+                        input("Press Enter to continue...")
+                        continue
+                    print(Fore.YELLOW + f"Total stock value: {analytics.total_stock_value()}" + Style.RESET_ALL)
+                    counts, edges = analytics.price_histogram(bins=5)
+                    for count, low, high in zip(counts, edges, edges[1:]):
+                        print(f"Price {low} - {high}: {count} products")
+                    print(Fore.YELLOW + "Low stock (5 or fewer left):" + Style.RESET_ALL)
+                    for product in analytics.low_stock(threshold=5, limit=20):
+                        print(product.display_product_info())
+                    input("Press Enter to continue...")
+
+
+                elif admin_choice == '6':
+                    try:
+                        percent = float(input("Enter price change in percent (e.g. -10 for 10% off): "))
+                        min_price = input("Only products priced at least (leave blank for any): ")
+                        max_price = input("Only products priced at most (leave blank for any): ")
+                        min_price = float(min_price) if min_price else None
+                        max_price = float(max_price) if max_price else None
+                    except ValueError:
+                        print(Fore.RED + "Invalid input. Please enter numeric values." + Style.RESET_ALL)
+                        input("Press Enter to continue...")
+                        continue
+                    try:
+                        changed = admin.bulk_update_prices(store, percent, min_price=min_price, max_price=max_price)
+                        print(Fore.GREEN + f"Updated the price of {changed} products" + Style.RESET_ALL)
+                    except RuntimeError as error:
+                        print(Fore.RED + str(error) + Style.RESET_ALL)
+                    input("Press Enter to continue...")
+
+
+                elif admin_choice == '7':
+                    filename = input("Enter the file to import (.csv or .jsonl, optionally .gz): ").strip()
+                    rejects_filename = input("Enter a file for rejected rows (leave blank for none): ").strip() or None
+                    try:
+                        report = CatalogSync(store).import_file(filename, rejects_filename)
+                    except (OSError, ValueError, csv.Error) as error:
+                        print(Fore.RED + f"Import failed: {error}" + Style.RESET_ALL)
+                        input("Press Enter to continue...")
+                        continue
+                    print(Fore.GREEN + f"Read {report.rows} rows in {report.seconds:.2f}s: {report.added} added, {report.updated} updated, {report.removed} removed, {report.unchanged} unchanged" + Style.RESET_ALL)
+                    if report.rejected:
+                        print(Fore.YELLOW + f"{report.rejected} rows were rejected:" + Style.RESET_ALL)
+                        for line_number, reason in report.errors:
+                            print(f"Line {line_number}: {reason}")
+                    input("Press Enter to continue...")
+
+
+                elif admin_choice == '8':
+                    filename = input("Enter the file to export to (.csv or .jsonl, optionally .gz): ").strip()
+                    try:
+                        count = CatalogSync(store).export_file(filename)
+                        print(Fore.GREEN + f"Exported {count} products to {filename}" + Style.RESET_ALL)
+                    except (OSError, ValueError) as error:
+                        print(Fore.RED + f"Export failed: {error}" + Style.RESET_ALL)
+                    input("Press Enter to continue...")
+
+
+                elif admin_choice == '9':
                     break
                 else:
                     print(Fore.RED + "Invalid choice" + Style.RESET_ALL)
@@ -573,12 +4352,16 @@ def main():
 
         elif choice == '4':
             # Display all products in the store
-            store.display_all_products()
+            browse_products(store)
             input("Press Enter to continue...")
 
 
         elif choice == '5':
             # Exit the application
+            sessions.close()
+            order_store.close()
+            user_db.close()
+            store.journal.close()
             break
 
 
@@ -587,5 +4370,27 @@ def main():
             input("Press Enter to continue...")
 
 
+# Run with --serve [port] to start the HTTP/JSON API server instead of the menu
+# --metrics FILE records operation metrics and writes them to FILE on exit (Prometheus text for .prom, JSON otherwise)
+# --profile OPERATION FILE runs every call of one operation (e.g. ShoppingCart.checkout) under cProfile, saved on exit
 if __name__ == "__main__":
-    main()
+    args = sys.argv[1:]
+    metrics_file = None
+    if '--metrics' in args:
+        index = args.index('--metrics')
+        metrics_file = args[index + 1]
+        del args[index:index + 2]
+        metrics.enable()
+    if '--profile' in args:
+        index = args.index('--profile')
+        metrics.profile(args[index + 1], args[index + 2])
+        del args[index:index + 3]
+    try:
+        if args and args[0] == '--serve':
+            serve(port=int(args[1]) if len(args) > 1 else 8080)
+        else:
+            main()
+    finally:
+        metrics.stop_profile()
+        if metrics_file is not None:
+            metrics.dump(metrics_file)
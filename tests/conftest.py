@@ -0,0 +1,26 @@
+# The main code file has spaces in its name, so it is loaded from its path and registered as the module "shop"
+# (tests then just `import shop`)
+import importlib.util
+import os
+import sys
+
+import pytest
+
+
+def load_shop():
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "shopping cart using python oop.py")
+    spec = importlib.util.spec_from_file_location("shop", path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["shop"] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+shop = sys.modules.get("shop") or load_shop()
+
+
+# Every test runs in its own empty directory, so the files the store writes (users.txt, orders.db, ...) don't mix
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
@@ -0,0 +1,91 @@
+import pytest
+
+import shop
+
+pytest.importorskip('numpy')
+
+
+@pytest.fixture(params=[False, True], ids=['objects', 'compact'])
+def compact(request):
+    return request.param
+
+
+def make_store(compact, journal_directory=None):
+    store = shop.Store(compact=compact)
+    if journal_directory is not None:
+        shop.InventoryJournal(journal_directory, store).open()
+    return store
+
+
+def add_products(store):
+    store.add_products([shop.Product(1, "Lamp", 19.99, "Desk lamp", 3), shop.Product(2, "Desk", 5.0, "Oak desk", 10),
+                        shop.Product(3, "Chair", 0.3, "Folding chair", 1), shop.Product(4, "Shelf", 120.0, "Tall shelf", 0)])
+
+
+def prices(store):
+    return [store.get_product(product_id).price for product_id in range(1, 5)]
+
+
+def test_reports(compact):
+    store = make_store(compact)
+    add_products(store)
+    analytics = shop.CatalogAnalytics(store)
+    assert analytics.total_stock_value() == shop.Decimal('110.27')
+    assert analytics.total_stock_value(min_price=10) == shop.Decimal('59.97')
+    assert analytics.total_stock_value(product_ids=[2, 3]) == shop.Decimal('50.30')
+    assert [product.product_id for product in analytics.low_stock(threshold=3)] == [4, 3, 1]
+    assert [product.product_id for product in analytics.low_stock(threshold=3, limit=2)] == [4, 3]
+    assert analytics.price_histogram(bins=2, max_price=100) == ([2, 1], [0.3, 10.14, 19.99])
+    assert analytics.price_histogram(min_price=1000) == ([], [])
+
+
+def test_bulk_price_change_rounds_to_cents_and_stops_at_zero(compact):
+    store = make_store(compact)
+    add_products(store)
+    analytics = shop.CatalogAnalytics(store)
+    assert analytics.bulk_price_change(-10, max_price=100) == 3
+    assert prices(store) == [17.99, 4.5, 0.27, 120.0]
+    assert analytics.bulk_price_change(12.5, product_ids=[2]) == 1
+    assert store.get_product(2).price == 5.06  # 5.0625
+    assert analytics.bulk_price_change(-150) == 4
+    assert prices(store) == [0.0, 0.0, 0.0, 0.0]
+    assert analytics.bulk_price_change(10, min_price=1) == 0
+
+
+# A listener adding products as soon as it hears about new prices
+class Restocker:
+    def __init__(self, store):
+        self.store = store
+
+    def product_added(self, product):
+        pass
+
+    def product_removed(self, product):
+        pass
+
+    def product_updated(self, product, old_name, old_description):
+        pass
+
+    def prices_updated(self, product_ids):
+        self.store.add_products([shop.Product(product_id, f"Item {product_id}", 1.0, "Filler", 1) for product_id in range(5, 2000)])
+
+
+def test_catalog_can_grow_while_listeners_hear_of_a_bulk_price_change(compact):
+    store = make_store(compact)
+    add_products(store)
+    store.listeners.append(Restocker(store))
+    # A compact catalog's columns are written through NumPy views, which must be gone before the columns can grow
+    shop.CatalogAnalytics(store).bulk_price_change(-10)
+    assert len(store.products) == 1999
+    assert store.get_product(1999).price == 1.0 and store.get_product(1).price == 17.99
+
+
+def test_bulk_price_change_is_journaled(compact, workdir):
+    store = make_store(compact, str(workdir / 'inventory'))
+    add_products(store)
+    shop.CatalogAnalytics(store).bulk_price_change(-10, min_price=1)
+    store.journal.flush()
+    store.journal.close(snapshot=False)
+    restarted = make_store(compact, str(workdir / 'inventory'))
+    assert prices(restarted) == [17.99, 4.5, 0.3, 108.0]
+    restarted.journal.close()
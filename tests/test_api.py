@@ -0,0 +1,89 @@
+import asyncio
+
+import pytest
+
+import shop
+
+
+@pytest.fixture
+def api():
+    store = shop.Store()
+    store.add_product(shop.Product(1, "Laptop", 1000, "High performance laptop", 10))
+    store.add_product(shop.Product(2, "Mouse", 30, "Wireless mouse", 50))
+    user_db = shop.UserDatabase('users.txt')
+    order_store = shop.OrderStore('orders.db')
+    sessions = shop.SessionManager(store, shop.CartStore('carts.db'))
+    user_db.add_user(shop.Admin(1, "admin1", "Admin@123", "Admin", "User", "123 Admin St"))
+    yield shop.StoreAPI(store, user_db, order_store, sessions)
+    sessions.close()
+    order_store.close()
+    user_db.close()
+
+
+async def signed_up(api):
+    client = shop.LocalClient(api)
+    status, data = await client.request('POST', '/signup', {'username': 'bobbytester1', 'password': 'Password1!', 'first_name': 'Bobby', 'last_name': 'Tester'})
+    assert status == 201, data
+    assert (await client.login('bobbytester1', 'Password1!'))[0] == 200
+    return client
+
+
+def test_customer_fills_a_cart_and_checks_out(api):
+    async def run():
+        client = await signed_up(api)
+        assert (await client.request('POST', '/cart/add', {'product_id': 1, 'quantity': 2}))[0] == 200
+        status, data = await client.request('POST', '/cart/batch', {'changes': [[2, 3]]})
+        assert status == 200 and len(data['lines']) == 2
+        status, order = await client.request('POST', '/cart/checkout')
+        assert status == 200 and order['total_price'] == '2090.00'
+        status, data = await client.request('GET', '/orders')
+        assert status == 200 and len(data['orders']) == 1
+    asyncio.run(run())
+    assert api.store.get_product(1).quantity == 8
+
+
+@pytest.mark.parametrize('changes', [[[[1], 1]], [[1, "2"]], [[1, True]], [[1, 2.5]], [[1, 2, 3]], "1,2"])
+def test_batch_rejects_malformed_changes(api, changes):
+    async def run():
+        client = await signed_up(api)
+        return await client.request('POST', '/cart/batch', {'changes': changes})
+    status, data = asyncio.run(run())
+    assert status == 400, data
+
+
+def test_patch_product_to_zero(api):
+    async def run():
+        client = shop.LocalClient(api)
+        await client.login('admin1', 'Admin@123', admin=True)
+        return await client.request('PATCH', '/admin/products/1', {'price': 0, 'quantity': 0})
+    status, data = asyncio.run(run())
+    assert status == 200, data
+    assert api.store.get_product(1).price == 0 and api.store.get_product(1).quantity == 0
+
+
+def test_expired_tokens_are_swept(api):
+    async def run():
+        client = await signed_up(api)
+        user_id, expires = api.sessions[client.token]
+        api.sessions[client.token] = (user_id, expires - api.session_ttl - 1)
+        return client
+    client = asyncio.run(run())
+    assert api.end_expired_sessions() == 1
+    assert client.token not in api.sessions
+
+
+def test_malformed_content_length_gets_400(api):
+    async def run():
+        server = shop.StoreServer(api)
+        await server.start(port=0)
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', server.port)
+            writer.write(b"POST /login HTTP/1.1\r\nContent-Length: lots\r\n\r\n")
+            await writer.drain()
+            status_line = await reader.readline()
+            writer.close()
+            return status_line
+        finally:
+            server.server.close()
+            await server.server.wait_closed()
+    assert asyncio.run(run()).split()[1] == b'400'
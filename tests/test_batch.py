@@ -0,0 +1,70 @@
+import pytest
+
+import shop
+
+
+@pytest.fixture
+def store():
+    store = shop.Store()
+    store.add_products([shop.Product(1, "Laptop", 1000, "High performance laptop", 10), shop.Product(2, "Mouse", 30, "Wireless mouse", 5),
+                        shop.Product(3, "Camera", 800, "High resolution camera", 1)])
+    return store
+
+
+@pytest.fixture
+def cart(store):
+    cart = shop.ShoppingCart(shop.Customer(1, "shopper1", None, "Test", "User", "-", "hash"), shop.InventoryReservations())
+    assert cart.add_product(store.get_product(1), 2)
+    return cart
+
+
+# (stock of every product, cart quantities by product ID, cart total)
+def state(store, cart):
+    return [store.get_product(product_id).quantity for product_id in (1, 2, 3)], {product.product_id: quantity for product, quantity in cart.products}, cart.total_price
+
+
+def test_one_short_line_leaves_everything_untouched(store, cart):
+    before = state(store, cart)
+    result = cart.apply_batch(store, [(1, 3), (2, 2), (3, 2)])
+    assert not result.ok and result.applied == {} and result.order is None
+    assert result.errors == [(None, 3, "Insufficient stock: requested 2, available 1")]
+    assert state(store, cart) == before == ([8, 5, 1], {1: 2}, shop.Decimal('2000.00'))
+
+
+def test_invalid_lines_leave_everything_untouched(store, cart):
+    before = state(store, cart)
+    result = cart.apply_batch(store, [(2, 1), (999, 1), (1, 0), (3, True)])
+    assert not result.ok
+    assert [(line_number, product_id) for line_number, product_id, message in result.errors] == [(2, 999), (3, 1), (4, 3)]
+    assert state(store, cart) == before
+
+
+def test_duplicate_product_ids_are_netted(store, cart):
+    result = cart.apply_batch(store, [(1, 3), (1, -1), (2, 2), (2, -2), (3, 1)])
+    assert result.ok and result.applied == {1: 2, 3: 1}
+    assert state(store, cart) == ([6, 5, 0], {1: 4, 3: 1}, shop.Decimal('4800.00'))
+    # Taking off more than the cart holds is fine when the same batch adds enough back first
+    result = cart.apply_batch(store, [(1, -5), (1, 2)])
+    assert result.ok and result.applied == {1: -3}
+    assert state(store, cart) == ([9, 5, 0], {1: 1, 3: 1}, shop.Decimal('1800.00'))
+
+
+@pytest.mark.parametrize('changes, message', [([(1, -3)], "Cannot remove 3, only 2 in the cart"),
+                                              ([(2, -1)], "Cannot remove 1, only 0 in the cart"),
+                                              ([(1, -1), (1, -2), (2, 1)], "Cannot remove 3, only 2 in the cart")])
+def test_removing_more_than_is_in_the_cart_is_rejected(store, cart, changes, message):
+    before = state(store, cart)
+    result = cart.apply_batch(store, changes)
+    assert not result.ok
+    assert [error[2] for error in result.errors] == [message]
+    assert state(store, cart) == before
+
+
+def test_batch_with_checkout(store, cart):
+    order_store = shop.OrderStore('orders.db')
+    result = cart.apply_batch(store, [(2, 3)], checkout=True, order_store=order_store)
+    assert result.ok and result.total_price == shop.Decimal('2090.00')
+    assert sorted((line.product_id, line.quantity) for line in result.order.lines) == [(1, 2), (2, 3)]
+    assert state(store, cart) == ([8, 2, 1], {}, shop.Decimal('0.00'))
+    assert order_store.count_for_user(cart.user) == 1
+    order_store.close()
@@ -0,0 +1,56 @@
+import pytest
+
+import shop
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_search_product_by_name(compact):
+    store = shop.Store(compact=compact)
+    store.add_product(shop.Product(1, "Laptop", 1000, "High performance laptop", 10))
+    store.add_product(shop.Product(2, "laptop", 900, "Older laptop", 5))
+    assert store.search_product('Laptop').product_id == 1
+    assert store.search_product('LAPTOP') is None
+    assert store.search_product('LAPTOP', ignore_case=True) is not None
+    assert store.search_product('Nope') is None
+    assert store.search_product('Nope', ignore_case=True) is None
+
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_renamed_product_is_found_by_its_new_name(compact):
+    store = shop.Store(compact=compact)
+    store.add_product(shop.Product(1, "Laptop", 1000, "High performance laptop", 10))
+    admin = shop.Admin(1, "admin1", None, "Admin", "User", "-", "hash")
+    admin.update_product_info(store, store.get_product(1), name="Gizmo")
+    assert [product.product_id for product in store.search('gizmo')] == [1]
+    assert store.search_product('Gizmo').product_id == 1
+    assert store.search_product('Laptop') is None
+
+
+@pytest.mark.parametrize('row', [
+    {'product_id': 1, 'price': True},
+    {'product_id': 1, 'price': 'nan'},
+    {'product_id': 1, 'price': 'inf'},
+    {'product_id': 1, 'price': -1},
+    {'product_id': True, 'price': 1},
+    {'product_id': 1.9, 'price': 1},
+    {'product_id': 3, 'action': 1},
+    {'product_id': 3, 'action': ['delete']},
+    {'product_id': 1, 'quantity': False},
+])
+def test_catalog_sync_rejects_bad_values(row):
+    with pytest.raises(ValueError):
+        shop.CatalogSync.validate(row)
+
+
+def test_catalog_sync_accepts_a_valid_row():
+    assert shop.CatalogSync.validate({'product_id': '3', 'name': ' Lamp ', 'price': '0', 'quantity': 2}) == ('upsert', 3, {'name': 'Lamp', 'price': 0.0, 'quantity': 2})
+
+
+def test_import_rejects_a_row_with_a_bad_action(workdir):
+    store = shop.Store()
+    (workdir / 'catalog.jsonl').write_text('{"product_id": 1, "name": "Lamp", "price": 5, "quantity": 2}\n'
+                                           '{"product_id": 3, "action": 1}\n'
+                                           '{"product_id": 2, "name": "Desk", "price": 50, "quantity": 1}\n')
+    result = shop.CatalogSync(store).import_file(str(workdir / 'catalog.jsonl'), str(workdir / 'rejects.jsonl'))
+    assert [product.product_id for product in store.products] == [1, 2]
+    assert result.rejected == 1 and result.errors[0][0] == 2
@@ -0,0 +1,25 @@
+import sys
+import threading
+
+import shop
+
+
+def test_first_colours_from_many_threads(monkeypatch):
+    monkeypatch.delitem(sys.modules, 'colorama', raising=False)
+    monkeypatch.setattr(shop.LazyColors, 'colorama', None)
+    fore, style = shop.LazyColors('Fore'), shop.LazyColors('Style')
+    start = threading.Barrier(16)
+    errors = []
+
+    def use_colours():
+        start.wait()
+        try:
+            fore.RED + style.RESET_ALL
+        except Exception as error:
+            errors.append(error)
+    threads = [threading.Thread(target=use_colours) for _ in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
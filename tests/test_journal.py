@@ -0,0 +1,91 @@
+import shop
+
+
+def open_store(directory, **options):
+    store = shop.Store()
+    shop.InventoryJournal(directory, store, **options).open()
+    return store
+
+
+# Stops the journal like a crash right after its last write: no final snapshot
+def crash(store):
+    store.journal.flush()
+    store.journal.close(snapshot=False)
+
+
+def test_each_store_has_its_own_journal(workdir):
+    store_a = open_store(workdir / 'a')
+    store_b = open_store(workdir / 'b')
+    store_a.add_product(shop.Product(1, "Laptop", 1000, "High performance laptop", 10))
+    store_b.add_product(shop.Product(1, "Laptop", 1000, "High performance laptop", 100))
+    store_a.change_quantity(store_a.get_product(1), -3)
+    store_b.change_quantity(store_b.get_product(1), -4)
+    crash(store_a)
+    crash(store_b)
+    assert open_store(workdir / 'a').get_product(1).quantity == 7
+    assert open_store(workdir / 'b').get_product(1).quantity == 96
+
+
+def test_stock_in_carts_goes_back_on_the_shelf_after_a_crash(workdir):
+    stock = 10
+    for restart in range(2):
+        store = open_store(workdir / 'inventory')
+        if restart == 0:
+            store.add_product(shop.Product(1, "Laptop", 1000, "High performance laptop", 10))
+        assert store.get_product(1).quantity == stock
+        cart = shop.ShoppingCart(shop.Customer(1, "shopper1", None, "A", "B", "-", "hash"), shop.InventoryReservations(), store=store)
+        cart.add_product(store.get_product(1), 3)
+        assert store.get_product(1).quantity == stock - 3
+        crash(store)
+    store = open_store(workdir / 'inventory')
+    assert store.get_product(1).quantity == 10
+
+
+def test_checkout_sells_held_stock_for_good(workdir):
+    store = open_store(workdir / 'inventory', snapshot_every=1)
+    store.add_product(shop.Product(1, "Laptop", 1000, "High performance laptop", 10))
+    cart = shop.ShoppingCart(shop.Customer(1, "shopper1", None, "A", "B", "-", "hash"), shop.InventoryReservations(), store=store)
+    cart.add_product(store.get_product(1), 4)
+    cart.remove_product(1, 1)
+    cart.checkout()
+    cart.add_product(store.get_product(1), 2)
+    store.journal.snapshot()
+    crash(store)
+    assert open_store(workdir / 'inventory').get_product(1).quantity == 7
+
+
+def test_snapshots_while_products_are_added(workdir):
+    store = open_store(workdir / 'inventory', commit_delay=0, snapshot_every=50)
+    for product_id in range(1, 20001):
+        store.add_product(shop.Product(product_id, f"Item {product_id}", 10, "thing", 5))
+    store.journal.barrier()
+    assert store.journal.writer.is_alive()
+    crash(store)
+    assert len(open_store(workdir / 'inventory').products) == 20000
+
+
+def test_barrier_raises_when_the_writer_stopped(workdir):
+    store = open_store(workdir / 'inventory', commit_delay=0)
+    store.add_product(shop.Product(1, "Laptop", 1000, "High performance laptop", 10))
+    store.journal.barrier()
+    store.journal.file.close()
+    store.change_quantity(store.get_product(1), -1)
+    try:
+        store.journal.barrier()
+    except RuntimeError as error:
+        assert "stopped" in str(error)
+    else:
+        raise AssertionError("barrier() didn't raise")
+
+
+def test_product_update_is_journaled(workdir):
+    store = open_store(workdir / 'inventory')
+    store.add_product(shop.Product(1, "Laptop", 1000, "High performance laptop", 10))
+    admin = shop.Admin(1, "admin1", None, "Admin", "User", "-", "hash")
+    admin.update_product_info(store, store.get_product(1), name="Gizmo", price=0, quantity=0)
+    crash(store)
+    restarted = open_store(workdir / 'inventory')
+    product = restarted.get_product(1)
+    assert (product.name, product.price, product.quantity) == ("Gizmo", 0, 0)
+    assert [product.product_id for product in restarted.search('gizmo')] == [1]
+    restarted.journal.close()
@@ -0,0 +1,74 @@
+import pstats
+
+import pytest
+
+import shop
+
+
+@pytest.fixture
+def metrics():
+    metrics = shop.Metrics()
+    yield metrics
+    metrics.disable()
+
+
+def fill_cart(quantity):
+    cart = shop.ShoppingCart(shop.Customer(1, "shopper1", None, "Test", "User", "-", "hash"), shop.InventoryReservations())
+    return cart, cart.add_product(shop.Product(1, "Laptop", 1000, "High performance laptop", 2), quantity)
+
+
+def test_disable_puts_the_original_methods_back(metrics):
+    originals = {(class_name, method_name): getattr(shop, class_name).__dict__[method_name] for class_name, method_name, false_fails in metrics.OPERATIONS}
+    metrics.enable()
+    metrics.enable()
+    assert metrics.enabled
+    assert all(getattr(shop, class_name).__dict__[method_name] is not original for (class_name, method_name), original in originals.items())
+    metrics.disable()
+    assert not metrics.enabled
+    assert all(getattr(shop, class_name).__dict__[method_name] is original for (class_name, method_name), original in originals.items())
+
+
+def test_failed_calls_count_as_errors(metrics):
+    metrics.enable()
+    fill_cart(1)
+    cart, added = fill_cart(5)
+    assert not added
+    assert not cart.remove_product(1)
+    user = shop.Customer(2, "shopper2", "Password1!", "Test", "User", "-")
+    assert not user.check_password("wrong")
+    assert user.check_password("Password1!")
+    with pytest.raises(AttributeError):
+        shop.ShoppingCart.checkout(None)
+    data = metrics.snapshot()
+    assert (data['ShoppingCart.add_product']['calls'], data['ShoppingCart.add_product']['errors']) == (2, 1)
+    assert (data['ShoppingCart.remove_product']['calls'], data['ShoppingCart.remove_product']['errors']) == (1, 1)
+    assert (data['User.check_password']['calls'], data['User.check_password']['errors']) == (2, 1)
+    assert (data['ShoppingCart.checkout']['calls'], data['ShoppingCart.checkout']['errors']) == (1, 1)
+
+
+def test_prometheus_text(metrics):
+    metrics.enable()
+    fill_cart(1)
+    fill_cart(5)
+    lines = metrics.to_prometheus().splitlines()
+    label = 'operation="ShoppingCart.add_product"'
+    buckets = [line for line in lines if line.startswith(f'shop_operation_seconds_bucket{{{label},')]
+    assert len(buckets) == len(shop.OperationStats.BUCKETS) + 1
+    assert buckets[-1] == f'shop_operation_seconds_bucket{{{label},le="+Inf"}} 2'
+    counts = [int(line.rsplit(' ', 1)[1]) for line in buckets]
+    assert counts == sorted(counts)
+    assert f'shop_operation_seconds_count{{{label}}} 2' in lines
+    assert f'shop_operation_errors_total{{{label}}} 1' in lines
+    assert f'shop_operation_errors_total{{operation="Store.search_product"}} 0' in lines
+
+
+def test_profile_writes_a_file(metrics, workdir):
+    with pytest.raises(ValueError):
+        metrics.profile('ShoppingCart.nothing', 'x.prof')
+    metrics.profile('ShoppingCart.add_product', str(workdir / 'add.prof'))
+    fill_cart(1)
+    assert metrics.stop_profile() == str(workdir / 'add.prof')
+    assert metrics.stop_profile() is None
+    stats = pstats.Stats(str(workdir / 'add.prof'))
+    assert any(function == 'add_product' for filename, line, function in stats.stats)
+    assert metrics.snapshot()['ShoppingCart.add_product']['calls'] == 1
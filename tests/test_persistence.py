@@ -0,0 +1,123 @@
+import datetime
+import threading
+
+import shop
+
+
+# Stops a BackgroundWriter like a crash: whatever is still queued is never written
+def crash(writer):
+    writer.write_batch = lambda values: None
+    writer.close()
+
+
+def make_order(user, order_cents=200):
+    return shop.Order(user, [shop.OrderLine(1, "Laptop", order_cents, 1)], shop.from_cents(order_cents), datetime.datetime.now())
+
+
+def customer(user_id, username):
+    return shop.Customer(user_id, username, None, "Test", "User", "-", "hash")
+
+
+def test_flushed_orders_survive_a_crash():
+    order_store = shop.OrderStore('orders.db', flush_interval=3600)
+    user = customer(1, "shopper1")
+    first = order_store.add_order(make_order(user))
+    second = order_store.add_order(make_order(user, 500))
+    order_store.flush()
+    crash(order_store.writer)
+    order_store = shop.OrderStore('orders.db')
+    orders = [order for page in order_store.orders_for_user(user) for order in page]
+    assert [(order.order_id, order.total_price) for order in orders] == [(first.order_id, first.total_price), (second.order_id, second.total_price)]
+    order_store.close()
+
+
+def test_order_ids_are_not_reused_after_a_crash():
+    order_store = shop.OrderStore('orders.db', flush_interval=3600)
+    user = customer(1, "shopper1")
+    lost = [order_store.add_order(make_order(user)).order_id for _ in range(3)]
+    crash(order_store.writer)
+    order_store = shop.OrderStore('orders.db')
+    assert order_store.count_for_user(user) == 0
+    new_id = order_store.add_order(make_order(user)).order_id
+    assert new_id > max(lost)
+    order_store.close()
+
+
+def test_flushed_users_survive_a_crash():
+    user_db = shop.UserDatabase('users.txt', flush_interval=3600)
+    for user_id in range(1, 4):
+        user_db.add_user(customer(user_db.allocate_user_id(), f"shopper{user_id}"))
+    user = user_db.get_user(2)
+    for number in range(10):
+        user.address = f"{number} Test St"
+        user_db.add_user(user)
+    user_db.flush()
+    user_db.add_user(customer(user_db.allocate_user_id(), "shopper4"))
+    crash(user_db.writer)
+    with open('users.txt') as file:
+        assert len(file.readlines()) == 3
+    user_db = shop.UserDatabase('users.txt')
+    assert user_db.get_user(2).address == "9 Test St"
+    assert user_db.find_user("shopper3") is not None
+    assert user_db.find_user("shopper4") is None
+    user_db.close()
+
+
+def test_barrier_waits_for_queued_writes():
+    written = []
+    writer = shop.BackgroundWriter(written.extend, 'test', flush_interval=0.05)
+    writer.submit('a', 1)
+    writer.submit('b', 2)
+    writer.submit('a', 3)
+    writer.barrier()
+    assert written == [3, 2]
+    writer.close()
+
+
+def test_login_rehashes_passwords_made_with_old_settings(monkeypatch):
+    monkeypatch.setattr(shop, 'password_hasher', shop.PasswordHasher(iterations=1000))
+    user_db = shop.UserDatabase('users.txt')
+    user_db.add_user(shop.Customer(1, "shopper1", "Password1!", "Test", "User", "-"))
+    old_hash = user_db.get_user(1).password_hash
+    monkeypatch.setattr(shop, 'password_hasher', shop.PasswordHasher(iterations=2000))
+    assert not user_db.get_user(1).check_password("wrong", user_db)
+    assert user_db.get_user(1).password_hash == old_hash
+    assert user_db.get_user(1).check_password("Password1!", user_db)
+    user_db.close()
+    restarted = shop.UserDatabase('users.txt')
+    user = restarted.get_user(1)
+    assert user.password_hash != old_hash and not shop.password_hasher.needs_rehash(user.password_hash)
+    assert user.check_password("Password1!")
+    restarted.close()
+
+
+def test_adding_users_does_not_wait_for_a_compaction(monkeypatch):
+    user_db = shop.UserDatabase('users.txt')
+    for user_id in range(1, 4):
+        user_db.add_user(customer(user_id, f"shopper{user_id}"))
+    user_db.flush()
+    writing, release = threading.Event(), threading.Event()
+    fsync = shop.os.fsync
+
+    # The compaction's fsync is held up until the new user has been added
+    def slow_fsync(fd):
+        if not writing.is_set():
+            writing.set()
+            release.wait(10)
+        fsync(fd)
+    monkeypatch.setattr(shop.os, 'fsync', slow_fsync)
+    compaction = threading.Thread(target=user_db.save_users)
+    compaction.start()
+    assert writing.wait(10)
+    adder = threading.Thread(target=user_db.add_user, args=(customer(4, "shopper4"),))
+    adder.start()
+    adder.join(5)
+    added = not adder.is_alive()
+    release.set()
+    compaction.join()
+    adder.join()
+    assert added
+    user_db.close()
+    restarted = shop.UserDatabase('users.txt')
+    assert [restarted.find_user(f"shopper{user_id}").user_id for user_id in range(1, 5)] == [1, 2, 3, 4]
+    restarted.close()
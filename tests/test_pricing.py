@@ -0,0 +1,125 @@
+import json
+
+import pytest
+
+import shop
+
+
+def make_cart(engine, *products):
+    cart = shop.ShoppingCart(shop.Customer(1, "shopper1", None, "Test", "User", "-", "hash"), shop.InventoryReservations(), engine)
+    for product, quantity in products:
+        assert cart.add_product(product, quantity)
+    return cart
+
+
+@pytest.mark.parametrize('percent, points', [(12.5, 1250), (0.005, 1), (0.004, 0), ('7.25', 725), (0, 0), (100, 10000)])
+def test_basis_points(percent, points):
+    assert shop.basis_points(percent) == points
+
+
+@pytest.mark.parametrize('percent', [-1, 100.01])
+def test_basis_points_out_of_range(percent):
+    with pytest.raises(ValueError):
+        shop.basis_points(percent)
+
+
+def test_percent_off_rounds_half_up():
+    engine = shop.PricingEngine([shop.PercentOff(12.5, (1,)), shop.PercentOff(50, (2,))])
+    assert engine.line_discount(1, 999, 3) == 375  # 374.625
+    assert engine.line_discount(2, 1, 1) == 1  # 0.5
+    assert engine.line_discount(2, 3, 1) == 2  # 1.5
+    assert engine.line_discount(3, 999, 3) == 0
+
+
+@pytest.mark.parametrize('quantity, discount', [(2, 0), (3, 300), (5, 300), (6, 600), (7, 600)])
+def test_buy_two_get_one_free(quantity, discount):
+    engine = shop.PricingEngine([shop.BuyXGetY(2, 1, product_ids=(1,))])
+    assert engine.line_discount(1, 300, quantity) == discount
+
+
+def test_buy_one_get_one_half_price():
+    engine = shop.PricingEngine([shop.BuyXGetY(1, 1, 50)])
+    assert engine.line_discount(9, 333, 3) == 167  # one group, 166.5
+    assert engine.line_discount(9, 333, 4) == 333
+
+
+def test_buy_x_get_y_needs_whole_groups():
+    with pytest.raises(ValueError):
+        shop.PricingEngine([shop.BuyXGetY(0, 1)])
+
+
+@pytest.mark.parametrize('quantity, discount', [(4, 0), (5, 50), (9, 90), (10, 200), (25, 500)])
+def test_quantity_tier_takes_the_highest_tier_reached(quantity, discount):
+    engine = shop.PricingEngine([shop.QuantityTier(((10, 20), (5, 10)), (1,))])
+    assert engine.line_discount(1, 100, quantity) == discount
+
+
+def test_line_gets_its_single_best_discount():
+    engine = shop.PricingEngine([shop.PercentOff(10), shop.BuyXGetY(1, 1, product_ids=(1,)), shop.PercentOff(100, (2,)), shop.PercentOff(60, (2,))])
+    assert engine.line_discount(1, 1000, 2) == 1000  # buy one get one beats the 10% everywhere rule
+    assert engine.line_discount(1, 1000, 1) == 100  # no whole group, the 10% everywhere rule still applies
+    assert engine.line_discount(2, 1000, 2) == 2000  # never more than the line
+    assert engine.line_discount(3, 1000, 2) == 200
+
+
+def test_category_rules():
+    engine = shop.PricingEngine([shop.PercentOff(10, category='audio')], {'audio': [4, 7]})
+    assert [engine.line_discount(product_id, 1000, 1) for product_id in (4, 5, 7)] == [100, 0, 100]
+
+
+def test_coupon_codes_ignore_case_and_need_the_minimum_total():
+    engine = shop.PricingEngine([shop.Coupon(' save10 ', percent=10, amount=5, min_total=50), shop.Coupon('BIG', amount=100)])
+    assert engine.has_coupon('Save10') and engine.has_coupon(' SAVE10 ')
+    assert not engine.has_coupon('SAVE20') and not engine.has_coupon(None)
+    assert engine.coupon_discount('SAVE10', 4999) == 0
+    assert engine.coupon_discount('SAVE10', 5000) == 1000  # 10% plus 5.00
+    assert engine.coupon_discount('SAVE10', 5005) == 1001  # 500.5 rounds up
+    assert engine.coupon_discount('BIG', 5000) == 5000  # never more than the total
+    assert engine.coupon_discount('NOPE', 5000) == 0
+
+
+def test_cart_total_takes_the_coupon_off_after_line_discounts():
+    engine = shop.PricingEngine([shop.PercentOff(10), shop.Coupon('SAVE10', percent=10, min_total=50)])
+    cart = make_cart(engine, (shop.Product(1, "Lamp", 30, "Desk lamp", 5), 2))
+    assert cart.total_price == shop.Decimal('54.00')
+    assert not cart.apply_coupon('nope')
+    assert cart.apply_coupon(' save10 ')
+    assert cart.coupon == 'SAVE10'
+    assert cart.discount_breakdown() == (600, 540)
+    assert cart.total_price == shop.Decimal('48.60')
+    cart.remove_product(1, 1)
+    assert cart.discount_breakdown() == (300, 0)  # 27.00 is below the coupon's minimum
+    assert cart.total_price == shop.Decimal('27.00')
+
+
+def test_cart_prices_all_its_lines_again_when_the_rules_change():
+    engine = shop.PricingEngine([shop.PercentOff(10, (1,))])
+    cart = make_cart(engine, (shop.Product(1, "Lamp", 10, "Desk lamp", 5), 3), (shop.Product(2, "Desk", 99.99, "Oak desk", 5), 1))
+    assert cart.total_price == shop.Decimal('126.99')
+    version = engine.version
+    engine.compile([shop.BuyXGetY(2, 1, product_ids=(1,)), shop.PercentOff(50, (2,))])
+    assert engine.version == version + 1
+    assert cart.discounts == {1: 300}  # not priced again until the cart is read
+    assert cart.total_price == shop.Decimal('69.99')  # 20.00 + 49.99 (4999.5 cents off rounds up to 50.00)
+    assert cart.discounts == {1: 1000, 2: 5000} and cart.pricing_version == engine.version
+
+
+def test_lines_total_of_order_lines():
+    engine = shop.PricingEngine([shop.QuantityTier(((3, 15),))])
+    lines = [shop.OrderLine(1, "Lamp", 1999, 3), shop.OrderLine(2, "Desk", 5000, 1)]
+    assert engine.lines_total_cents(lines) == 5997 - 900 + 5000  # 899.55 rounds up
+
+
+def test_load_pricing_rules(workdir):
+    (workdir / 'promotions.json').write_text(json.dumps({
+        'categories': {'audio': [4]},
+        'rules': [{'type': 'percent_off', 'percent': 12.5, 'category': 'audio'},
+                  {'type': 'quantity_tier', 'tiers': [[5, 10]], 'product_ids': [1]},
+                  {'type': 'coupon', 'code': 'welcome', 'amount': 5}]}))
+    rules, categories = shop.load_pricing_rules(str(workdir / 'promotions.json'))
+    assert rules == [shop.PercentOff(12.5, (), 'audio'), shop.QuantityTier(((5, 10),), (1,)), shop.Coupon('welcome', amount=5)]
+    engine = shop.PricingEngine(rules, categories)
+    assert (engine.line_discount(4, 800, 1), engine.line_discount(1, 100, 5), engine.coupon_discount('WELCOME', 2000)) == (100, 50, 500)
+    (workdir / 'bad.json').write_text(json.dumps({'rules': [{'type': 'free_lunch'}]}))
+    with pytest.raises(ValueError):
+        shop.load_pricing_rules(str(workdir / 'bad.json'))
@@ -0,0 +1,74 @@
+import random
+import sys
+import threading
+
+import pytest
+
+import shop
+
+
+# Many carts fighting over a few products: no stock may be oversold or lost, and no shopper thread may raise
+def test_concurrent_carts_never_oversell():
+    threads, operations, stock = 16, 500, 100
+    reservations = shop.InventoryReservations(ttl=60)
+    products = [shop.Product(i, f"Product {i}", 10, "Contended product", stock) for i in range(1, 4)]
+    customers = [shop.Customer(i, f"customer{i}", None, "Stress", "Test", "-", "hash") for i in range(threads)]
+    for customer in customers:
+        customer.cart = shop.ShoppingCart(customer, reservations)
+    sold = [0] * threads
+    errors = []
+    start = threading.Barrier(threads)
+
+    def shopper(index):
+        rng = random.Random(index)
+        cart = customers[index].cart
+        start.wait()
+        try:
+            for _ in range(operations):
+                product = rng.choice(products)
+                action = rng.random()
+                if action < 0.6:
+                    cart.add_product(product, rng.randint(1, 3))
+                elif action < 0.95 or index % 4 == 0:
+                    cart.remove_product(product.product_id, rng.randint(1, 3))
+                else:
+                    sold[index] += sum(line.quantity for line in cart.checkout().lines)
+        except Exception as error:
+            errors.append(error)
+
+    old_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        workers = [threading.Thread(target=shopper, args=(i,)) for i in range(threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    finally:
+        sys.setswitchinterval(old_interval)
+
+    assert errors == []
+    total = stock * len(products)
+    in_carts = sum(customer.cart.quantity_of(product.product_id) for customer in customers for product in products)
+    assert all(product.quantity >= 0 for product in products)
+    assert sum(sold) + in_carts + sum(product.quantity for product in products) == total
+
+    # Expiring the abandoned carts gives all of their stock back
+    reservations.ttl = 0
+    for customer in customers:
+        reservations.touch(customer.cart)
+    reservations.expire(shop.time.monotonic() + 1)
+    assert sum(product.quantity for product in products) == total - sum(sold)
+
+
+@pytest.mark.parametrize('quantity', [0, -5])
+def test_removing_a_non_positive_quantity_changes_nothing(quantity):
+    product = shop.Product(1, "Laptop", 1000, "High performance laptop", 2)
+    reservations = shop.InventoryReservations(ttl=60)
+    cart = shop.ShoppingCart(shop.Customer(1, "shopper1", None, "Test", "User", "-", "hash"), reservations)
+    assert cart.add_product(product, 1)
+    cart.remove_product(1, quantity)
+    assert product.quantity == 1 and cart.quantity_of(1) == 1
+    with pytest.raises(ValueError):
+        reservations.release(cart, product, quantity)
+    assert product.quantity == 1
@@ -0,0 +1,53 @@
+import time
+
+import shop
+
+
+def test_expired_cart_is_saved_before_its_stock_goes_back():
+    store = shop.Store()
+    store.add_product(shop.Product(1, "Laptop", 1000, "High performance laptop", 10))
+    reservations = shop.inventory_reservations
+    sessions = shop.SessionManager(store, shop.CartStore('carts.db'), idle_ttl=1800)
+    customer = shop.Customer(1, "shopper1", None, "Test", "User", "-", "hash")
+    sessions.login(customer).add_product(store.get_product(1), 3)
+    now = time.monotonic()
+    assert reservations.expire(now + reservations.ttl + 300) == 1
+    assert store.get_product(1).quantity == 10
+    sessions.evict_idle(now + 1900)
+    cart = sessions.login(customer)
+    assert cart.quantity_of(1) == 3
+    assert store.get_product(1).quantity == 7
+    sessions.close()
+
+
+def test_cart_outside_a_session_is_emptied_on_expiry():
+    product = shop.Product(1, "Laptop", 1000, "High performance laptop", 10)
+    reservations = shop.InventoryReservations(ttl=60)
+    cart = shop.ShoppingCart(shop.Customer(1, "shopper1", None, "Test", "User", "-", "hash"), reservations)
+    cart.add_product(product, 4)
+    assert reservations.expire(time.monotonic() + 30) == 0
+    assert reservations.expire(time.monotonic() + 61) == 1
+    assert product.quantity == 10 and not cart.lines
+
+
+def test_cart_after_an_expired_session_comes_from_the_session_manager(workdir):
+    store = shop.Store()
+    shop.InventoryJournal(str(workdir / 'inventory'), store).open()
+    store.add_product(shop.Product(1, "Laptop", 1000, "High performance laptop", 10))
+    reservations = shop.inventory_reservations
+    sessions = shop.SessionManager(store, shop.CartStore('carts.db'))
+    customer = shop.Customer(1, "shopper1", None, "Test", "User", "-", "hash")
+    sessions.touch(customer).add_product(store.get_product(1), 3)
+    assert reservations.expire(time.monotonic() + reservations.ttl + 300) == 1
+    cart = customer.cart
+    assert cart.store is store and cart.on_expire is not None
+    assert cart.quantity_of(1) == 3
+    assert sessions.touch(customer) is cart
+    cart.checkout()
+    store.journal.flush()
+    store.journal.close(snapshot=False)
+    restarted = shop.Store()
+    shop.InventoryJournal(str(workdir / 'inventory'), restarted).open()
+    assert restarted.get_product(1).quantity == 7
+    restarted.journal.close()
+    sessions.close()
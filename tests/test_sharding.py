@@ -0,0 +1,124 @@
+import time
+
+import pytest
+
+import shop
+
+
+@pytest.fixture
+def sharded(workdir):
+    sharded = shop.ShardedStore(str(workdir / 'shards'), shards=2, routers=1, prepare_timeout=0.2).start()
+    yield sharded
+    sharded.stop()
+
+
+def stock(router, product_id):
+    return router.get_product(product_id).quantity
+
+
+def test_checkout_across_shards(sharded):
+    router = sharded.router()
+    router.add_products([shop.Product(i, f"Item {i} widget", 10 + i, "A widget", 5) for i in range(1, 5)])
+    user_id = router.signup("shopper01", "Password1!", "Test", "User", "-")
+    assert router.login("shopper01", "Password1!") == user_id
+    assert router.add_to_cart(user_id, 1, 2)
+    assert router.add_to_cart(user_id, 2, 1)
+    assert not router.add_to_cart(user_id, 3, 6)
+    order = router.checkout(user_id)
+    assert order.total_price == shop.Decimal('34.00')
+    assert sorted((line.product_id, line.quantity) for line in order.lines) == [(1, 2), (2, 1)]
+    assert router.view_cart(user_id) == []
+    assert (stock(router, 1), stock(router, 2), stock(router, 3)) == (3, 4, 5)
+    assert [placed.order_id for placed in router.orders(user_id)] == [order.order_id]
+
+
+def test_unknown_user_gets_no_cart(sharded):
+    router = sharded.router()
+    router.add_products([shop.Product(1, "Item 1 widget", 11, "A widget", 5)])
+    with pytest.raises(shop.ShardError):
+        router.add_to_cart(999, 1, 1)
+    with pytest.raises(shop.ShardError):
+        router.checkout(999)
+    assert router.view_cart(999) == []
+    assert stock(router, 1) == 5
+
+
+def test_stale_prepare_is_aborted(sharded):
+    router = sharded.router()
+    router.add_products([shop.Product(i, f"Item {i} widget", 10 + i, "A widget", 5) for i in range(1, 3)])
+    user_id = router.signup("shopper01", "Password1!", "Test", "User", "-")
+    router.add_to_cart(user_id, 1, 2)
+    router.add_to_cart(user_id, 2, 1)
+    # The router prepares a checkout and then never finishes it, like a router that died
+    votes = router.call_many({shard: ('prepare', ('dead:1', user_id, shard == router.shard_of_user(user_id))) for shard in range(2)})
+    assert all(status == 'ok' for status, value in votes.values())
+    assert router.view_cart(user_id) == []
+    time.sleep(0.7)
+    with pytest.raises(shop.ShardError):
+        router.call(router.shard_of_user(user_id), 'record_order', 'dead:1', user_id, [], shop.datetime.datetime.now())
+    assert sorted((line.product_id, line.quantity) for line in router.view_cart(user_id)) == [(1, 2), (2, 1)]
+    assert router.checkout(user_id) is not None
+
+
+def test_router_dying_after_the_order_was_recorded_still_commits(sharded):
+    router = sharded.router()
+    router.add_products([shop.Product(i, f"Item {i} widget", 10 + i, "A widget", 5) for i in range(1, 3)])
+    user_id = router.signup("shopper01", "Password1!", "Test", "User", "-")
+    router.add_to_cart(user_id, 1, 2)
+    router.add_to_cart(user_id, 2, 1)
+    user_shard = router.shard_of_user(user_id)
+    votes = router.call_many({shard: ('prepare', ('dead:1', user_id, shard == user_shard)) for shard in range(2)})
+    rows = [row for status, value in votes.values() for row in value]
+    order_id = router.call(user_shard, 'record_order', 'dead:1', user_id, rows, shop.datetime.datetime.now())
+    # The router dies here, before telling the shards to commit
+    time.sleep(0.7)
+    assert router.view_cart(user_id) == []
+    assert router.checkout(user_id) is None
+    assert [order.order_id for order in router.orders(user_id)] == [order_id]
+    assert (stock(router, 1), stock(router, 2)) == (3, 4)
+
+
+def start_workers(directory, timeout=0.2):
+    ends = shop.multiprocessing.Pipe()
+    return [shop.ShardWorker(shard, 2, directory, timeout, {1 - shard: ends[shard]}) for shard in range(2)]
+
+
+# Stops a worker like a crash: its journal gets no final snapshot and open carts keep their stock
+def crash(worker):
+    worker.reservations.stop_reaper()
+    worker.store.journal.flush()
+    worker.store.journal.close(snapshot=False)
+    worker.order_store.close()
+    worker.user_db.close()
+
+
+@pytest.mark.parametrize('recorded', [True, False])
+def test_participant_settles_its_prepares_after_a_crash(workdir, recorded):
+    user_shard, shard = start_workers(str(workdir / 'shards'))
+    shard.op_add_products([(1, "Item 1 widget", 11, "A widget", 10)])
+    user_id = user_shard.op_signup("shopper01", "Password1!", "Test", "User", "-")
+    assert user_id % 2 == 0
+    assert shard.op_cart_change(user_id, [(1, 3)])[0]
+    user_shard.op_prepare('dead:1', user_id, True)
+    rows = shard.op_prepare('dead:1', user_id, False)
+    if recorded:
+        user_shard.op_record_order('dead:1', user_id, rows, shop.datetime.datetime.now())
+    crash(shard)
+    shard = shop.ShardWorker(1, 2, str(workdir / 'shards'), 0.2, shard.peers)
+    assert shard.store.get_product(1).quantity == 7
+    shard.settle_stale()
+    # Pass the question to the user's shard and its answer back, as their serve loops would
+    user_shard.peer_message(1, *user_shard.peers[1].recv())
+    shard.peer_message(0, *shard.peers[0].recv())
+    assert shard.store.journal.prepared == {}
+    expected = 7 if recorded else 10
+    assert shard.store.get_product(1).quantity == expected
+    crash(shard)
+    shard = shop.ShardWorker(1, 2, str(workdir / 'shards'), 0.2, shard.peers)
+    assert shard.store.get_product(1).quantity == expected
+    if not recorded:
+        with pytest.raises(ValueError):
+            user_shard.op_record_order('dead:1', user_id, rows, shop.datetime.datetime.now())
+    assert user_shard.order_store.count_for_user(user_shard.user_db.get_user(user_id)) == int(recorded)
+    shard.op_stop()
+    user_shard.op_stop()